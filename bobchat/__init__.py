@@ -44,6 +44,137 @@ def create_app(test_config=None):
         # It’s under app.instance_path, which is the path that Flask has chosen
         # for the instance folder.
         DATABASE=os.path.join(app.instance_path, 'database.sqlite'),
+
+        # DATABASE_DRIVER is 'sqlite', or 'postgresql' to use the server at POSTGRES_DSN instead,
+        # e.g. 'host=db.example.com dbname=bobchat user=bobchat'. See postgres.py.
+        # Each worker keeps a pool of POSTGRES_POOL_MIN_SIZE to POSTGRES_POOL_MAX_SIZE connections,
+        # and a request waits up to POSTGRES_POOL_TIMEOUT seconds for one. A statement is prepared on
+        # the server once a connection has run it POSTGRES_PREPARE_THRESHOLD times.
+        DATABASE_DRIVER='sqlite',
+        POSTGRES_DSN='dbname=bobchat',
+        POSTGRES_POOL_MIN_SIZE=1,
+        POSTGRES_POOL_MAX_SIZE=10,
+        POSTGRES_POOL_TIMEOUT=30,
+        POSTGRES_PREPARE_THRESHOLD=5,
+
+        # FEED_PAGE_SIZE is how many posts are shown per page of a user's feed.
+        # The rest are reached through the "load more" link at the bottom.
+        FEED_PAGE_SIZE=20,
+
+        # A post's page shows COMMENT_PAGE_SIZE comments at a time, and expanding a thread
+        # shows REPLY_PAGE_SIZE of its replies at a time.
+        COMMENT_PAGE_SIZE=20,
+        REPLY_PAGE_SIZE=10,
+
+        # New posts are copied into the feed of each follower of their den, unless the den has
+        # at least TIMELINE_FANOUT_LIMIT followers; those dens are read when the feed is shown.
+        # Following a den copies its TIMELINE_BACKFILL most recent posts into your feed.
+        # See timelines.py.
+        TIMELINE_FANOUT_LIMIT=1000,
+        TIMELINE_BACKFILL=100,
+
+        # The den directory shows DEN_PAGE_SIZE dens per page. Sorted by activity, it ranks dens
+        # by how many posts they've had in the last DEN_ACTIVITY_DAYS days, today included.
+        DEN_PAGE_SIZE=20,
+        DEN_ACTIVITY_DAYS=7,
+
+        # SEARCH_PAGE_SIZE is how many results are shown per page when searching
+        # for dens, posts or users.
+        SEARCH_PAGE_SIZE=20,
+
+        # The JSON API returns API_PAGE_SIZE items per page, unless asked for a different
+        # ?per_page= up to API_MAX_PAGE_SIZE. See api.py.
+        API_PAGE_SIZE=20,
+        API_MAX_PAGE_SIZE=100,
+
+        # These are applied to every SQLite connection when it's opened. See db.open_db().
+        # cache_size is negative to mean KiB rather than pages, so this is a 64 MiB page cache.
+        # mmap_size lets SQLite read the database file through memory-mapped I/O.
+        # busy_timeout is how many milliseconds to wait for another writer before giving up.
+        SQLITE_JOURNAL_MODE='wal',
+        SQLITE_SYNCHRONOUS='normal',
+        SQLITE_CACHE_SIZE=-64000,
+        SQLITE_MMAP_SIZE=256 * 1024 * 1024,
+        SQLITE_BUSY_TIMEOUT=5000,
+        SQLITE_FOREIGN_KEYS=True,
+        SQLITE_CACHED_STATEMENTS=256,
+
+        # The logged in user is cached in each worker for up to USER_CACHE_TTL seconds,
+        # for up to USER_CACHE_SIZE users, instead of being looked up on every request.
+        # Entries only expire with the TTL (see auth.get_user_cache()).
+        USER_CACHE_SIZE=4096,
+        USER_CACHE_TTL=60,
+
+        # Rendered pages are cached in each worker until a write changes them. See pagecache.py.
+        # PAGE_CACHE_MAX_BYTES caps the memory the cache can use, as well as the number of pages.
+        PAGE_CACHE_ENABLED=True,
+        PAGE_CACHE_SIZE=10000,
+        PAGE_CACHE_MAX_BYTES=64 * 1024 * 1024,
+
+        # New posts, comments and likes are pushed to the pages showing them. See events.py.
+        # Workers pass events to each other through Unix sockets in EVENTS_SOCKET_DIR.
+        # Each subscriber can fall EVENTS_QUEUE_SIZE events behind before it starts missing some,
+        # and idle streams get a heartbeat every EVENTS_HEARTBEAT seconds.
+        EVENTS_SOCKET_DIR=os.path.join(app.instance_path, 'events'),
+        EVENTS_QUEUE_SIZE=100,
+        EVENTS_HEARTBEAT=15,
+
+        # Likes are collected in each worker and written in batches, every LIKE_FLUSH_INTERVAL
+        # seconds or once LIKE_BUFFER_SIZE are waiting. LIKE_BUFFER is 'memory', 'journal' to also
+        # keep them in LIKE_JOURNAL_DIR in case a worker dies, or 'off' to write each one
+        # immediately. See likes.py.
+        LIKE_BUFFER='memory',
+        LIKE_BUFFER_SIZE=1000,
+        LIKE_FLUSH_INTERVAL=1.0,
+        LIKE_JOURNAL_DIR=os.path.join(app.instance_path, 'likes'),
+
+        # Each request's SQL and template timings are collected per route and served at /metrics
+        # for Prometheus (see metrics.py). Workers share them through files in METRICS_DIR, written
+        # every METRICS_FLUSH_INTERVAL seconds. Statements slower than METRICS_SLOW_QUERY seconds
+        # are logged. /metrics is only served to this machine, unless METRICS_TOKEN is set, which it
+        # then needs as a bearer token.
+        METRICS_ENABLED=True,
+        METRICS_DIR=os.path.join(app.instance_path, 'metrics'),
+        METRICS_FLUSH_INTERVAL=10,
+        METRICS_SLOW_QUERY=0.1,
+        METRICS_TOKEN=None,
+
+        # How passwords are hashed (see passwords.py). PASSWORD_HASH_METHOD is 'scrypt', with
+        # PASSWORD_SCRYPT_N/R/P, or 'pbkdf2' with PASSWORD_PBKDF2_ITERATIONS. Existing hashes are
+        # upgraded when their user logs in. Each worker hashes PASSWORD_HASH_WORKERS passwords at
+        # a time, with up to PASSWORD_HASH_QUEUE more waiting, and turns the rest away with a 503.
+        PASSWORD_HASH_METHOD='scrypt',
+        PASSWORD_SCRYPT_N=2 ** 15,
+        PASSWORD_SCRYPT_R=8,
+        PASSWORD_SCRYPT_P=1,
+        PASSWORD_PBKDF2_ITERATIONS=1000000,
+        PASSWORD_HASH_WORKERS=2,
+        PASSWORD_HASH_QUEUE=16,
+
+        # When served over ASGI (see asgi.py), views run on a pool of ASGI_THREADS threads per
+        # worker, and event streams look up their user on a pool of ASGI_DB_THREADS (see asyncdb.py).
+        ASGI_THREADS=32,
+        ASGI_DB_THREADS=8,
+
+        # Static files are served under names that include a hash of their contents, and cached by
+        # browsers for a year. Their gzip and brotli versions are written to ASSETS_DIR. Turn
+        # ASSETS_FINGERPRINT off while editing them, since they're hashed at startup. See assets.py.
+        ASSETS_FINGERPRINT=True,
+        ASSETS_DIR=os.path.join(app.instance_path, 'assets'),
+
+        # Long listing pages are rendered while they're sent, STREAM_BUFFER_SIZE characters at a
+        # time (see streaming.py). Responses are compressed with gzip at COMPRESS_LEVEL (1-9) on the
+        # way out, unless they're shorter than COMPRESS_MIN_SIZE bytes. See compression.py.
+        STREAM_BUFFER_SIZE=16 * 1024,
+        COMPRESS_ENABLED=True,
+        COMPRESS_LEVEL=6,
+        COMPRESS_MIN_SIZE=500,
+
+        # Compiled templates are kept in TEMPLATE_CACHE_DIR between restarts (None to turn that off).
+        # When served with gunicorn.conf.py, the app requests WARMUP_PATHS once before the workers
+        # are forked, so they start with everything those pages need loaded. See boot.py.
+        TEMPLATE_CACHE_DIR=os.path.join(app.instance_path, 'templates'),
+        WARMUP_PATHS=['/', '/auth/login', '/auth/register', '/dens/', '/users/'],
     )
 
     if test_config is None:
@@ -69,6 +200,39 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    from . import metrics
+    metrics.init_app(app)
+
+    from . import loader
+    loader.init_app(app)
+
+    from . import counters
+    counters.init_app(app)
+
+    from . import search
+    search.init_app(app)
+
+    from . import timelines
+    timelines.init_app(app)
+
+    from . import likes
+    likes.init_app(app)
+
+    from . import queryplan
+    queryplan.init_app(app)
+
+    from . import bench
+    bench.init_app(app)
+
+    from . import assets
+    assets.init_app(app)
+
+    from . import compression
+    compression.init_app(app)
+
+    from . import boot
+    boot.init_app(app)
+
     from . import auth
     app.register_blueprint(auth.bp)
 
@@ -76,9 +240,11 @@ def create_app(test_config=None):
     from . import dens
     from . import posts
     from . import users
+    from . import events
     app.register_blueprint(users.bp)
     app.register_blueprint(posts.bp)
     app.register_blueprint(dens.bp)
+    app.register_blueprint(events.bp)
     # Unlike the auth blueprint, the den blueprint does not have a url_prefix.
     # So the index view will be at /, the create view at /create, and so on.
 
@@ -86,6 +252,9 @@ def create_app(test_config=None):
     app.register_blueprint(index.bp)
     app.add_url_rule('/', endpoint='index')
 
+    from . import api
+    app.register_blueprint(api.bp)
+
     # print(" * Using SECRET_KEY: " + app.config['SECRET_KEY'])
 
     return app
@@ -0,0 +1,369 @@
+#
+#   api.py
+#       A read-only JSON API under /api/v1 that mirrors the main pages of the site,
+#       for clients that want the data rather than the HTML.
+#
+
+# Every response has a strong ETag and a Last-Modified date, worked out from the same version
+# counters the page cache uses (see pagecache.py). A client or proxy that already has a copy sends
+# them back in If-None-Match or If-Modified-Since, and if nothing it depends on has changed it gets
+# an empty 304 Not Modified. Checking costs one indexed read of the versions table; the queries
+# that build the response are never run.
+#
+# Lists are paginated with ?page= and ?per_page=, and ?fields=id,title returns only those fields
+# of each item in the list. Pages that show something only to logged in users need the same
+# session cookie as the site.
+
+import functools
+import hashlib
+from datetime import datetime, timezone
+
+from flask import Blueprint, Response, current_app, g, jsonify, request, url_for
+from werkzeug.exceptions import HTTPException, abort
+
+from bobchat.db import get_db
+from bobchat.loader import get_loader
+from bobchat.timelines import get_timeline
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# The fields each kind of item can have, and the order they're returned in.
+DEN_FIELDS = ('id', 'name', 'description', 'created', 'username')
+POST_FIELDS = ('id', 'den_id', 'title', 'created', 'username', 'likes')
+FEED_FIELDS = ('id', 'den_id', 'den_name', 'title', 'body', 'created', 'username', 'likes')
+USER_POST_FIELDS = ('id', 'den_id', 'den_name', 'title', 'created', 'likes')
+COMMENT_FIELDS = ('id', 'parent_id', 'body', 'created', 'username', 'reply_count')
+
+
+# Errors are returned as JSON too, rather than as the HTML error pages.
+@bp.errorhandler(HTTPException)
+def handle_error(error):
+    response = jsonify(error=error.description)
+    response.status_code = error.code
+    return response
+
+
+# Like auth.login_required, but answers 401 instead of redirecting to the login form.
+def api_login_required(view):
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        if g.user is None:
+            abort(401, 'You need to be logged in.')
+        return view(**kwargs)
+
+    return wrapped_view
+
+
+# Returns the current version of each key, in the same order, and when the most recent of them
+# changed (or None if none of them have ever changed).
+def get_validators(keys):
+    rows = get_db().execute(
+        'SELECT key, version, modified FROM versions WHERE key IN ({})'.format(', '.join('?' * len(keys))),
+        keys,
+    ).fetchall()
+    versions = dict((row['key'], row['version']) for row in rows)
+    modified = max((row['modified'] for row in rows), default=None)
+    if modified is not None:
+        # CURRENT_TIMESTAMP is in UTC.
+        modified = datetime.strptime(modified, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    return tuple(versions.get(key, 0) for key in keys), modified
+
+
+# Answers conditional requests for a view that returns a dict to be sent as JSON.
+#
+# depends_on is called with the view's arguments and returns the version keys the response depends
+# on, like cached_page() in pagecache.py. The ETag is a hash of those versions and the URL, so it
+# changes whenever the response could. With private=True the response also depends on who's logged
+# in, and is marked so that shared caches don't hand it to anyone else.
+def conditional(depends_on, private=False):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(**kwargs):
+            keys = depends_on(**kwargs)
+            versions, modified = get_validators(keys)
+            user_id = g.user['id'] if private else None
+            etag = hashlib.sha1(
+                repr((request.full_path, user_id, tuple(keys), versions)).encode('utf8')).hexdigest()
+
+            # If-None-Match wins when a client sends both, since an ETag is more precise than
+            # a date with one-second resolution. It's compared weakly, as RFC 7232 says it must be:
+            # the compression middleware sends W/"..." for a gzipped response (see compression.py),
+            # and that's the tag the client sends back.
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                # A write in the same second as the client's last fetch has the same Last-Modified,
+                # so that isn't enough to say nothing changed. Only a date after the last write is.
+                not_modified = (modified is not None and request.if_modified_since is not None
+                                and modified < request.if_modified_since)
+
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = jsonify(view(**kwargs))
+
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
+            # Caches may keep a copy, but have to check it's still current every time.
+            response.cache_control.no_cache = True
+            if private:
+                response.cache_control.private = True
+                response.vary.add('Cookie')
+            else:
+                response.cache_control.public = True
+            return response
+
+        return wrapped_view
+
+    return decorator
+
+
+# Returns the requested page number and page size.
+def get_page():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = request.args.get('per_page', current_app.config['API_PAGE_SIZE'], type=int)
+    per_page = min(max(per_page, 1), current_app.config['API_MAX_PAGE_SIZE'])
+    return page, per_page
+
+
+# Returns the fields named in ?fields=, in the order given, or all of them if it's missing.
+def get_fields(allowed):
+    fields = request.args.get('fields')
+    if fields is None:
+        return allowed
+    fields = [field for field in fields.split(',') if field]
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        abort(400, 'Unknown fields: {}. Choose from: {}.'.format(', '.join(unknown), ', '.join(allowed)))
+    return fields
+
+
+# Turns one page of rows into a list of dicts with just the requested fields, plus the URL of the
+# next page. rows should have one row more than a page if there is a next page.
+# Any other query arguments (like ?fields=) are carried over to the next page.
+def paginate(rows, page, per_page, fields):
+    items = [dict((field, row[field]) for field in fields) for row in rows[:per_page]]
+    next_url = None
+    if len(rows) > per_page:
+        args = request.args.to_dict()
+        args['page'] = page + 1
+        next_url = url_for(request.endpoint, **request.view_args, **args)
+    return items, next_url
+
+
+# Validates the query arguments, and returns the LIMIT and OFFSET for the requested page along with
+# a function that turns the rows into the items of the response.
+def page_query(allowed_fields):
+    page, per_page = get_page()
+    fields = get_fields(allowed_fields)
+    return per_page + 1, (page - 1) * per_page, lambda rows: paginate(rows, page, per_page, fields)
+
+
+# Mirrors the home page: the site-wide totals and the most recent posts.
+@bp.route('/')
+@conditional(lambda: ['posts', 'users', 'likes', 'dens'])
+def index():
+    db = get_db()
+    stats = db.execute('''
+        SELECT users,
+            posts,
+            dens
+        FROM site_stats
+        WHERE id = 1;
+    ''').fetchone()
+    limit, offset, finish = page_query(FEED_FIELDS)
+    posts = db.execute('''
+        SELECT posts.id,
+            posts.den_id,
+            dens.name AS den_name,
+            posts.title,
+            posts.body,
+            posts.created,
+            users.username,
+            posts.like_count AS likes
+        FROM posts
+            JOIN users ON users.id = posts.author_id
+            JOIN dens ON dens.id = posts.den_id
+        ORDER BY posts.created DESC, posts.id DESC
+        LIMIT ? OFFSET ?;
+    ''', (limit, offset)).fetchall()
+    posts, next_url = finish(posts)
+    return {'stats': dict(stats) if stats else None, 'posts': posts, 'next': next_url}
+
+
+# The version keys of a user's feed: what they follow, and every den they follow.
+def feed_keys():
+    user_id = g.user['id']
+    dens = get_db().execute('''
+        SELECT den_id
+        FROM user_den_assoc
+        WHERE user_id = ?;
+    ''', (user_id,)).fetchall()
+    return ['follows:{}'.format(user_id)] + ['den:{}'.format(row['den_id']) for row in dens]
+
+
+# Mirrors the logged in user's feed. Like the HTML feed, it's paginated with a keyset:
+# the next link carries the created time and id of the last post, as ?before= and ?before_id=.
+@bp.route('/feed')
+@api_login_required
+@conditional(feed_keys, private=True)
+def feed():
+    page_size = get_page()[1]
+    fields = get_fields(FEED_FIELDS)
+    before = request.args.get('before')
+    before_id = request.args.get('before_id', type=int)
+    cursor = None if before is None or before_id is None else (before, before_id)
+
+    rows = get_timeline(g.user['id'], cursor, page_size + 1)
+    names = {'id': 'post_id', 'den_name': 'name'}
+    posts = [dict((field, row[names.get(field, field)]) for field in fields) for row in rows[:page_size]]
+    next_url = None
+    if len(rows) > page_size:
+        args = request.args.to_dict()
+        args['before'] = rows[page_size - 1]['created']
+        args['before_id'] = rows[page_size - 1]['post_id']
+        next_url = url_for('api.feed', **args)
+    return {'posts': posts, 'next': next_url}
+
+
+# Mirrors the list of all dens, newest first.
+@bp.route('/dens')
+@conditional(lambda: ['dens'])
+def dens():
+    limit, offset, finish = page_query(DEN_FIELDS)
+    rows = get_db().execute('''
+        SELECT dens.id,
+            dens.name,
+            dens.description,
+            dens.created,
+            users.username
+        FROM dens
+            JOIN users ON users.id = dens.author_id
+        ORDER BY dens.created DESC, dens.id DESC
+        LIMIT ? OFFSET ?;
+    ''', (limit, offset)).fetchall()
+    items, next_url = finish(rows)
+    return {'dens': items, 'next': next_url}
+
+
+# Mirrors a den's page: the den, whether you follow it, and its posts, most liked first.
+@bp.route('/dens/<int:den_id>')
+@api_login_required
+@conditional(lambda den_id: ['den:{}'.format(den_id), 'follows:{}'.format(g.user['id'])], private=True)
+def den(den_id):
+    db = get_db()
+    den, following = get_loader().den_for_user(den_id, g.user['id'])
+    if den is None:
+        abort(404, "Den id {} doesn't exist.".format(den_id))
+
+    limit, offset, finish = page_query(POST_FIELDS)
+    rows = db.execute('''
+        SELECT posts.id,
+            posts.den_id,
+            posts.title,
+            posts.created,
+            users.username,
+            posts.like_count AS likes
+        FROM posts
+            JOIN users ON users.id = posts.author_id
+        WHERE posts.den_id = ?
+        ORDER BY posts.like_count DESC, posts.id
+        LIMIT ? OFFSET ?;
+    ''', (den_id, limit, offset)).fetchall()
+    posts, next_url = finish(rows)
+    return {
+        'den': dict((field, den[field]) for field in DEN_FIELDS),
+        'following': following,
+        'posts': posts,
+        'next': next_url,
+    }
+
+
+# Mirrors a post's page: the post and its comments, newest first.
+@bp.route('/dens/<int:den_id>/<int:post_id>')
+@api_login_required
+@conditional(lambda den_id, post_id: ['den:{}'.format(den_id), 'post:{}'.format(post_id)], private=True)
+def den_post(den_id, post_id):
+    db = get_db()
+    post = db.execute('''
+        SELECT posts.id,
+            posts.den_id,
+            dens.name AS den_name,
+            posts.title,
+            posts.body,
+            posts.created,
+            users.username,
+            posts.like_count AS likes,
+            posts.comment_count AS comments
+        FROM posts
+            JOIN users ON users.id = posts.author_id
+            JOIN dens ON dens.id = posts.den_id
+        WHERE posts.id = ?
+            AND posts.den_id = ?;
+    ''', (post_id, den_id)).fetchone()
+    if post is None:
+        abort(404, "Post id {} doesn't exist.".format(post_id))
+
+    limit, offset, finish = page_query(COMMENT_FIELDS)
+    rows = db.execute('''
+        SELECT comments.id,
+            comments.parent_id,
+            comments.body,
+            comments.created,
+            users.username,
+            comments.reply_count
+        FROM comments
+            JOIN users ON users.id = comments.author_id
+        WHERE comments.post_id = ?
+        ORDER BY comments.created DESC, comments.id DESC
+        LIMIT ? OFFSET ?;
+    ''', (post_id, limit, offset)).fetchall()
+    comments, next_url = finish(rows)
+    return {'post': dict(post), 'comments': comments, 'next': next_url}
+
+
+# A profile depends on the user's own posts and their likes ('user:<id>'), and on the names of the
+# dens they posted in ('dens'). Users are looked up by name, so an unknown name depends on 'users'.
+def user_keys(username):
+    user = get_db().execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+    if user is None:
+        return ['users']
+    return ['user:{}'.format(user['id']), 'dens']
+
+
+# Mirrors a user's profile page: the user and their posts, most liked first.
+@bp.route('/users/<username>')
+@conditional(user_keys)
+def user_page(username):
+    db = get_db()
+    user = db.execute('''
+        SELECT id,
+            username,
+            firstname,
+            lastname,
+            email,
+            major,
+            created
+        FROM users
+        WHERE username = ?;
+    ''', (username,)).fetchone()
+    if user is None:
+        abort(404, "User {} doesn't exist.".format(username))
+
+    limit, offset, finish = page_query(USER_POST_FIELDS)
+    rows = db.execute('''
+        SELECT posts.id,
+            posts.den_id,
+            dens.name AS den_name,
+            posts.title,
+            posts.created,
+            posts.like_count AS likes
+        FROM posts
+            JOIN dens ON dens.id = posts.den_id
+        WHERE posts.author_id = ?
+        ORDER BY posts.like_count DESC, posts.id
+        LIMIT ? OFFSET ?;
+    ''', (user['id'], limit, offset)).fetchall()
+    posts, next_url = finish(rows)
+    return {'user': dict(user), 'posts': posts, 'next': next_url}
@@ -0,0 +1,209 @@
+#
+#   asgi.py
+#       Serves Bobchat on an ASGI server, like uvicorn, where one process can keep thousands
+#       of slow or idle connections open without a thread for each.
+#
+#       uvicorn --factory bobchat.asgi:create_asgi_app
+#
+
+# Flask is a WSGI framework: a view runs on a thread from start to finish, and that thread is
+# busy the whole time, even while it's only waiting on a slow client or an idle event stream.
+# Behind an ASGI server, the event loop does all the waiting instead:
+#   • the request body is read by the loop before any thread is involved, so slow uploads
+#     and slow connections don't hold one,
+#   • every view still runs as normal Flask code, on a pool of ASGI_THREADS threads, and only for
+#     as long as it takes to build the response,
+#   • /events/ streams (see events.py), which stay open for as long as the page does, are served
+#     by the loop itself: waiting for the next event takes no thread at all. The one database
+#     lookup each stream needs goes through asyncdb.py, so it doesn't block the loop either.
+#
+# The views themselves stay synchronous. Flask runs an `async def` view by starting an event loop
+# on the request's thread and blocking it until the view is done, so it wouldn't free anything.
+# Needs an ASGI server: pip install -e .[asgi]
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, request
+
+from bobchat import create_app
+from bobchat.asyncdb import get_async_db
+from bobchat.auth import load_logged_in_user
+from bobchat.events import HEADERS, HEARTBEAT, RETRY, format_event, get_broadcaster, requested_channels
+
+
+# Runs one request through a WSGI app, on the given pool of threads. asgiref's WsgiToAsgi
+# runs every request on a single shared thread, one at a time, so this is our own.
+class WsgiAdapter:
+    def __init__(self, wsgi_application, executor):
+        self.wsgi_application = wsgi_application
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        body = await read_body(receive)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.run, build_environ(scope, body), send, loop)
+
+    # Runs on one of the pool's threads, and hands each message to the loop to send, waiting
+    # for it to go, so a streamed page is sent as it's rendered.
+    def run(self, environ, send, loop):
+        response = {}
+
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+
+        # Like a WSGI server, only sends the status and headers along with the first of the body,
+        # so the app can still change them until then.
+        def send_body(chunk, more_body):
+            if not response.get('sent'):
+                response['sent'] = True
+                send_message({
+                    'type': 'http.response.start',
+                    'status': response['status'],
+                    'headers': response['headers'],
+                })
+            send_message({'type': 'http.response.body', 'body': chunk, 'more_body': more_body})
+
+        body = self.wsgi_application(environ, start_response)
+        try:
+            for chunk in body:
+                if chunk:
+                    send_body(chunk, True)
+            send_body(b'', False)
+        finally:
+            # Flask only finishes a streamed page's request here (see streaming.py).
+            if hasattr(body, 'close'):
+                body.close()
+
+
+async def read_body(receive):
+    body = io.BytesIO()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body.write(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return body.getvalue()
+
+
+# The WSGI environ for an ASGI request (see PEP 3333).
+def build_environ(scope, body):
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI wants the path as its UTF-8 bytes, each read as a latin-1 character.
+        'SCRIPT_NAME': root_path.encode('utf8').decode('latin1'),
+        'PATH_INFO': path.encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+class BobchatASGI:
+    def __init__(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=app.config['ASGI_THREADS'], thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'].rstrip('/') == scope.get('root_path', '') + '/events':
+            await self.stream(scope, receive, send)
+        else:
+            await WsgiAdapter(self.app, self.executor)(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                get_async_db(self.app).close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # Works out who's asking for which channels, with the app's own session and user lookup.
+    # Runs on an asyncdb thread, since it may need to query the database.
+    def subscriber(self, environ):
+        with self.app.request_context(environ):
+            load_logged_in_user()
+            return g.user, requested_channels(request.args), get_broadcaster()
+
+    # An /events/ stream, the same as events.stream(), but waiting on the event loop.
+    async def stream(self, scope, receive, send):
+        environ = build_environ(scope, b'')
+        user, channels, broadcaster = await get_async_db(self.app).run(self.subscriber, environ)
+        if user is None or not channels:
+            # Let the Flask view send the usual redirect to the login page, or 400.
+            await WsgiAdapter(self.app, self.executor)(scope, receive, send)
+            return
+
+        subscription = broadcaster.subscribe(channels, loop=asyncio.get_running_loop())
+        heartbeat = self.app.config['EVENTS_HEARTBEAT']
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'text/event-stream; charset=utf-8')] + [
+                    (name.lower().encode('latin1'), value.encode('latin1')) for name, value in HEADERS.items()],
+            })
+            await send_text(send, RETRY)
+            while True:
+                event = asyncio.ensure_future(subscription.get(heartbeat))
+                await asyncio.wait({event, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    event.cancel()
+                    return
+                event = event.result()
+                await send_text(send, HEARTBEAT if event is None else format_event(event))
+        finally:
+            disconnected.cancel()
+            subscription.close()
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_text(send, text):
+    await send({'type': 'http.response.body', 'body': text.encode('utf8'), 'more_body': True})
+
+
+def create_asgi_app(test_config=None):
+    return BobchatASGI(create_app(test_config))
@@ -0,0 +1,176 @@
+#
+#   assets.py
+#       Serves the files in bobchat/static under names that change whenever their contents do,
+#       so browsers can keep them for a year without ever asking whether they've changed.
+#
+
+# Without this, every page view makes the browser revalidate style.css, the scripts and the
+# icons, and each of those requests goes through Python. Instead, when the app starts:
+#   • every static file is hashed, and url_for('static', filename='style.css') gives
+#     /static/style.3f2a9c01be.css. Templates don't change; they keep asking for style.css,
+#   • text files (CSS, JS, the manifest, the .ico) are compressed ahead of time with gzip, and
+#     with brotli if it's installed, into ASSETS_DIR. Each variant is only written once, since
+#     its name includes the hash,
+#   • a fingerprinted URL is served with Cache-Control: immutable and a max-age of a year, so
+#     repeat visits don't request it at all. When the file changes, so does its URL.
+# The smallest variant the browser accepts is sent with send_file(), from a path on disk, so the
+# server can hand it to the kernel with sendfile() (gunicorn does), or to a front-end server
+# with X-Sendfile if USE_X_SENDFILE is set.
+#
+# The hashes are taken once, at startup, so turn ASSETS_FINGERPRINT off while editing static files
+# with `flask run`. `flask build-assets` builds the compressed variants ahead of a deploy.
+# Brotli is optional: pip install -e .[brotli]
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+import click
+from flask import current_app, request, send_file
+from flask.cli import with_appcontext
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Python's mimetypes doesn't know this one.
+mimetypes.add_type('application/manifest+json', '.webmanifest')
+
+# How long a browser may keep a fingerprinted file: a year, the longest it'll keep anything.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Files that are worth compressing. Images like PNGs are compressed already.
+COMPRESSIBLE = {'.css', '.js', '.json', '.webmanifest', '.svg', '.ico', '.txt'}
+
+# How a fingerprinted name looks: style.3f2a9c01be.css.
+FINGERPRINTED = re.compile(r'^(?P<stem>.+)\.(?P<digest>[0-9a-f]{10})(?P<suffix>\.[^./]+)$')
+
+
+def fingerprinted_name(filename, digest):
+    stem, suffix = os.path.splitext(filename)
+    return '{}.{}{}'.format(stem, digest[:10], suffix)
+
+
+# Writes data to path, unless it's already there. Several workers can start at once, so the file
+# is written under a name of its own and moved into place, and nobody reads it half written.
+def write_once(path, data):
+    if os.path.exists(path):
+        return
+    partial = '{}.{}.tmp'.format(path, os.getpid())
+    with open(partial, 'wb') as f:
+        f.write(data)
+    os.replace(partial, path)
+
+
+class Assets:
+    def __init__(self, static_folder, build_dir):
+        self.static_folder = static_folder
+        self.build_dir = build_dir
+        # style.css -> style.3f2a9c01be.css
+        self.names = {}
+        # style.3f2a9c01be.css -> (style.css, {'br': path, 'gzip': path, 'identity': path})
+        self.files = {}
+
+    # Hashes every static file, and writes whichever compressed variants aren't there yet.
+    def build(self):
+        os.makedirs(self.build_dir, exist_ok=True)
+        for directory, _, file_names in os.walk(self.static_folder):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                filename = os.path.relpath(path, self.static_folder).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    data = f.read()
+                name = fingerprinted_name(filename, hashlib.sha256(data).hexdigest())
+                variants = {'identity': path}
+                if os.path.splitext(filename)[1] in COMPRESSIBLE:
+                    variants.update(self.compress(name, data))
+                self.names[filename] = name
+                self.files[name] = (filename, variants)
+
+    # Returns the paths of the compressed variants of a file that came out smaller than it.
+    def compress(self, name, data):
+        compressors = {'gzip': ('.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))}
+        if brotli is not None:
+            compressors['br'] = ('.br', lambda data: brotli.compress(data, quality=11))
+        variants = {}
+        for encoding, (extension, compress) in compressors.items():
+            path = os.path.join(self.build_dir, name.replace('/', '_') + extension)
+            if not os.path.exists(path):
+                compressed = compress(data)
+                if len(compressed) >= len(data):
+                    continue
+                write_once(path, compressed)
+            variants[encoding] = path
+        return variants
+
+
+def get_assets():
+    return current_app.extensions['bobchat.assets']
+
+
+def build_assets(app):
+    assets = Assets(app.static_folder, app.config['ASSETS_DIR'])
+    assets.build()
+    app.extensions['bobchat.assets'] = assets
+    return assets
+
+
+# Called by url_for() for every URL it builds. For the static endpoint, it swaps the file name
+# for its fingerprinted one.
+def fingerprint_url(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = get_assets().names.get(values['filename'], values['filename'])
+
+
+# Replaces Flask's own static view.
+def serve_static(filename):
+    assets = get_assets()
+    asset = assets.files.get(filename)
+    if asset is None:
+        # A page from before a deploy can still ask for a file by its old fingerprint. Send the
+        # file as it is now, but don't let it be cached under that name.
+        match = FINGERPRINTED.match(filename)
+        if match is not None and match['stem'] + match['suffix'] in assets.names:
+            filename = match['stem'] + match['suffix']
+        return current_app.send_static_file(filename)
+
+    original, variants = asset
+    encoding = request.accept_encodings.best_match(
+        [encoding for encoding in ('br', 'gzip') if encoding in variants], default='identity')
+    response = send_file(
+        variants[encoding],
+        mimetype=mimetypes.guess_type(original)[0] or 'application/octet-stream',
+        download_name=os.path.basename(filename),
+        conditional=True,
+        max_age=IMMUTABLE_MAX_AGE,
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    if len(variants) > 1:
+        response.vary.add('Accept-Encoding')
+        if encoding != 'identity':
+            response.content_encoding = encoding
+    return response
+
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets_command():
+    """Fingerprint and compress the static files."""
+    assets = build_assets(current_app)
+    for filename, name in sorted(assets.names.items()):
+        original, variants = assets.files[name]
+        click.echo('{:<40} {}'.format(name, ', '.join(
+            '{} {} B'.format(encoding, os.path.getsize(path)) for encoding, path in sorted(variants.items()))))
+
+
+def init_app(app):
+    app.cli.add_command(build_assets_command)
+    if not app.config['ASSETS_FINGERPRINT']:
+        return
+    build_assets(app)
+    app.url_defaults(fingerprint_url)
+    app.view_functions['static'] = serve_static
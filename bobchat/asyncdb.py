@@ -0,0 +1,51 @@
+#
+#   asyncdb.py
+#       Lets code running on an asyncio event loop (see asgi.py) use the database without
+#       blocking the loop, by running each query on a small pool of threads.
+#
+
+# sqlite3 has no asynchronous API: every call blocks until SQLite is done, and the same goes for the
+# PostgreSQL driver (see postgres.py). On an event loop,
+# that would stop every other request the loop is serving. So queries are handed to a pool of
+# ASGI_DB_THREADS threads and awaited. Each of those threads keeps its own connection open, the
+# same way every worker thread does (see db.connect()), so the pool is also a set of connections
+# that are opened once and reused.
+#
+# Code for the loop is written as a normal function that uses get_db(), and run with
+# `await get_async_db(app).run(function, *args)`. It runs in an app context, which rolls back
+# anything left uncommitted when it ends, just like a request.
+#
+# Only the /events/ streams in asgi.py run on the loop, and they only use this to look up who's
+# subscribing. The views are synchronous, and use get_db() on their own thread (see asgi.py for why).
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDatabase:
+    def __init__(self, app, threads):
+        self.app = app
+        self.pid = os.getpid()
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asyncdb')
+
+    # Runs function(*args) on one of the pool's threads, and returns what it returned.
+    async def run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._call, function, args)
+
+    def _call(self, function, args):
+        with self.app.app_context():
+            return function(*args)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+# Returns the app's pool. A worker forked from a process that had one starts its own,
+# since the parent's threads don't exist in the child.
+def get_async_db(app):
+    database = app.extensions.get('bobchat.asyncdb')
+    if database is None or database.pid != os.getpid():
+        database = app.extensions['bobchat.asyncdb'] = AsyncDatabase(app, app.config['ASGI_DB_THREADS'])
+    return database
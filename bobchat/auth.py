@@ -16,10 +16,11 @@
 
 import functools
 
-from flask import ( Blueprint, flash, g, redirect, render_template, request, session, url_for )
-from werkzeug.security import check_password_hash, generate_password_hash
+from flask import ( Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for )
 
+from bobchat.cache import MISSING, LRUCache
 from bobchat.db import get_db
+from bobchat.passwords import HashingBusy, check_password, hash_password, needs_rehash
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
@@ -55,27 +56,32 @@ def register():
             error = 'Username is required.'
         elif not password:
             error = 'Password is required.'
+        # Checked before the password is hashed, so registering a taken username doesn't take up
+        # one of the few hashing threads (see passwords.py) that logins are waiting on.
+        elif db.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone() is not None:
+            error = f"User {username} is already registered."
 
         # If validation succeeds, insert the new user data into the database.
         if error is None:
-            try:
-                # db.execute takes a SQL query with ? placeholders for any user input,
-                # and a tuple of values to replace the placeholders with. The database
-                # library will take care of escaping the values so you are not vulnerable
-                # to a SQL injection attack.
-                db.execute(
-                    "INSERT INTO users (username, password, firstname, lastname, email, major) VALUES (?, ?, ?, ?, ?, ?)",
-                    (username, generate_password_hash(password),
-                     firstname, lastname, email, major),
-                )
-                # For security, passwords should never be stored in the database directly.
-                # Instead, generate_password_hash() is used to securely hash the password,
-                # and that hash is stored. Since this query modifies data, db.commit()
-                # needs to be called afterwards to save the changes.
-                db.commit()
-            except db.IntegrityError:
-                # An sqlite3.IntegrityError will occur if the username already exists,
-                # which should be shown to the user as another validation error.
+            # db.execute takes a SQL query with ? placeholders for any user input,
+            # and a tuple of values to replace the placeholders with. The database
+            # library will take care of escaping the values so you are not vulnerable
+            # to a SQL injection attack.
+            # If the username was taken since we checked, ON CONFLICT skips the insert, rather than
+            # failing. (On PostgreSQL, a failed statement would spoil the rest of the transaction.)
+            inserted = db.execute(
+                "INSERT INTO users (username, password, firstname, lastname, email, major) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (username) DO NOTHING",
+                (username, hash_password(password),
+                 firstname, lastname, email, major),
+            ).rowcount
+            # For security, passwords should never be stored in the database directly.
+            # Instead, hash_password() is used to securely hash the password (see passwords.py),
+            # and that hash is stored. Since this query modifies data, db.commit()
+            # needs to be called afterwards to save the changes.
+            db.commit()
+            if not inserted:
+                # The username already exists, which should be shown to the user as another validation error.
                 error = f"User {username} is already registered."
             else:
                 # After storing the user, they are redirected to the login page.
@@ -111,12 +117,21 @@ def login():
             'SELECT * FROM users WHERE username = ?', (username,)
         ).fetchone()
 
-        # check_password_hash() hashes the submitted password in the same way as the stored hash
+        # check_password() hashes the submitted password in the same way as the stored hash
         # and securely compares them. If they match, the password is valid.
         if user is None:
             error = 'Incorrect username.'
-        elif not check_password_hash(user['password'], password):
+        elif not check_password(user['password'], password):
             error = 'Incorrect password.'
+        elif needs_rehash(user['password'], current_app.config):
+            # This is the only time we have the password itself, so it's when a hash made with
+            # older, weaker settings can be replaced with one made with the current ones.
+            try:
+                db.execute('UPDATE users SET password = ? WHERE id = ?', (hash_password(password), user['id']))
+                db.commit()
+            except HashingBusy:
+                # They can still log in. The hash gets upgraded next time.
+                pass
 
         # 'session' is a dict that stores data across requests.
         # When validation succeeds, the user’s id is stored in a new session.
@@ -126,6 +141,9 @@ def login():
             session.clear()
             session['user_id'] = user['id']
 
+            # We already have the user's row, so start them off with a fresh cache entry.
+            get_user_cache().set(user['id'], {'id': user['id'], 'username': user['username']})
+
             # Now that the user’s id is stored in the session, it will be available on subsequent requests.
             return redirect(url_for('index'))
 
@@ -140,15 +158,53 @@ def load_logged_in_user():
     # load_logged_in_user checks if a user id is stored in the session
     # and gets that user’s data from the database, storing it on g.user,
     # which lasts for the length of the request.
+    # Static files look the same to everyone, so they skip this. Reading the session would also
+    # make Flask add Vary: Cookie, and stop shared caches from keeping them (see assets.py).
+    if request.endpoint == 'static':
+        g.user = None
+        return
     user_id = session.get('user_id')
 
     # If there is no user id, or if the id doesn’t exist, g.user will be None.
     if user_id is None:
         g.user = None
     else:
-        g.user = get_db().execute(
-            'SELECT * FROM users WHERE id = ?', (user_id,)
-        ).fetchone()
+        # Since this runs before every single request, the user is kept in a cache
+        # for a little while (USER_CACHE_TTL seconds) instead of being queried every time.
+        cache = get_user_cache()
+        user = cache.get(user_id)
+        if user is MISSING:
+            user = fetch_user(user_id)
+            cache.set(user_id, user)
+        g.user = user
+
+
+# The only columns views and templates read from g.user. Keeping the projection this narrow
+# means the password hash, email and so on never leave the database on a normal request.
+USER_COLUMNS = 'id, username'
+
+
+# Returns the columns of g.user for a user by id, as a dict, or None if they don't exist.
+def fetch_user(user_id):
+    user = get_db().execute(
+        'SELECT {} FROM users WHERE id = ?'.format(USER_COLUMNS), (user_id,)
+    ).fetchone()
+    if user is None:
+        return None
+    return dict(user)
+
+
+# Returns this app's cache of logged in users, keyed by user id.
+# Entries only go away when USER_CACHE_TTL runs out (or to make room). Nothing on the site changes
+# a user's USER_COLUMNS once they've registered, so nothing needs to remove one sooner. A view that
+# starts to, like renaming a user, must pop them from this cache on every worker, or they'll see
+# the old name for up to USER_CACHE_TTL seconds.
+def get_user_cache():
+    cache = current_app.extensions.get('bobchat.users')
+    if cache is None:
+        cache = current_app.extensions['bobchat.users'] = LRUCache(
+            current_app.config['USER_CACHE_SIZE'], current_app.config['USER_CACHE_TTL'])
+    return cache
 
 
 # To log out, we need to remove the user id from the session.
@@ -0,0 +1,773 @@
+#
+#   bench.py
+#       Benchmarks for Bobchat, available as subcommands of `flask bench`.
+#       Each one prints a human readable summary, or JSON with --json so that
+#       results can be saved and compared between commits.
+#
+
+import http.cookiejar
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from bobchat.counters import check_counters
+from bobchat.db import close_db, get_db, get_driver
+from bobchat.events import Broadcaster
+from bobchat.likes import get_like_buffer, toggle_like
+from bobchat.synthetic import BENCH_PASSWORD, WORDS, default_database, generate_command, sentence, zipf_weights
+
+bench_cli = AppGroup('bench', help='Run Bobchat benchmarks.')
+
+# Run in a fresh interpreter by `flask bench imports`. It imports the given module, builds
+# the app if it's bobchat, and prints how long that took and the process's peak memory.
+IMPORT_PROBE = '''
+import resource, sys, time
+start = time.perf_counter()
+module = __import__(sys.argv[1])
+if sys.argv[1] == 'bobchat':
+    module.create_app()
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+# Imports each module in a brand new Python process, like a gunicorn worker or a `flask`
+# command starting up, and returns the time taken (seconds) and peak RSS (KiB) of each run.
+def measure_import(module, runs):
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_PROBE, module],
+            check=True, capture_output=True, text=True,
+        ).stdout.split()
+        results.append((float(output[0]), int(output[1])))
+    return results
+
+
+@bench_cli.command('imports')
+@click.argument('modules', nargs=-1)
+@click.option('--runs', default=10, show_default=True, help='Fresh interpreters to start per module.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the results as JSON.')
+def imports_command(modules, runs, as_json):
+    """Measure cold start time and memory of importing MODULES.
+
+    Defaults to importing bobchat and building the app, which is what every
+    worker and CLI call pays for. Pass other modules (e.g. pandas) to compare.
+    """
+    report = {}
+    for module in modules or ('bobchat',):
+        results = measure_import(module, runs)
+        report[module] = {
+            'runs': runs,
+            'median_seconds': statistics.median(seconds for seconds, rss in results),
+            'max_rss_kib': max(rss for seconds, rss in results),
+        }
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+    for module, result in report.items():
+        click.echo('{}: {:.1f} ms median over {} runs, {:.1f} MiB peak RSS'.format(
+            module, result['median_seconds'] * 1000, result['runs'], result['max_rss_kib'] / 1024))
+
+
+# The pages `flask bench startup` asks for. They're the ones anyone can see, so no one has to log in.
+STARTUP_PATHS = ['/', '/auth/login', '/auth/register', '/dens/', '/users/']
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+# How much of a process's memory is its own, in KiB, rather than still shared with the process it
+# was forked from. Only Linux reports this; elsewhere it's None.
+def private_memory(pid):
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid), encoding='utf8') as file:
+            return sum(int(line.split()[1]) for line in file if line.startswith(('Private_Clean:', 'Private_Dirty:')))
+    except (OSError, ValueError):
+        return None
+
+
+# Starts gunicorn with the given arguments and sends it `requests` requests from `clients` threads as
+# soon as it's listening. gunicorn's access log says which worker served each one, and how long it
+# took. Returns how long gunicorn took to start listening, and for each worker, its requests as
+# (server seconds, seconds from launch until the response arrived), how many failed, and its
+# private memory.
+def run_startup(arguments, workers, requests, clients):
+    port = free_port()
+    scratch = tempfile.mkdtemp()
+    log = os.path.join(scratch, 'access.log')
+    command = [sys.executable, '-m', 'gunicorn', '--bind', '127.0.0.1:{}'.format(port), '--workers', str(workers),
+               '--access-logfile', log, '--access-logformat', '%(p)s %(q)s %(s)s %(D)s'] + arguments
+    launched = time.perf_counter()
+    server = subprocess.Popen(command, cwd=os.path.dirname(current_app.root_path),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if server.poll() is not None:
+                raise click.ClickException('gunicorn exited with status {}: {}'.format(server.returncode, ' '.join(command)))
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.01)
+        listening = time.perf_counter() - launched
+
+        arrived = {}
+        numbers = itertools.count()
+        lock = threading.Lock()
+
+        def client():
+            while True:
+                with lock:
+                    number = next(numbers)
+                if number >= requests:
+                    return
+                url = 'http://127.0.0.1:{}{}?startup={}'.format(port, STARTUP_PATHS[number % len(STARTUP_PATHS)], number)
+                try:
+                    with urllib.request.urlopen(url) as response:
+                        response.read()
+                except urllib.error.HTTPError as error:
+                    # Errors are counted from the access log.
+                    error.read()
+                arrived[number] = time.perf_counter() - launched
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        served = {}
+        with open(log, encoding='utf8') as file:
+            for line in file:
+                pid, query, status, micros = line.split()
+                number = int(query.split('=')[1])
+                served.setdefault(int(pid.strip('<>')), []).append((number, int(micros) / 1e6, int(status)))
+        results = {}
+        for pid, entries in served.items():
+            results[pid] = {
+                'requests': [(seconds, arrived[number]) for number, seconds, status in sorted(entries)],
+                'errors': sum(1 for number, seconds, status in entries if status >= 400),
+                'private_kib': private_memory(pid),
+            }
+        return listening, results
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+@bench_cli.command('startup')
+@click.option('--workers', default=4, show_default=True, help='gunicorn workers to start.')
+@click.option('--threads', default=8, show_default=True, help='Threads per worker.')
+@click.option('--requests', default=200, show_default=True, help='Requests to send once gunicorn is listening.')
+@click.option('--clients', default=8, show_default=True, help='Requests to have in flight at once.')
+@click.option('--fast', default=2.0, show_default=True,
+              help='A request counts as fast once it takes at most this many times the steady median.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the results as JSON.')
+@with_appcontext
+def startup_command(workers, threads, requests, clients, fast, as_json):
+    """Measure how soon newly started gunicorn workers serve fast requests.
+
+    Starts gunicorn twice on the configured database: once building the app
+    in every worker, and once with gunicorn.conf.py, which builds and warms
+    it in the master before forking (see boot.py). For each worker, reports
+    how long its first request took, and how long after launch it served a
+    request within FAST times the steady median, along with the memory it
+    doesn't share with the master.
+    """
+    config_file = os.path.join(os.path.dirname(current_app.root_path), 'gunicorn.conf.py')
+    if not os.path.exists(config_file):
+        raise click.ClickException('{} does not exist.'.format(config_file))
+    scratch = tempfile.mkdtemp()
+    # gunicorn reads ./gunicorn.conf.py by itself, so the cold run points it at an empty file.
+    empty_config = os.path.join(scratch, 'empty.conf.py')
+    open(empty_config, 'w').close()
+    modes = {
+        'cold': ['--config', empty_config, '--worker-class', 'gthread', '--threads', str(threads), 'bobchat:create_app()'],
+        'preload': ['--config', config_file, '--threads', str(threads)],
+    }
+
+    report = {}
+    try:
+        for mode, arguments in modes.items():
+            listening, results = run_startup(arguments, workers, requests, clients)
+            times = [seconds for result in results.values() for seconds, arrived in result['requests']]
+            steady = statistics.median(times[len(times) // 2:])
+            report[mode] = {
+                'listening_seconds': listening,
+                'steady_ms': steady * 1000,
+                'workers': {},
+            }
+            for pid, result in results.items():
+                first_fast = next((arrived for seconds, arrived in result['requests'] if seconds <= steady * fast), None)
+                report[mode]['workers'][pid] = {
+                    'requests': len(result['requests']),
+                    'errors': result['errors'],
+                    'first_request_ms': result['requests'][0][0] * 1000,
+                    'first_fast_seconds': first_fast,
+                    'private_mib': None if result['private_kib'] is None else result['private_kib'] / 1024,
+                }
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+    for mode, result in report.items():
+        click.echo('{}: listening after {:.2f} s, steady median {:.1f} ms'.format(
+            mode, result['listening_seconds'], result['steady_ms']))
+        click.echo('  {:>8} {:>9} {:>7} {:>17} {:>19} {:>12}'.format(
+            'pid', 'requests', 'errors', 'first request ms', 'first fast after s', 'private MiB'))
+        for pid, worker in sorted(result['workers'].items()):
+            click.echo('  {:>8} {:>9} {:>7} {:>17.1f} {:>19} {:>12}'.format(
+                pid, worker['requests'], worker['errors'], worker['first_request_ms'],
+                '-' if worker['first_fast_seconds'] is None else '{:.3f}'.format(worker['first_fast_seconds']),
+                '-' if worker['private_mib'] is None else '{:.1f}'.format(worker['private_mib'])))
+
+
+# Runs in a separate process, standing in for another gunicorn worker: publishes events to
+# every worker listening in socket_dir, each stamped with the time it was sent.
+def publish_events(socket_dir, channel, events, interval):
+    broadcaster = Broadcaster(socket_dir)
+    for sequence in range(events):
+        broadcaster.publish([channel], {'type': 'post', 'sequence': sequence, 'sent': time.time()})
+        time.sleep(interval)
+    broadcaster.publish([channel], {'type': 'stop'})
+
+
+# Waits like the stream view does, recording how long each event took to arrive.
+def idle_subscriber(subscription, heartbeat, latencies, lock):
+    while True:
+        event = subscription.get(heartbeat)
+        if event is None:
+            continue
+        if event['type'] == 'stop':
+            break
+        with lock:
+            latencies.append(time.time() - event['sent'])
+    subscription.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+@bench_cli.command('subscribers')
+@click.option('--count', default=5000, show_default=True, help='Idle subscribers to hold open.')
+@click.option('--events', default=100, show_default=True, help='Events to publish from another process.')
+@click.option('--interval', default=0.01, show_default=True, help='Seconds between events.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the results as JSON.')
+def subscribers_command(count, events, interval, as_json):
+    """Measure the cost of holding open many idle event streams in one worker.
+
+    Starts COUNT subscribers to one den, each waiting in its own thread like an
+    open /events/ stream on a gthread worker, then publishes events to them from
+    a second process through the same sockets the workers use.
+    """
+    latencies = []
+    lock = threading.Lock()
+    with tempfile.TemporaryDirectory() as socket_dir:
+        broadcaster = Broadcaster(socket_dir, queue_size=events + 1)
+
+        tracemalloc.start()
+        threads = []
+        for _ in range(count):
+            subscription = broadcaster.subscribe(['den:1'])
+            thread = threading.Thread(target=idle_subscriber, args=(subscription, 15, latencies, lock))
+            thread.start()
+            threads.append(thread)
+        heap = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        publisher = multiprocessing.get_context('fork').Process(
+            target=publish_events, args=(socket_dir, 'den:1', events, interval))
+        publisher.start()
+        publisher.join()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    report = {
+        'subscribers': count,
+        'events': events,
+        'deliveries': len(latencies),
+        'expected_deliveries': count * events,
+        'heap_bytes_per_subscriber': heap / count,
+        'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'deliveries_per_second': len(latencies) / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.50) * 1000 if latencies else None,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+    click.echo('{} subscribers: {:.0f} bytes of heap each, {:.1f} MiB peak RSS'.format(
+        count, report['heap_bytes_per_subscriber'], report['max_rss_kib'] / 1024))
+    click.echo('{} of {} deliveries, {:.0f}/s'.format(
+        report['deliveries'], report['expected_deliveries'], report['deliveries_per_second']))
+    if latencies:
+        click.echo('latency: {:.1f} ms p50, {:.1f} ms p99'.format(
+            report['latency_p50_ms'], report['latency_p99_ms']))
+
+
+# Runs in each process started by `flask bench likes`, standing in for a gunicorn worker whose
+# users are all liking and unliking the same post. Puts how many toggles it managed on results.
+def like_storm(app, user_ids, post_id, seconds, results):
+    with app.app_context():
+        toggles = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            toggle_like(user_ids[toggles % len(user_ids)], post_id)
+            toggles += 1
+        if app.config['LIKE_BUFFER'] != 'off':
+            get_like_buffer().flush()
+    results.put(toggles)
+
+
+@bench_cli.command('likes')
+@click.option('--mode', 'modes', multiple=True, type=click.Choice(['off', 'memory', 'journal']),
+              help='LIKE_BUFFER settings to compare. Defaults to all of them.')
+@click.option('--workers', default=4, show_default=True, help='Processes liking at the same time.')
+@click.option('--seconds', default=5.0, show_default=True, help='How long each run lasts.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the results as JSON.')
+@with_appcontext
+def likes_command(modes, workers, seconds, as_json):
+    """Measure likes per second on one popular post with each LIKE_BUFFER setting.
+
+    Every worker process toggles likes on the same post for its own share of the
+    users, against a scratch copy of the database.
+    """
+    app = current_app._get_current_object()
+    if get_driver() != 'sqlite':
+        raise click.ClickException('This benchmark copies a SQLite database, so it needs DATABASE_DRIVER = "sqlite".')
+    scratch = tempfile.mkdtemp()
+    database = app.config['DATABASE']
+    copy = os.path.join(scratch, 'likes.sqlite')
+    source = sqlite3.connect(database)
+    destination = sqlite3.connect(copy)
+    source.backup(destination)
+    source.close()
+    destination.close()
+
+    saved = dict((key, app.config[key]) for key in ('DATABASE', 'LIKE_BUFFER', 'LIKE_JOURNAL_DIR'))
+    app.config['DATABASE'] = copy
+    app.config['LIKE_JOURNAL_DIR'] = os.path.join(scratch, 'journal')
+    report = {}
+    try:
+        db = get_db()
+        post_id = db.execute('SELECT MIN(id) FROM posts').fetchone()[0]
+        user_ids = [row[0] for row in db.execute('SELECT id FROM users ORDER BY id')]
+        context = multiprocessing.get_context('fork')
+
+        for mode in modes or ('off', 'memory', 'journal'):
+            app.config['LIKE_BUFFER'] = mode
+            results = context.Queue()
+            processes = [
+                context.Process(target=like_storm,
+                                args=(app, user_ids[worker::workers], post_id, seconds, results))
+                for worker in range(workers)
+            ]
+            start = time.perf_counter()
+            for process in processes:
+                process.start()
+            toggles = sum(results.get() for _ in processes)
+            for process in processes:
+                process.join()
+            elapsed = time.perf_counter() - start
+
+            report[mode] = {
+                'workers': workers,
+                'toggles': toggles,
+                'seconds': elapsed,
+                'likes_per_second': toggles / elapsed,
+                # Should always be 0: the like counts agree with the likes that were written.
+                'wrong_like_counts': check_counters()['posts.like_count'],
+            }
+    finally:
+        app.config.update(saved)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+    for mode, result in report.items():
+        click.echo('{}: {:.0f} likes/s ({} toggles by {} workers in {:.1f} s), {} wrong like counts'.format(
+            mode, result['likes_per_second'], result['toggles'], result['workers'], result['seconds'],
+            result['wrong_like_counts']))
+
+
+# The requests `flask bench routes` sends, with how often each is sent relative to the others,
+# roughly like real traffic: mostly reading feeds, dens and posts. Each entry is
+# (name, endpoint, weight, request), where request(client) returns (method, path, form data).
+# Popular dens, posts and users are picked more often, by the same Zipf rule the data was made with.
+ROUTE_MIX = [
+    ('index.index', 'index.index', 10, lambda c: ('GET', '/', None)),
+    ('dens.index', 'dens.index', 1, lambda c: ('GET', '/dens/', None)),
+    ('dens.index (search)', 'dens.index', 1, lambda c: ('GET', '/dens/?search=' + c.word(), None)),
+    ('dens.den', 'dens.den', 10, lambda c: ('GET', '/dens/{}'.format(c.den()), None)),
+    ('dens.den (search)', 'dens.den', 1,
+     lambda c: ('GET', '/dens/{}?search={}'.format(c.den(), c.word()), None)),
+    ('dens.den_post', 'dens.den_post', 15, lambda c: ('GET', '/dens/{}/{}'.format(*c.post()), None)),
+    ('dens.den_post (like)', 'dens.den_post', 3, lambda c: ('POST', '/dens/{}/{}'.format(*c.post()), {})),
+    ('dens.replies', 'dens.replies', 2,
+     lambda c: ('GET', '/dens/{}/{}/comments/{}/replies'.format(*c.thread()), None)),
+    ('dens.comment', 'dens.comment', 1,
+     lambda c: ('POST', '/dens/{}/{}/comment'.format(*c.post()), {'comment': c.sentence()})),
+    ('dens.follow', 'dens.follow', 0.5,
+     lambda c: ('POST', '/dens/follow', {'den_id': c.den(), 'follow': c.rng.choice(['follow', 'unfollow'])})),
+    ('dens.create', 'dens.create', 0.2, lambda c: ('GET', '/dens/create', None)),
+    ('dens.update', 'dens.update', 0.2, lambda c: ('GET', '/dens/{}/update'.format(c.own_den), None)),
+    ('posts.create', 'posts.create', 0.2, lambda c: ('GET', '/posts/create/{}'.format(c.den()), None)),
+    ('posts.create (submit)', 'posts.create', 1,
+     lambda c: ('POST', '/posts/create/{}'.format(c.den()), {'title': c.sentence(), 'body': c.sentence()})),
+    ('posts.update', 'posts.update', 0.2, lambda c: ('GET', '/posts/update/{}'.format(c.own_post), None)),
+    ('users.index', 'users.index', 0.5, lambda c: ('GET', '/users/', None)),
+    ('users.index (search)', 'users.index', 1, lambda c: ('GET', '/users/?search=' + c.username()[:5], None)),
+    ('users.user_page', 'users.user_page', 3, lambda c: ('GET', '/users/' + c.username(), None)),
+    ('auth.login (form)', 'auth.login', 0.2, lambda c: ('GET', '/auth/login', None)),
+    ('auth.register', 'auth.register', 0.2, lambda c: ('GET', '/auth/register', None)),
+    ('api.index', 'api.index', 1, lambda c: ('GET', '/api/v1/', None)),
+    ('api.feed', 'api.feed', 2, lambda c: ('GET', '/api/v1/feed', None)),
+    ('api.dens', 'api.dens', 0.5, lambda c: ('GET', '/api/v1/dens', None)),
+    ('api.den', 'api.den', 1, lambda c: ('GET', '/api/v1/dens/{}'.format(c.den()), None)),
+    ('api.den_post', 'api.den_post', 2, lambda c: ('GET', '/api/v1/dens/{}/{}'.format(*c.post()), None)),
+    ('api.user_page', 'api.user_page', 1, lambda c: ('GET', '/api/v1/users/' + c.username(), None)),
+    ('metrics', 'metrics', 0.1, lambda c: ('GET', '/metrics', None)),
+]
+
+# How many of the most popular dens, posts, users and threads the benchmark picks from.
+SAMPLE_SIZE = 100000
+
+
+# What the benchmark's requests are about, read from the database once before it starts.
+class Workload:
+    def __init__(self, db):
+        self.dens = [row[0] for row in db.execute(
+            'SELECT id FROM dens ORDER BY follower_count DESC, id LIMIT ?', (SAMPLE_SIZE,))]
+        self.posts = [tuple(row) for row in db.execute(
+            'SELECT den_id, id FROM posts ORDER BY like_count DESC, id LIMIT ?', (SAMPLE_SIZE,))]
+        self.threads = [tuple(row) for row in db.execute('''
+            SELECT posts.den_id, posts.id, comments.id
+            FROM comments
+                JOIN posts ON posts.id = comments.post_id
+            WHERE comments.reply_count > 0
+            ORDER BY comments.reply_count DESC, comments.id
+            LIMIT ?
+        ''', (SAMPLE_SIZE,))]
+        self.usernames = [row[0] for row in db.execute('SELECT username FROM users ORDER BY id LIMIT ?', (SAMPLE_SIZE,))]
+        if not (self.dens and self.posts and self.threads):
+            raise click.ClickException('The database needs dens, posts and replies. Run `flask bench generate` first.')
+        self.den_weights = zipf_weights(len(self.dens))
+        self.post_weights = zipf_weights(len(self.posts))
+        self.thread_weights = zipf_weights(len(self.threads))
+        self.user_weights = zipf_weights(len(self.usernames))
+
+        # Each client logs in as one of the users who has written a den and a post, so it has
+        # something of its own to edit.
+        self.accounts = [tuple(row) for row in db.execute('''
+            SELECT users.username,
+                (SELECT MIN(id) FROM dens WHERE dens.author_id = users.id),
+                (SELECT MIN(id) FROM posts WHERE posts.author_id = users.id)
+            FROM users
+            WHERE EXISTS (SELECT 1 FROM dens WHERE dens.author_id = users.id)
+                AND EXISTS (SELECT 1 FROM posts WHERE posts.author_id = users.id)
+            ORDER BY users.id
+            LIMIT ?
+        ''', (SAMPLE_SIZE,))]
+        if not self.accounts:
+            raise click.ClickException('No user has written both a den and a post to log in as.')
+
+
+# One simulated person using the site, through either the test client or HTTP.
+class BenchClient:
+    def __init__(self, workload, account, transport, seed):
+        self.workload = workload
+        self.account, self.own_den, self.own_post = account
+        self.transport = transport
+        self.rng = random.Random(seed)
+
+    def den(self):
+        return self.rng.choices(self.workload.dens, cum_weights=self.workload.den_weights)[0]
+
+    def post(self):
+        return self.rng.choices(self.workload.posts, cum_weights=self.workload.post_weights)[0]
+
+    def thread(self):
+        return self.rng.choices(self.workload.threads, cum_weights=self.workload.thread_weights)[0]
+
+    def username(self):
+        return self.rng.choices(self.workload.usernames, cum_weights=self.workload.user_weights)[0]
+
+    def word(self):
+        return self.rng.choice(WORDS)
+
+    def sentence(self):
+        return sentence(self.rng, self.rng.randint(3, 12))
+
+    # Logs in, and returns how long it took. Logging in redirects, and shows the form again if it failed.
+    def login(self):
+        start = time.perf_counter()
+        status = self.transport.request('POST', '/auth/login', {'username': self.account, 'password': BENCH_PASSWORD})
+        if status != 302:
+            raise click.ClickException('Could not log in as {}. Was the database made by `flask bench generate`?'.format(
+                self.account))
+        return time.perf_counter() - start
+
+    # Sends requests from ROUTE_MIX until deadline, and adds (name, seconds, status) for each one
+    # that started after warmup to results.
+    def run(self, warmup, deadline, results):
+        names = [name for name, endpoint, weight, request in ROUTE_MIX]
+        requests = dict((name, request) for name, endpoint, weight, request in ROUTE_MIX)
+        weights = list(itertools.accumulate(weight for name, endpoint, weight, request in ROUTE_MIX))
+        while True:
+            start = time.perf_counter()
+            if start >= deadline:
+                return
+            name = self.rng.choices(names, cum_weights=weights)[0]
+            method, path, data = requests[name](self)
+            status = self.transport.request(method, path, data)
+            if start >= warmup:
+                results.append((name, time.perf_counter() - start, status))
+
+
+# Werkzeug's request handler, without a line in the log for every request.
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+# Sends requests through Flask's test client, in this process.
+class TestClientTransport:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data):
+        return self.client.open(path, method=method, data=data).status_code
+
+
+# Sends requests to a server over HTTP, keeping its own cookies. Redirects aren't followed,
+# so each request is timed on its own, the same as with the test client.
+class HttpTransport:
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self.NoRedirect())
+
+    def request(self, method, path, data):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code
+
+
+def summarize(latencies, seconds):
+    return {
+        'requests': len(latencies),
+        'requests_per_second': len(latencies) / seconds,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@bench_cli.command('routes')
+@click.option('--database', type=click.Path(exists=True, dir_okay=False),
+              help='Database made by `flask bench generate`. Defaults to bench.sqlite in the instance folder.')
+@click.option('--clients', default=8, show_default=True, help='Clients sending requests at the same time.')
+@click.option('--seconds', default=30.0, show_default=True, help='How long to send requests for.')
+@click.option('--warmup', default=3.0, show_default=True, help='Seconds at the start that are left out of the results.')
+@click.option('--seed', default=0, show_default=True, help='Seed for choosing requests.')
+@click.option('--server', type=click.Choice(['test-client', 'wsgi']), default='test-client', show_default=True,
+              help="Call the app in this process, or serve it with Werkzeug's threaded server and send HTTP requests.")
+@click.option('--url', help='Send HTTP requests to a server that is already running (e.g. gunicorn) instead. '
+                            'It should be using the same database.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the results as JSON.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Also save the results as JSON to this file.')
+def routes_command(database, clients, seconds, warmup, seed, server, url, as_json, output):
+    """Measure throughput and latency of every route under load.
+
+    CLIENTS simulated users, each logged in as a different user, send a mix
+    of requests to every page of the site (see ROUTE_MIX in bench.py) for
+    SECONDS. Reports requests per second, and p50/p95/p99 latency for each
+    route. Requests that write go to a scratch copy of the database, unless
+    --url is given. With DATABASE_DRIVER = "postgresql" they go to the database
+    at POSTGRES_DSN, so generate a fresh one for each run. Save the --json output of two commits and compare them
+    with `flask bench compare`.
+    """
+    app = current_app._get_current_object()
+    sqlite = get_driver() == 'sqlite'
+    database = database or default_database()
+    if sqlite and not os.path.exists(database):
+        raise click.ClickException('{} does not exist. Run `flask bench generate` first.'.format(database))
+
+    scratch = tempfile.mkdtemp()
+    copy = os.path.join(scratch, 'routes.sqlite')
+    if url is None and sqlite:
+        source = sqlite3.connect(database)
+        destination = sqlite3.connect(copy)
+        source.backup(destination)
+        source.close()
+        destination.close()
+
+    saved = app.config['DATABASE']
+    if sqlite:
+        app.config['DATABASE'] = copy if url is None else database
+    httpd = None
+    try:
+        db = get_db()
+        workload = Workload(db)
+        sizes = dict(db.execute('SELECT users, dens, posts, comments, likes FROM site_stats').fetchone())
+        close_db()
+
+        if url is None and server == 'wsgi':
+            httpd = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            url = 'http://127.0.0.1:{}'.format(httpd.server_port)
+
+        bench_clients = []
+        logins = []
+        for number in range(clients):
+            transport = HttpTransport(url) if url else TestClientTransport(app)
+            client = BenchClient(workload, workload.accounts[number % len(workload.accounts)], transport, seed + number)
+            logins.append(client.login())
+            bench_clients.append(client)
+
+        results = []
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client.run, args=(start + warmup, start + warmup + seconds, results))
+                   for client in bench_clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if not results:
+            raise click.ClickException('No requests finished after the warmup.')
+        # Write the likes still waiting in the buffer to this database, not the real one.
+        if 'bobchat.likes' in app.extensions:
+            app.extensions['bobchat.likes'].flush()
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+        app.config['DATABASE'] = saved
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    routes = {}
+    for name, endpoint, weight, request in ROUTE_MIX:
+        latencies = [elapsed for route, elapsed, status in results if route == name]
+        if not latencies:
+            continue
+        routes[name] = summarize(latencies, seconds)
+        routes[name]['statuses'] = dict(Counter(str(status) for route, elapsed, status in results if route == name))
+
+    exercised = set(endpoint for name, endpoint, weight, request in ROUTE_MIX) | {'auth.login'}
+    report = {
+        'commit': git_commit(),
+        'driver': get_driver(),
+        'database': sizes,
+        'target': url or server,
+        'clients': clients,
+        'seconds': seconds,
+        'seed': seed,
+        'total': summarize([elapsed for route, elapsed, status in results], seconds),
+        'errors': sum(1 for route, elapsed, status in results if status >= 500),
+        # Logging in is slow on purpose (it hashes the password), so it's timed on its own, once per client.
+        'login_p50_ms': percentile(logins, 0.50) * 1000,
+        'routes': routes,
+        # Routes in the app that ROUTE_MIX doesn't send anything to.
+        'not_exercised': sorted(set(rule.endpoint for rule in app.url_map.iter_rules()) - exercised),
+    }
+
+    if output:
+        with open(output, 'w', encoding='utf8') as file:
+            json.dump(report, file, indent=2)
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+    click.echo('{} requests from {} clients in {:.0f} s: {:.0f}/s, {} errors, against {}'.format(
+        report['total']['requests'], clients, seconds, report['total']['requests_per_second'],
+        report['errors'], ', '.join('{} {}'.format(count, table) for table, count in sizes.items())))
+    click.echo('{:<24} {:>8} {:>8} {:>8} {:>8} {:>8}'.format('route', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for name, result in routes.items():
+        click.echo('{:<24} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+            name, result['requests_per_second'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['max_ms']))
+    click.echo('Not exercised: ' + ', '.join(report['not_exercised']))
+
+
+@bench_cli.command('compare')
+@click.argument('before', type=click.File())
+@click.argument('after', type=click.File())
+def compare_command(before, after):
+    """Compare two saved results of `flask bench routes --output`.
+
+    Shows how each route's throughput and latency changed from BEFORE to AFTER.
+    """
+    before, after = json.load(before), json.load(after)
+    click.echo('{} -> {}'.format(before.get('commit'), after.get('commit')))
+    if before['database'] != after['database']:
+        click.echo('Warning: the two runs used different data, so they may not be comparable.')
+
+    def change(old, new):
+        return '{:+.0f}%'.format((new - old) / old * 100) if old else 'n/a'
+
+    click.echo('{:<24} {:>9} {:>9} {:>9}'.format('route', 'req/s', 'p50', 'p99'))
+    for name in ['total'] + sorted(set(before['routes']) & set(after['routes'])):
+        old = before['total'] if name == 'total' else before['routes'][name]
+        new = after['total'] if name == 'total' else after['routes'][name]
+        click.echo('{:<24} {:>9} {:>9} {:>9}'.format(
+            name, change(old['requests_per_second'], new['requests_per_second']),
+            change(old['p50_ms'], new['p50_ms']), change(old['p99_ms'], new['p99_ms'])))
+
+
+bench_cli.add_command(generate_command)
+
+
+def init_app(app):
+    app.cli.add_command(bench_cli)
@@ -0,0 +1,88 @@
+#
+#   boot.py
+#       Gets workers ready to serve before their first request, so a worker that has just started
+#       or been restarted isn't slow for the first people who reach it.
+#
+
+# Left alone, every worker pays for its own cold start on its first requests: Jinja compiles each
+# template the first time it's rendered, the modules views import on demand are imported then, and
+# the database is read from disk. gunicorn.conf.py, at the top of the repository, serves
+# create_warm_app() with preload_app on, so instead:
+#   • the app is built once, in the gunicorn master, and every worker is forked from it with
+#     everything already loaded. The workers share that memory until one of them writes to it,
+#   • every template is compiled while the app is built. Jinja keeps the compiled code in
+#     TEMPLATE_CACHE_DIR, so the next boot loads it instead of compiling again,
+#   • a request is made to each of WARMUP_PATHS, which imports what those views import, runs their
+#     queries once so the database's pages are in the OS's file cache, and fills the page cache
+#     the workers start with,
+#   • the connections those requests opened are closed before forking, since a connection must
+#     never be used by two processes (see db.py). Each worker opens its own, and on PostgreSQL,
+#     warm_worker() fills its pool as soon as it's forked.
+# `flask bench startup` measures how soon new workers serve a fast request, with and without this.
+
+import atexit
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+from bobchat import create_app
+from bobchat.db import close_connections, get_driver
+from bobchat.likes import recover_journals
+
+
+def compile_templates(app):
+    # The README files in the templates folder aren't templates.
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def warm_requests(app):
+    client = app.test_client()
+    for path in app.config['WARMUP_PATHS']:
+        response = client.get(path)
+        response.get_data()
+        response.close()
+
+    # These weren't real requests, so they shouldn't show up in /metrics.
+    registry = app.extensions.pop('bobchat.metrics', None)
+    if registry is not None:
+        atexit.unregister(registry.flush)
+
+
+# Closes the connections this process opened, so that none are carried into a forked worker.
+def close_database(app):
+    close_connections()
+    pool = app.extensions.pop('bobchat.postgres', None)
+    if pool is not None:
+        pool.close()
+
+
+# Builds the app and warms it up. This is the app gunicorn.conf.py serves.
+def create_warm_app(test_config=None):
+    app = create_app(test_config)
+    compile_templates(app)
+    warm_requests(app)
+    close_database(app)
+    return app
+
+
+# Runs in each worker as soon as it's forked. Writes out the like journals of workers that have
+# died since the app was built, which this one is likely replacing (see likes.py). On PostgreSQL,
+# opens the worker's pool and waits for its first POSTGRES_POOL_MIN_SIZE connections. SQLite
+# connections belong to the thread that opens them, so those are opened by each thread as it serves
+# its first request.
+def warm_worker(app):
+    recover_journals(app)
+    with app.app_context():
+        if get_driver() == 'postgresql':
+            from bobchat.postgres import get_pool
+            get_pool().wait()
+
+
+def init_app(app):
+    directory = app.config['TEMPLATE_CACHE_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
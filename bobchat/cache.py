@@ -0,0 +1,89 @@
+#
+#   cache.py
+#       A small in-process cache that the rest of the app uses to avoid repeating
+#       database work on every request.
+#
+
+# Every gunicorn worker is its own process, so each one has its own copy of these caches.
+# That's why entries can have a time to live: a change made through one worker will be seen
+# by the others after at most that long, even if nothing tells them to drop their copy.
+
+import threading
+import time
+from collections import OrderedDict
+
+# Returned by get() when a key isn't cached, since None is a perfectly good value to cache.
+MISSING = object()
+
+
+# A least-recently-used cache with an optional time to live, safe to share between threads.
+# Once it holds maxsize entries, adding another one evicts whichever entry was used longest ago.
+# With maxbytes set, values must be strings, and entries are also evicted once their combined
+# length goes over maxbytes. That's how the page cache caps how much memory it can use.
+class LRUCache:
+    def __init__(self, maxsize, ttl=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns the cached value for key, or default if it isn't cached or has expired.
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.maxbytes is not None:
+                if len(value) > self.maxbytes:
+                    return
+                self.bytes += len(value)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize or (
+                    self.maxbytes is not None and self.bytes > self.maxbytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    # Drops key from the cache, if it's there.
+    def pop(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    # Must be called with the lock held.
+    def _remove(self, key):
+        expires, value = self._entries.pop(key)
+        if self.maxbytes is not None:
+            self.bytes -= len(value)
@@ -0,0 +1,116 @@
+#
+#   compression.py
+#       Compresses responses with gzip as they're sent, for every client that accepts it.
+#
+
+# HTML, JSON and the like shrink to a fraction of their size with gzip, which matters most for
+# the long listing pages. This is WSGI middleware around the whole app, so it covers every view,
+# including error pages and /metrics, and it works piece by piece: each piece of a streamed page
+# (see streaming.py) is compressed and flushed on its own, so the browser can start on the page
+# before the rest of it has been rendered.
+#
+# A response is left alone when:
+#   • the client doesn't accept gzip, or it's a HEAD request,
+#   • it isn't a 200, or it's already encoded, like the precompressed static files (see assets.py),
+#   • it isn't text (images are compressed already), or it's an event stream, where every event
+#     has to go out the moment it happens,
+#   • it's shorter than COMPRESS_MIN_SIZE bytes, where the gzip header would cost more than it saves,
+#   • it says Cache-Control: no-transform.
+# A response that's left alone is passed through untouched, so the server can still send files
+# with sendfile().
+
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_etags, unquote_etag
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/manifest+json',
+    'application/xml',
+    'image/svg+xml',
+}
+
+
+def compressible(status, headers, min_size):
+    if not status.startswith('200'):
+        return False
+    if 'Content-Encoding' in headers or 'no-transform' in headers.get('Cache-Control', ''):
+        return False
+    mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+    if not (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES) or mimetype == 'text/event-stream':
+        return False
+    length = headers.get('Content-Length', type=int)
+    return length is None or length >= min_size
+
+
+# The compressed body is a different set of bytes, so it can't share a strong ETag.
+def weaken_etag(headers):
+    etag = headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        headers['ETag'] = 'W/' + etag
+
+
+# Whether the client's If-None-Match has the response's ETag in its weakened form, meaning the
+# copy it has was gzipped by us.
+def holds_weak_etag(environ, headers):
+    etag = headers.get('ETag')
+    if etag is None:
+        return False
+    return parse_etags(environ.get('HTTP_IF_NONE_MATCH')).is_weak(unquote_etag(etag)[0])
+
+
+class CompressionMiddleware:
+    def __init__(self, wsgi_app, level, min_size):
+        self.wsgi_app = wsgi_app
+        self.level = level
+        self.min_size = min_size
+
+    def __call__(self, environ, start_response):
+        accept_encoding = environ.get('HTTP_ACCEPT_ENCODING', '')
+        if 'gzip' not in accept_encoding.lower() or environ['REQUEST_METHOD'] == 'HEAD':
+            return self.wsgi_app(environ, start_response)
+
+        compressor = None
+
+        def start_compressed_response(status, response_headers, exc_info=None):
+            nonlocal compressor
+            headers = Headers(response_headers)
+            if compressible(status, headers, self.min_size):
+                # wbits=31 means a gzip header and trailer around the deflate stream.
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+                headers.remove('Content-Length')
+                headers['Content-Encoding'] = 'gzip'
+                vary = headers.get('Vary')
+                headers['Vary'] = vary + ', Accept-Encoding' if vary else 'Accept-Encoding'
+                weaken_etag(headers)
+            elif status.startswith('304') and holds_weak_etag(environ, headers):
+                # A 304 stands in for the gzipped response the client already has, so it carries
+                # the same tag that one did.
+                weaken_etag(headers)
+            return start_response(status, headers.to_wsgi_list(), exc_info)
+
+        body = self.wsgi_app(environ, start_compressed_response)
+        # Flask calls start_response before it returns the body, so by now we know.
+        if compressor is None:
+            return body
+        return self.compress(body, compressor)
+
+    def compress(self, body, compressor):
+        try:
+            for piece in body:
+                # Flushing after each piece sends it now, rather than when zlib's buffer fills up.
+                compressed = compressor.compress(piece) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                if compressed:
+                    yield compressed
+            yield compressor.flush()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+
+def init_app(app):
+    if not app.config['COMPRESS_ENABLED']:
+        return
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app, app.config['COMPRESS_LEVEL'], app.config['COMPRESS_MIN_SIZE'])
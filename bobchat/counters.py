@@ -0,0 +1,235 @@
+#
+#   counters.py
+#       Keeps track of the denormalized counters in our schema (such as posts.like_count)
+#       and provides a command to verify them or rebuild them from the source tables.
+#
+
+import click
+from flask.cli import with_appcontext
+
+from bobchat.db import get_db, get_driver
+
+# Each counter is kept up to date by triggers in schema.sql, so under normal operation
+# they never drift. If they do (say, rows were edited by hand with triggers missing),
+# these queries find and fix them.
+#
+# Every entry maps a name to a pair of queries:
+#   • the first returns one row per counter that disagrees with the source table,
+#   • the second recomputes every counter from scratch. Where that takes more than one
+#     statement, it's a tuple of them, run in order.
+COUNTERS = {
+    'posts.like_count': (
+        '''
+        SELECT id
+        FROM posts
+        WHERE like_count != (
+                SELECT COUNT(*)
+                FROM post_like_assoc
+                WHERE post_like_assoc.post_id = posts.id
+            );
+        ''',
+        '''
+        UPDATE posts
+        SET like_count = (
+                SELECT COUNT(*)
+                FROM post_like_assoc
+                WHERE post_like_assoc.post_id = posts.id
+            );
+        ''',
+    ),
+    'posts.comment_count': (
+        '''
+        SELECT id
+        FROM posts
+        WHERE comment_count != (
+                SELECT COUNT(*)
+                FROM comments
+                WHERE comments.post_id = posts.id
+            );
+        ''',
+        '''
+        UPDATE posts
+        SET comment_count = (
+                SELECT COUNT(*)
+                FROM comments
+                WHERE comments.post_id = posts.id
+            );
+        ''',
+    ),
+    'comments.reply_count': (
+        '''
+        SELECT id
+        FROM comments AS parents
+        WHERE reply_count != (
+                SELECT COUNT(*)
+                FROM comments
+                WHERE comments.parent_id = parents.id
+            );
+        ''',
+        '''
+        UPDATE comments
+        SET reply_count = (
+                SELECT COUNT(*)
+                FROM comments AS replies
+                WHERE replies.parent_id = comments.id
+            );
+        ''',
+    ),
+    'dens.follower_count': (
+        '''
+        SELECT id
+        FROM dens
+        WHERE follower_count != (
+                SELECT COUNT(*)
+                FROM user_den_assoc
+                WHERE user_den_assoc.den_id = dens.id
+            );
+        ''',
+        '''
+        UPDATE dens
+        SET follower_count = (
+                SELECT COUNT(*)
+                FROM user_den_assoc
+                WHERE user_den_assoc.den_id = dens.id
+            );
+        ''',
+    ),
+    'dens.post_count': (
+        '''
+        SELECT id
+        FROM dens
+        WHERE post_count != (
+                SELECT COUNT(*)
+                FROM posts
+                WHERE posts.den_id = dens.id
+            );
+        ''',
+        '''
+        UPDATE dens
+        SET post_count = (
+                SELECT COUNT(*)
+                FROM posts
+                WHERE posts.den_id = dens.id
+            );
+        ''',
+    ),
+    # Every (day, den) that has posts must have a row with the right count, and no other rows
+    # should exist. Both are checked against one pass over posts, in each direction.
+    # date() works on PostgreSQL too, as a cast to DATE.
+    'den_activity': (
+        '''
+        SELECT day, den_id
+        FROM (
+                SELECT day, den_id, posts
+                FROM den_activity
+                EXCEPT
+                SELECT date(created), den_id, COUNT(*)
+                FROM posts
+                GROUP BY date(created), den_id
+            ) AS extra
+        UNION ALL
+        SELECT day, den_id
+        FROM (
+                SELECT date(created) AS day, den_id, COUNT(*) AS posts
+                FROM posts
+                GROUP BY date(created), den_id
+                EXCEPT
+                SELECT day, den_id, posts
+                FROM den_activity
+            ) AS missing;
+        ''',
+        (
+            'DELETE FROM den_activity;',
+            '''
+            INSERT INTO den_activity(day, den_id, posts)
+            SELECT date(created), den_id, COUNT(*)
+            FROM posts
+            GROUP BY date(created), den_id;
+            ''',
+        ),
+    ),
+    'site_stats': (
+        '''
+        SELECT 1
+        WHERE NOT EXISTS (
+                SELECT 1
+                FROM site_stats
+                WHERE id = 1
+                    AND users = (SELECT COUNT(*) FROM users)
+                    AND posts = (SELECT COUNT(*) FROM posts)
+                    AND dens = (SELECT COUNT(*) FROM dens)
+                    AND comments = (SELECT COUNT(*) FROM comments)
+                    AND likes = (SELECT COUNT(*) FROM post_like_assoc)
+            );
+        ''',
+        '''
+        INSERT OR REPLACE INTO site_stats(id, users, posts, dens, comments, likes)
+        VALUES (
+                1,
+                (SELECT COUNT(*) FROM users),
+                (SELECT COUNT(*) FROM posts),
+                (SELECT COUNT(*) FROM dens),
+                (SELECT COUNT(*) FROM comments),
+                (SELECT COUNT(*) FROM post_like_assoc)
+            );
+        ''',
+    ),
+}
+
+# On PostgreSQL, site_stats is a view that adds up the rows of site_stats_shards (see
+# schema_postgresql.sql). So it's rebuilt by putting the totals in the first shard instead,
+# and zeroing the others.
+POSTGRESQL_REBUILDS = {
+    'site_stats': '''
+        UPDATE site_stats_shards
+        SET users = CASE WHEN shard = 0 THEN (SELECT COUNT(*) FROM users) ELSE 0 END,
+            posts = CASE WHEN shard = 0 THEN (SELECT COUNT(*) FROM posts) ELSE 0 END,
+            dens = CASE WHEN shard = 0 THEN (SELECT COUNT(*) FROM dens) ELSE 0 END,
+            comments = CASE WHEN shard = 0 THEN (SELECT COUNT(*) FROM comments) ELSE 0 END,
+            likes = CASE WHEN shard = 0 THEN (SELECT COUNT(*) FROM post_like_assoc) ELSE 0 END;
+    ''',
+}
+
+
+# Returns a dict of counter name -> number of rows where the counter is wrong.
+def check_counters():
+    db = get_db()
+    return {
+        name: len(db.execute(check).fetchall())
+        for name, (check, rebuild) in COUNTERS.items()
+    }
+
+
+# Recomputes every counter in a single transaction.
+def rebuild_counters():
+    db = get_db()
+    postgresql = get_driver() == 'postgresql'
+    with db:
+        for name, (check, rebuild) in COUNTERS.items():
+            if postgresql:
+                rebuild = POSTGRESQL_REBUILDS.get(name, rebuild)
+            for statement in (rebuild,) if isinstance(rebuild, str) else rebuild:
+                db.execute(statement)
+
+
+@click.command('rebuild-counters')
+@click.option('--check', is_flag=True,
+              help='Only report counters that are out of date, without changing them.')
+@with_appcontext
+def rebuild_counters_command(check):
+    """Verify or rebuild the denormalized counters."""
+    drift = check_counters()
+    for name, wrong in drift.items():
+        click.echo('{}: {} out of date'.format(name, wrong))
+
+    if check:
+        # A non-zero exit status lets this be used from cron or CI.
+        if any(drift.values()):
+            raise SystemExit(1)
+    else:
+        rebuild_counters()
+        click.echo('Counters rebuilt.')
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_counters_command)
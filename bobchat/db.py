@@ -4,18 +4,24 @@
 #       that are used in the blueprints for our front-end rendering.
 #
 
+import csv
+import functools
+import io
+import os
 import sqlite3
-from sqlite3 import Error
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
-import pandas as pd
-
 from werkzeug.security import generate_password_hash
 
-import time
+from bobchat.metrics import InstrumentedConnection
+from bobchat.passwords import hash_method
+from bobchat.streaming import is_streaming
 
 # g is a special object that is unique for each request.
 # It is used to store data that might be accessed by multiple
@@ -29,29 +35,145 @@ import time
 # our code. get_db will be called when the application has been
 # created and is handling a request, so current_app can be used.
 
+# Opening a SQLite connection isn't free: the file has to be opened, the schema parsed and
+# the page cache starts out cold. So instead of opening a new connection for every request,
+# each worker keeps its connections open and hands the same one to every request it serves.
+#
+# A sqlite3 connection may only be used by the thread that created it, so the connections
+# live in a threading.local, one per thread per database file. They also must never be used
+# in a process other than the one that opened them (e.g. after gunicorn forks its workers),
+# so we remember which process they belong to as well.
+# See: https://www.sqlite.org/howtocorrupt.html#_carrying_an_open_database_connection_across_a_fork_
+_local = threading.local()
+
+# Connections that were inherited from a parent process. Closing them could release locks
+# that the parent still holds, so we keep a reference to them and never touch them again.
+_inherited = []
+
+
+# Opens a new connection to the database and tunes it with the SQLITE_* configuration keys.
+# These settings only last as long as the connection, which is why they're applied here once,
+# rather than at the start of every request.
+def open_db(config):
+    # Establishes a connection to the file pointed at by the DATABASE configuration key.
+    # This file doesn’t have to exist yet, and won’t until you initialize the database later.
+    # cached_statements is how many compiled statements the connection keeps around, so that
+    # running the same query again doesn't have to parse and plan it again.
+    # With METRICS_ENABLED, the connection times every statement it runs (see metrics.py).
+    db = sqlite3.connect(
+        config['DATABASE'],
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        cached_statements=config['SQLITE_CACHED_STATEMENTS'],
+        factory=InstrumentedConnection if config['METRICS_ENABLED'] else sqlite3.Connection,
+    )
+    if config['METRICS_ENABLED']:
+        db.slow_query = config['METRICS_SLOW_QUERY']
+
+    # Tells the connection to return rows that behave like dicts. This allows accessing the columns by name.
+    db.row_factory = sqlite3.Row
+
+    # In WAL mode readers don't block writers and writers don't block readers, so one worker
+    # writing doesn't stall every other worker that's reading.
+    # See: https://www.sqlite.org/wal.html and https://www.sqlite.org/pragma.html
+    db.execute('PRAGMA journal_mode = {}'.format(config['SQLITE_JOURNAL_MODE']))
+    db.execute('PRAGMA synchronous = {}'.format(config['SQLITE_SYNCHRONOUS']))
+    db.execute('PRAGMA cache_size = {:d}'.format(config['SQLITE_CACHE_SIZE']))
+    db.execute('PRAGMA mmap_size = {:d}'.format(config['SQLITE_MMAP_SIZE']))
+    db.execute('PRAGMA busy_timeout = {:d}'.format(config['SQLITE_BUSY_TIMEOUT']))
+    db.execute('PRAGMA foreign_keys = {}'.format('ON' if config['SQLITE_FOREIGN_KEYS'] else 'OFF'))
+    return db
+
+
+# Returns this thread's connection to the configured database, opening it the first time.
+def connect():
+    if getattr(_local, 'pid', None) != os.getpid():
+        _inherited.extend(getattr(_local, 'connections', {}).values())
+        _local.connections = {}
+        _local.pid = os.getpid()
+
+    path = current_app.config['DATABASE']
+    db = _local.connections.get(path)
+    if db is None:
+        db = _local.connections[path] = open_db(current_app.config)
+    return db
+
+
+# Closes every connection the current thread has open.
+def close_connections():
+    if getattr(_local, 'pid', None) == os.getpid():
+        for db in _local.connections.values():
+            db.close()
+    _local.connections = {}
+    _local.pid = os.getpid()
+
+
+# DATABASE_DRIVER picks the database get_db() connects to: 'sqlite' for the file at DATABASE,
+# or 'postgresql' for the server at POSTGRES_DSN, which several web servers can share.
+# The connections behave the same either way (see postgres.py), so the rest of the code
+# doesn't need to know which it has, apart from the odd query that's written for each.
+DRIVERS = ('sqlite', 'postgresql')
+
+# The file in the bobchat package that creates the schema for each driver.
+SCHEMAS = {
+    'sqlite': 'schema.sql',
+    'postgresql': 'schema_postgresql.sql',
+}
+
+
+def get_driver():
+    driver = current_app.config['DATABASE_DRIVER']
+    if driver not in DRIVERS:
+        raise ValueError('DATABASE_DRIVER must be one of {}, not {!r}'.format(', '.join(DRIVERS), driver))
+    return driver
+
 
 # Returns a database connection, which is used to execute the commands read from the file.
 def get_db():
     if 'db' not in g:
-        # Establishes a connection to the file pointed at by the DATABASE configuration key.
-        # This file doesn’t have to exist yet, and won’t until you initialize the database later.
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-
-        # Tells the connection to return rows that behave like dicts. This allows accessing the columns by name.
-        g.db.row_factory = sqlite3.Row
+        if get_driver() == 'postgresql':
+            # Only imported when it's used, so psycopg is only needed to run on PostgreSQL.
+            from bobchat import postgres
+            g.db = postgres.connect()
+        else:
+            g.db = connect()
 
     return g.db
 
 
-# Checks if a connection was created by checking if g.db was set. If the connection exists, it is closed.
+# Checks if a connection was handed out by checking if g.db was set. If it was, the connection is
+# returned to the worker (or the pool) for the next request. Anything the request left uncommitted is
+# rolled back, so one request can never see, or accidentally commit, another request's half-finished changes.
 def close_db(e=None):
+    # A streamed page is still reading from the connection. This runs again once it's sent.
+    if is_streaming():
+        return
     db = g.pop('db', None)
 
-    if db is not None:
-        db.close()
+    if db is None:
+        return
+    if get_driver() == 'postgresql':
+        from bobchat import postgres
+        postgres.release(db)
+    elif db.in_transaction:
+        db.rollback()
+
+
+# Whether the database has a table with this name.
+def table_exists(db, table_name):
+    if get_driver() == 'postgresql':
+        return db.execute('SELECT to_regclass(?) IS NOT NULL', (table_name,)).fetchone()[0]
+    # See: https://www.sqlite.org/schematab.html
+    return db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+    ).fetchone() is not None
+
+
+# Runs the schema for the configured driver, which drops every table and creates them again, empty.
+def create_schema(db):
+    with current_app.open_resource(SCHEMAS[get_driver()]) as f:
+        db.executescript(f.read().decode('utf8'))
+    # SQLite commits as it goes, but PostgreSQL runs the whole script in one transaction.
+    db.commit()
 
 
 # Running the SQL commands in 'schema.sql' to initialize the database.
@@ -60,9 +182,8 @@ def init_db():
     print("Verifying database integrity...\n")
     db = get_db()
 
-    # Testing to see if any tables exist in the schema table
-    # See: https://www.sqlite.org/schematab.html
-    if db.cursor().execute("SELECT name FROM sqlite_master").fetchone() is not None:
+    # Testing to see if the database has already been initialized
+    if table_exists(db, 'users'):
         print("\tWARNING: You already have a database initialized.")
         print("\t         Are you certain you want to overwrite it?\n")
         yn = input("\ty/n: ")
@@ -73,55 +194,178 @@ def init_db():
     # Opens a file relative to the bobchat package,
     # which is useful since we won’t necessarily know
     # where that location is when deploying the application later.
-    with current_app.open_resource('schema.sql') as f:
-        try:
-            db.executescript(f.read().decode('utf8'))
-        except Error as e:
-            print("\tERROR: " + str(e) + "\n")
-            return -1
+    try:
+        create_schema(db)
+    except db.Error as e:
+        db.rollback()
+        print("\tERROR: " + str(e) + "\n")
+        return -1
 
     # Attempt to populate all the tables with default data.
-    # We have to load in the CSVs in a specific order, else foreign key constraints will fail.
-    # See: https://github.com/tsainez/bobchat/issues/5
-    for file_name in ['users.csv', 'dens.csv', 'posts.csv', 'comments.csv', 'post_like_assoc.csv', 'user_den_assoc.csv']:
-        table_name = file_name[:-4]  # Removing '.csv' from the file_name
-        if pd.io.sql.has_table(table_name, db):
-            try:
-                df = pd.read_csv(
-                    'bobchat/csv/{}'.format(file_name), index_col=0)
-                df.to_sql('{}'.format(table_name), db, if_exists='append')
-                print("\tSUCCESS: filled table {}\n".format(table_name))
-            except Error as e:
-                print("\tERROR: " + str(e) + "\n")
-        else:
-            # We are not handling creating the schema here. We do that in schema.sql.
-            print(
-                "\tWARNING: table {} does not exist in the schema.\n".format(table_name))
-
-    # For the users table specifically, we need to salt and hash their passwords
-    # after we've populated the table, for security purposes...
-    if pd.io.sql.has_table('users', db):
-        print("\tSalting and hashing passwords...\n")
-        start_time = time.time()
-        users_df = pd.read_csv(
-            'bobchat/csv/users.csv', index_col=0)
-        i = 1
-        for row in users_df.itertuples():
-            print('\r\t\t', str(i), end='')
-            print(" updated.", end='')
-            try:
-                db.execute(
-                    '''UPDATE users
-                        SET password = ?
-                        WHERE id = ?;''',
-                    (generate_password_hash(row[2]), row[0]),
+    try:
+        load_seed_data(db)
+
+        # The seed data is inserted directly, rather than through the views that would
+        # normally fill in everyone's feed, so build the timelines in one go.
+        from bobchat.timelines import rebuild_timelines
+        rebuild_timelines()
+    except db.Error as e:
+        print("\tERROR: " + str(e) + "\n")
+        return -1
+
+
+# The seed CSVs in bobchat/csv, named after the table they fill.
+# We have to load in the CSVs in a specific order, else foreign key constraints will fail.
+# See: https://github.com/tsainez/bobchat/issues/5
+SEED_TABLES = ['users', 'dens', 'posts', 'comments', 'post_like_assoc', 'user_den_assoc']
+
+# How many CSV rows are read and inserted at a time. Only one batch is held in memory,
+# so loading a CSV takes the same amount of memory no matter how big it is.
+SEED_BATCH_SIZE = 1000
+
+
+# Reads a seed CSV from the bobchat package and yields its rows in lists of up to size rows.
+# The first row of the file holds the column names, which is also returned.
+def read_seed_csv(table_name, size=SEED_BATCH_SIZE):
+    with current_app.open_resource('csv/{}.csv'.format(table_name)) as f:
+        reader = csv.reader(io.TextIOWrapper(f, encoding='utf8', newline=''))
+        columns = next(reader)
+        batch = []
+        for row in reader:
+            # Empty cells become NULL.
+            batch.append([value if value != '' else None for value in row])
+            if len(batch) == size:
+                yield columns, batch
+                batch = []
+        if batch:
+            yield columns, batch
+
+
+# Salts and hashes a list of plain text passwords, spread across a pool of processes.
+# Password hashing is deliberately slow, so doing it one password at a time is what used to
+# make init-db take minutes. Hashing runs in processes rather than threads, so the
+# work isn't serialized behind Python's GIL. The hashes follow the PASSWORD_* settings (see passwords.py).
+def hash_passwords(pool, passwords):
+    chunksize = max(1, len(passwords) // (4 * (os.cpu_count() or 1)))
+    hash_password = functools.partial(generate_password_hash, method=hash_method(current_app.config))
+    return list(pool.map(hash_password, passwords, chunksize=chunksize))
+
+
+# Fills every table in SEED_TABLES from its CSV, inside a single transaction.
+# Committing once at the end means SQLite only has to sync the file to disk once,
+# instead of after every table (or, for passwords, every row).
+def load_seed_data(db):
+    total_rows = 0
+    total_start = time.perf_counter()
+    with db, ProcessPoolExecutor() as pool:
+        for table_name in SEED_TABLES:
+            if not table_exists(db, table_name):
+                # We are not handling creating the schema here. We do that in schema.sql.
+                print("\tWARNING: table {} does not exist in the schema.\n".format(table_name))
+                continue
+
+            start = time.perf_counter()
+            rows = 0
+            for columns, batch in read_seed_csv(table_name):
+                # For the users table specifically, we need to salt and hash their passwords
+                # before they're stored, for security purposes...
+                if table_name == 'users':
+                    column = columns.index('password')
+                    hashes = hash_passwords(pool, [row[column] for row in batch])
+                    for row, password_hash in zip(batch, hashes):
+                        row[column] = password_hash
+
+                db.executemany(
+                    'INSERT INTO {} ({}) VALUES ({})'.format(
+                        table_name, ', '.join(columns), ', '.join('?' * len(columns))),
+                    batch,
                 )
+                rows += len(batch)
+
+            lap = time.perf_counter() - start
+            total_rows += rows
+            print("\tSUCCESS: filled table {} with {} rows in {:.2f} s ({:.0f} rows/s)\n".format(
+                table_name, rows, lap, rows / lap))
+
+        if get_driver() == 'postgresql':
+            from bobchat.postgres import reset_sequences
+            reset_sequences(db, SEED_TABLES)
+
+    lap = time.perf_counter() - total_start
+    print("\tFinished. {} rows in {:.2f} s ({:.0f} rows/s)\n".format(total_rows, lap, total_rows / lap))
+
+
+# Brings an existing database up to date with the current schema.
+#
+# schema.sql always describes the latest schema, which is what init-db creates. Databases
+# that were created by an older version of schema.sql are upgraded by running the numbered
+# files in bobchat/migrations (0001_*.sql, 0002_*.sql, ...) that they haven't seen yet.
+# SQLite has a spare integer in the database header, user_version, which we use to remember
+# the number of the last migration applied. schema.sql sets it to the latest migration.
+# See: https://www.sqlite.org/pragma.html#pragma_user_version
+#
+# PostgreSQL keeps the number in the schema_version table instead, and its migrations are in
+# bobchat/migrations/postgresql, numbered the same as the SQLite ones they match.
+def migrate_db():
+    db = get_db()
+    postgresql = get_driver() == 'postgresql'
+    if postgresql:
+        version = db.execute('SELECT version FROM schema_version').fetchone()[0]
+        directory = os.path.join('migrations', 'postgresql')
+    else:
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        directory = 'migrations'
+
+    migrations_path = os.path.join(current_app.root_path, directory)
+    file_names = sorted(os.listdir(migrations_path)) if os.path.isdir(migrations_path) else []
+    applied = []
+    for file_name in file_names:
+        if not file_name.endswith('.sql'):
+            continue
+        number = int(file_name.split('_', 1)[0])
+        if number <= version:
+            continue
+
+        with current_app.open_resource(os.path.join(directory, file_name)) as f:
+            script = f.read().decode('utf8')
+
+        # Each migration runs in its own transaction together with the version bump,
+        # so a failing migration leaves the database exactly as it was before it.
+        try:
+            if postgresql:
+                db.executescript('{}\nUPDATE schema_version SET version = {};'.format(script, number))
                 db.commit()
-                i += 1
-            except Error as e:
-                print(e)
-        lap = time.time() - start_time
-        print("\n\n\tFinished. Time elapsed: %d m %.2f s\n" % (int(lap / 60) , lap - (int(lap / 60) * 60)))
+            else:
+                # executescript() commits any pending transaction first, then runs the script as-is.
+                db.executescript(
+                    'BEGIN;\n{}\nPRAGMA user_version = {};\nCOMMIT;'.format(script, number))
+        except db.Error:
+            db.rollback()
+            raise
+        applied.append(file_name)
+
+    # 0006 adds an empty timelines table, and which posts belong in it depends on
+    # TIMELINE_FANOUT_LIMIT, so fill it in here rather than in the migration.
+    if '0006_timelines.sql' in applied:
+        from bobchat.timelines import rebuild_timelines
+        rebuild_timelines()
+
+    return applied
+
+
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    """Upgrade an existing database to the current schema."""
+    try:
+        applied = migrate_db()
+    except get_db().Error as e:
+        click.echo('Failed to migrate database: ' + str(e))
+        raise SystemExit(1)
+
+    for file_name in applied:
+        click.echo('Applied ' + file_name)
+    click.echo('Database is up to date.')
 
 
 # Defines a command line command called init-db that calls the init_db function and shows a success message to the user
@@ -146,3 +390,4 @@ def init_app(app):
 
     # Add commands that can be called with the flask command.
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
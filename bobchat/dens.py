@@ -3,44 +3,115 @@
 #       Handles the main use-cases for our program.
 #
 
-from flask import ( Blueprint, flash, g, redirect, render_template, request, url_for )
+from datetime import datetime, timedelta, timezone
+
+from flask import ( Blueprint, current_app, flash, g, redirect, render_template, request, url_for )
 from werkzeug.exceptions import abort
 
 from bobchat.auth import login_required
 from bobchat.db import get_db
+from bobchat.events import publish
+from bobchat.likes import pending_likes, toggle_like
+from bobchat.loader import get_loader
+from bobchat.pagecache import cached_page
+from bobchat.search import search_dens, search_posts
+from bobchat.timelines import backfill, prune
+
 bp = Blueprint('dens', __name__, url_prefix='/dens')
 
 
-# The index will show all the dens available, which you can click on to view a den in more detail.
+# The index is a directory of dens, which you can click on to view a den in more detail.
 # A JOIN is used so that the author information from the user table is available in the result.
+# Every den shows its follower and post counts, so the page changes when anyone follows or posts.
 @bp.route('/', methods=['POST', 'GET'])
+@cached_page(lambda: ['dens', 'followers', 'posts'], vary=lambda: activity_since())
 def index():
-    db = get_db()
-    if request.method == 'POST' and request.form['search'] != '':
-        # print('user is looking for: {}'.format(request.form['search']))
-        results = db.execute('''
-            SELECT name,
-            username,
-            d.created,
-            description,
-            d.id
-            FROM dens d
-            JOIN users u ON d.author_id = u.id
-            where d.name like ?
-            ORDER BY d.created DESC;
-        ''',('%'+request.form['search']+'%',)).fetchall()
+    # Searches are submitted with GET so the result pages can link to each other,
+    # but request.values also accepts the older POST form.
+    search = request.values.get('search', '')
+    page = request.args.get('page', 1, type=int)
+    sort = request.args.get('sort')
+    if sort not in DEN_SORTS:
+        sort = 'newest'
+    has_more = False
+    next_cursor = None
+    if search != '':
+        results, has_more = search_dens(search, page)
     else:
-        results = db.execute('''
-        SELECT name,
-            username,
+        cursor_type = DEN_SORTS[sort][1]
+        after = request.args.get('after', type=cursor_type)
+        after_id = request.args.get('after_id', type=int)
+        cursor = None if after is None or after_id is None else (after, after_id)
+        results, next_cursor = get_den_directory(sort, cursor)
+    return render_template('dens/index.html', dens=results, search=search, page=page, has_more=has_more,
+                           sort=sort, sorts=DEN_SORTS, next_cursor=next_cursor,
+                           activity_days=current_app.config['DEN_ACTIVITY_DAYS'])
+
+
+# The ways the den directory can be sorted: each name maps to a label, the type of its cursor in
+# the query string, and the column it sorts by, biggest first.
+#   • newest walks dens_created,
+#   • followers walks dens_follower_count. dens.follower_count is kept up to date by triggers,
+#   • active ranks the dens with posts in the last DEN_ACTIVITY_DAYS days by how many they had.
+#     That sums the den_activity rows for those days, one per den per day with posts, which the
+#     triggers on posts keep up to date. It never reads the posts themselves.
+# Like the feed, each sort is paginated with a keyset on (sort column, id) instead of an OFFSET,
+# so every page costs the same. See index.py.
+DEN_SORTS = {
+    'newest': ('Newest', str, 'd.created'),
+    'followers': ('Most followed', int, 'd.follower_count'),
+    'active': ('Most active', int, 'a.posts'),
+}
+
+
+# The first day (in UTC, as YYYY-MM-DD) counted by the 'active' sort.
+def activity_since():
+    days = current_app.config['DEN_ACTIVITY_DAYS']
+    return (datetime.now(timezone.utc).date() - timedelta(days=days - 1)).isoformat()
+
+
+# Returns one page of the den directory in the given sort, and the cursor of the next page
+# (or None if there isn't one). cursor is either None for the first page, or the
+# (sort column, id) of the last den already shown.
+def get_den_directory(sort, cursor=None):
+    size = current_app.config['DEN_PAGE_SIZE']
+    column = DEN_SORTS[sort][2]
+    params = ()
+    source = 'dens d'
+    if sort == 'active':
+        source = '''(
+                SELECT den_id,
+                    SUM(posts) AS posts
+                FROM den_activity
+                WHERE day >= ?
+                GROUP BY den_id
+            ) a
+            JOIN dens d ON d.id = a.den_id'''
+        params += (activity_since(),)
+    # The only things we splice into the query text are fixed fragments, never user input.
+    keyset = ''
+    if cursor is not None:
+        keyset = 'WHERE ({}, d.id) < (?, ?)'.format(column)
+        params += tuple(cursor)
+    dens = get_db().execute('''
+        SELECT d.name,
+            u.username,
             d.created,
-            description,
-            d.id
-        FROM dens d
+            d.description,
+            d.id,
+            d.follower_count,
+            d.post_count,
+            {0} AS sort_key
+        FROM {1}
             JOIN users u ON d.author_id = u.id
-        ORDER BY d.created DESC;
-        ''').fetchall()
-    return render_template('dens/index.html', dens=results)
+        {2}
+        ORDER BY {0} DESC, d.id DESC
+        LIMIT ?;
+    '''.format(column, source, keyset), params + (size + 1,)).fetchall()
+    if len(dens) <= size:
+        return dens, None
+    dens = dens[:size]
+    return dens, (dens[-1]['sort_key'], dens[-1]['id'])
 
 
 # The create view works the same as the auth register view.
@@ -77,29 +148,6 @@ def create():
     return render_template('dens/create.html')
 
 
-# Both the update and delete views will need to fetch a post by id
-# and check if the author matches the logged in user. To avoid
-# duplicating code, you can write a function to get the post and call it from each view.
-def get_post(id, check_author=True):
-    post = get_db().execute(
-        'SELECT p.id, title, body, created, author_id, username'
-        ' FROM post p JOIN users u ON p.author_id = u.id'
-        ' WHERE p.id = ?',
-        (id,)
-    ).fetchone()
-
-    if post is None:
-        # abort() will raise a special exception that returns an HTTP status code.
-        # 404 means “Not Found”.
-        abort(404, f"Post id {id} doesn't exist.")
-
-    if check_author and post['author_id'] != g.user['id']:
-        # 403 means “Forbidden”.
-        abort(403)
-
-    return post
-
-
 # Route for updating a den
 @bp.route('/<int:id>/update', methods=('GET', 'POST'))
 @login_required
@@ -111,10 +159,9 @@ def update(id):
     #
 
     den = get_den_info(id)
-    print(g.user['id'])
-    print(den['author_id'])
+    if den is None:
+        abort(404, f"Den id {id} doesn't exist.")
     if (int(g.user['id']) != int(den['author_id'])):
-        print('error')
         return abort(403)
 
     if request.method == 'POST':
@@ -131,7 +178,7 @@ def update(id):
             db = get_db()
             db.execute(
                 'UPDATE dens SET name = ?, description = ?'
-                'WHERE id = ?',
+                ' WHERE id = ?',
                 (title, body, id))
             db.commit()
             return redirect(url_for('dens.index'))
@@ -145,9 +192,15 @@ def update(id):
 @bp.route('/<int:den_id>/delete', methods=('POST', 'GET'))
 @login_required
 def delete(den_id):
-    get_post(den_id)
+    den = get_den_info(den_id)
+    if den is None:
+        # abort() will raise a special exception that returns an HTTP status code.
+        # 404 means “Not Found”.
+        abort(404, f"Den id {den_id} doesn't exist.")
+    if den['author_id'] != g.user['id']:
+        # 403 means “Forbidden”.
+        abort(403)
     db = get_db()
-    db.execute('pragma foreign_keys = on;')
     db.execute('delete FROM dens WHERE id = ?', (den_id,))
     db.commit()
     return redirect(url_for('dens.index'))
@@ -156,180 +209,202 @@ def delete(den_id):
 # This route returns all the posts associated with a den.
 @bp.route('/<int:den_id>', methods=['POST', 'GET'])
 @login_required
+@cached_page(lambda den_id: ['den:{}'.format(den_id), 'follows:{}'.format(g.user['id'])])
 def den(den_id):
-    search = ''
-    if request.method == 'POST':
-        print(request.form['search'])
-        search = request.form['search']
-    follow = get_db().execute('''
-        select *
-        from user_den_assoc
-        where user_id = ?
-        and den_id = ?
-    ''',(g.user['id'], den_id,)).fetchone()
-    if follow is None:
-        follow = 'follow'
+    search = request.values.get('search', '')
+    page = request.args.get('page', 1, type=int)
+    # The den and whether you follow it come back from one query.
+    den_info, following = get_loader().den_for_user(den_id, g.user['id'])
+    if den_info is None:
+        abort(404, f"Den id {den_id} doesn't exist.")
+    follow = 'unfollow' if following else 'follow'
+    has_more = False
+    if search != '':
+        posts, has_more = search_posts(den_id, search, page)
     else:
-        follow = 'unfollow'
-    posts = get_posts(den_id, search)
-    den_info = get_den_info(den_id)
-    return render_template('dens/den.html', den=den_info, posts=posts, follow=follow)
+        posts = get_posts(den_id)
+    return render_template('dens/den.html', den=den_info, posts=posts, follow=follow,
+                           search=search, page=page, has_more=has_more)
 
 
-# Returns information for a specific den by id
+# Returns information for a specific den by id, or None if there's no such den.
+# Dens are only looked up once per request. See loader.py.
 def get_den_info(den_id):
-    info = get_db().execute('''
-    SELECT dens.name,
-        dens.created,
-        dens.description,
-        users.username,
-        dens.id,
-        dens.author_id
-    FROM dens,
-        users
-    WHERE users.id = dens.author_id
-        AND dens.id = ?
-    ''', (den_id,)).fetchone()
-    return info
-
-
-# Returns a list of all posts attached to a specific den by id and search keyword
-def get_posts(den_id, search):
-    if search == '':
-        posts = get_db().execute('''
-        SELECT users.username,
-            posts.created,
-            posts.title,
-            posts.id,
-            IFNULL(post.likes, 0) AS likes
-        FROM users,
-            posts
-            LEFT JOIN (
-                SELECT post_id,
-                    COUNT(*) AS likes
-                FROM post_like_assoc,
-                    posts
-                WHERE posts.id = post_like_assoc.post_id
-                    AND posts.den_id = ?
-                GROUP BY post_like_assoc.post_id
-            ) AS post ON post_id = posts.id
-        WHERE posts.den_id = ?
-            AND posts.author_id = users.id
-        ORDER BY likes DESC;
-        ''',(den_id, den_id,)).fetchall()
-    else:
-        posts = get_db().execute('''
-        SELECT users.username,
-            posts.created,
-            posts.title,
-            posts.id,
-            IFNULL(post.likes, 0) AS likes
-        FROM users,
-            posts
-            LEFT JOIN (
-                SELECT post_id,
-                    COUNT(*) AS likes
-                FROM post_like_assoc,
-                    posts
-                WHERE posts.id = post_like_assoc.post_id
-                    AND posts.den_id = ?
-                GROUP BY post_like_assoc.post_id
-            ) AS post ON post_id = posts.id
-        WHERE posts.den_id = ?
-            AND posts.author_id = users.id
-            AND posts.title LIKE ?
-        ORDER BY likes DESC;
-        ''',(den_id, den_id, '%'+search+'%',)).fetchall()
+    return get_loader().den(den_id)
+
+
+# Returns a list of all posts attached to a specific den by id, most liked first.
+# Searching within a den is handled by search.search_posts().
+def get_posts(den_id):
+    posts = get_db().execute('''
+    SELECT users.username,
+        posts.created,
+        posts.title,
+        posts.id,
+        posts.like_count AS likes
+    FROM users,
+        posts
+    WHERE posts.den_id = ?
+        AND posts.author_id = users.id
+    ORDER BY posts.like_count DESC;
+    ''',(den_id,)).fetchall()
     return posts
 
 
 # Route for showing specific post information
+# The like count it shows is the post's like_count, which 'post:<id>' covers, plus the likes this
+# worker hasn't written yet (see get_likes()), so those are added to the cache key.
 @bp.route('/<int:den_id>/<int:post_id>', methods=['POST', 'GET'])
 @login_required
+@cached_page(lambda den_id, post_id: ['den:{}'.format(den_id), 'post:{}'.format(post_id)],
+             vary=lambda den_id, post_id: pending_likes(post_id))
 def den_post(den_id, post_id):
-    db = get_db()
-    if request.method == 'POST':
-        try:
-            db.execute('''
-            INSERT INTO post_like_assoc(user_id, post_id)
-            VALUES(?, ?);
-            ''', (g.user['id'], post_id,)
-            )
-            db.commit()
-        except get_db().IntegrityError:
-            # This user already liked the post, so the database will throw an IntegrityError
-            # since there is a uniqueness constraint attached to the post_like_assoc table.
-            db.execute('''
-                DELETE FROM post_like_assoc
-                WHERE user_id = ?
-                    AND post_id = ?;
-            ''', (g.user['id'], post_id,)
-            )
-            db.commit()
+    # The post, its den and its like count come back from one query.
+    den_info, post_info = get_loader().post_in_den(den_id, post_id)
+    if den_info is None or post_info is None:
+        abort(404, f"Post id {post_id} doesn't exist.")
 
-    den_info = get_den_info(den_id)
-    post_info = get_post(post_id)
+    # Only a post that exists can be liked. Otherwise the like would fail the foreign key,
+    # or sit in the like buffer for a post that isn't there.
+    if request.method == 'POST':
+        # Depending on LIKE_BUFFER, the like may be written a little later, in a batch. See likes.py.
+        toggle_like(g.user['id'], post_id)
+        # With LIKE_BUFFER off, the like count has already changed.
+        post_info = get_loader().reload_post(post_id)
     likes = get_likes(post_id)
-    comments = get_comments(post_id)
 
-    return render_template('dens/post.html', den=den_info, post=post_info, likes=likes, comments=comments)
+    # Only the first page of comments is shown, and none of their replies, so the page stays
+    # the same size no matter how long the discussion gets. Older comments are a link away,
+    # and each thread's replies are fetched when it's expanded (see replies()).
+    comments, next_cursor = get_comments(post_id, get_cursor('before'))
 
+    return render_template('dens/post.html', den=den_info, post=post_info, likes=likes,
+                           comments=comments, next_cursor=next_cursor, den_id=den_id, post_id=post_id)
 
-# Returns the username, created, title, and body of a single post queried by id
+
+# Returns a single post by id, with its author's username, or None if there's no such post.
+# Both the update and delete views will need to fetch a post by id, so posts are only looked up
+# once per request. See loader.py.
 def get_post(post_id):
-    post = get_db().execute('''
-    SELECT posts.id,
-        users.username,
-        posts.created,
-        posts.title,
-        posts.body
-    FROM posts,
-        users
-    WHERE users.id = posts.author_id
-        AND posts.id = ?;
-    ''', (post_id,)).fetchone()
-    return post
+    return get_loader().post(post_id)
 
 
 # Returns the number of likes by post_id...
+# This reads the like_count column that the post_like_assoc triggers keep up to date (see schema.sql).
 def get_likes(post_id):
     # TODO: handle getting likes for comments as well, see: https://github.com/tsainez/bobchat/issues/8
-    likes = get_db().execute('''
-        SELECT COUNT(*) AS COUNT
-        FROM post_like_assoc
-        WHERE post_id = ?;
-        ''', (post_id,)).fetchone()
-    return likes['count']
-
-
-# Return a list of comments attached to a post
-def get_comments(post_id):
+    post = get_post(post_id)
+    if post is None:
+        return 0
+    # Likes this worker hasn't written to the database yet are counted too,
+    # so whoever just liked the post sees their like.
+    return post['like_count'] + pending_likes(post_id)
+
+
+# Comments are paginated with a keyset on (created, id), like the feed in index.py.
+# Returns the cursor in the query string under the given name (and name + '_id'), or None.
+def get_cursor(name):
+    created = request.args.get(name)
+    comment_id = request.args.get(name + '_id', type=int)
+    if created is None or comment_id is None:
+        return None
+    return (created, comment_id)
+
+
+# Splits off the extra row a page query asked for, and returns (rows, cursor of the next page).
+def split_page(rows, size):
+    if len(rows) <= size:
+        return rows, None
+    rows = rows[:size]
+    return rows, (rows[-1]['created'], rows[-1]['id'])
+
+
+# Returns one page of the comments on a post that aren't replies to another comment, newest first,
+# and the cursor of the next page (or None if there isn't one).
+# cursor is either None for the first page, or the (created, id) of the last comment already shown.
+def get_comments(post_id, cursor=None):
+    size = current_app.config['COMMENT_PAGE_SIZE']
+    # The only thing we splice into the query text is a fixed fragment, never user input.
+    keyset = '' if cursor is None else 'AND (comments.created, comments.id) < (?, ?)'
     comments = get_db().execute('''
         SELECT users.username,
             comments.body,
             comments.created,
-            comments.id
-        FROM comments,
-            users
-        WHERE comments.author_id = users.id
+            comments.id,
+            comments.reply_count
+        FROM comments
+            JOIN users ON users.id = comments.author_id
+        WHERE comments.post_id = ?
+            AND comments.parent_id IS NULL
+            {}
+        ORDER BY comments.created DESC, comments.id DESC
+        LIMIT ?;
+    '''.format(keyset), (post_id,) + tuple(cursor or ()) + (size + 1,)).fetchall()
+    return split_page(comments, size)
+
+
+# Returns one page of the replies to a comment, oldest first so the conversation reads in order,
+# and the cursor of the next page (or None if there isn't one).
+# cursor is either None for the first page, or the (created, id) of the last reply already shown.
+def get_replies(post_id, comment_id, cursor=None):
+    size = current_app.config['REPLY_PAGE_SIZE']
+    keyset = '' if cursor is None else 'AND (comments.created, comments.id) > (?, ?)'
+    replies = get_db().execute('''
+        SELECT users.username,
+            comments.body,
+            comments.created,
+            comments.id,
+            comments.reply_count
+        FROM comments
+            JOIN users ON users.id = comments.author_id
+        WHERE comments.parent_id = ?
             AND comments.post_id = ?
-        ORDER BY comments.created DESC;
-    ''', (post_id,)).fetchall()
-    return comments
+            {}
+        ORDER BY comments.created, comments.id
+        LIMIT ?;
+    '''.format(keyset), (comment_id, post_id) + tuple(cursor or ()) + (size + 1,)).fetchall()
+    return split_page(replies, size)
 
 
-# Route that is used when the user wants to comment on a post
+# Returns a page of replies to a comment as a fragment of HTML, which the post page inserts
+# under the comment when its thread is expanded (see static/comments.js).
+@bp.route('/<int:den_id>/<int:post_id>/comments/<int:comment_id>/replies')
+@login_required
+@cached_page(lambda den_id, post_id, comment_id: ['post:{}'.format(post_id)])
+def replies(den_id, post_id, comment_id):
+    replies, next_cursor = get_replies(post_id, comment_id, get_cursor('after'))
+    more_url = None
+    if next_cursor is not None:
+        more_url = url_for('dens.replies', den_id=den_id, post_id=post_id, comment_id=comment_id,
+                           after=next_cursor[0], after_id=next_cursor[1])
+    return render_template('dens/comments.html', comments=replies, den_id=den_id, post_id=post_id,
+                           more_url=more_url)
+
+
+# Route that is used when the user wants to comment on a post, or reply to a comment on it
 @bp.route('/<int:den_id>/<int:post_id>/comment', methods=['POST'])
 # Although you are required to be logged in, you do not have to be a member of a den to comment in it.
 @login_required
 def comment(den_id, post_id):
     body = request.form['comment']
+    parent_id = request.form.get('parent_id', type=int)
     db = get_db()
+    if parent_id is not None:
+        parent = db.execute('''
+            SELECT 1
+            FROM comments
+            WHERE id = ?
+                AND post_id = ?
+        ''', (parent_id, post_id)).fetchone()
+        if parent is None:
+            abort(400, "You can only reply to a comment on the same post.")
     db.execute('''
-    INSERT INTO comments(author_id, post_id, body)
-    VALUES(?, ?, ?)
-    ''', (g.user['id'], post_id, body))
+    INSERT INTO comments(author_id, post_id, body, parent_id)
+    VALUES(?, ?, ?, ?)
+    ''', (g.user['id'], post_id, body, parent_id))
     db.commit()
+    publish(['post:{}'.format(post_id)],
+            {'type': 'comment', 'den_id': den_id, 'post_id': post_id, 'parent_id': parent_id})
 
     return redirect(url_for('dens.den_post', den_id=den_id, post_id=post_id))
 
@@ -339,18 +414,31 @@ def comment(den_id, post_id):
 @login_required
 def follow():
     db = get_db()
-    den_id = request.form['den_id']
+    den_id = request.form.get('den_id', type=int)
+    # The foreign key would turn away a follow of a den that doesn't exist, but only with an error.
+    if den_id is None or get_den_info(den_id) is None:
+        abort(404, f"Den id {den_id} doesn't exist.")
+    # The user's feed timeline is updated in the same transaction as the follow itself.
     if request.form['follow'] == 'unfollow':
         db.execute('''
             DELETE FROM user_den_assoc
             WHERE user_id = ?
                 AND den_id = ?
         ''', (g.user['id'], den_id))
+        prune(g.user['id'], den_id)
         db.commit()
     else:
+        # Following a den you already follow does nothing.
         db.execute('''
             INSERT INTO user_den_assoc(user_id, den_id)
-            VALUES(?, ?)
-        ''', (g.user['id'], den_id))
+            SELECT ?, ?
+            WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM user_den_assoc
+                    WHERE user_id = ?
+                        AND den_id = ?
+                )
+        ''', (g.user['id'], den_id, g.user['id'], den_id))
+        backfill(g.user['id'], den_id)
         db.commit()
     return redirect(url_for('dens.den', den_id=den_id))
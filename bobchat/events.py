@@ -0,0 +1,270 @@
+#
+#   events.py
+#       Pushes new posts, comments and likes to the browsers that are looking at them, using
+#       Server-Sent Events, so nobody has to keep refreshing a den or post to see new activity.
+#
+
+# A browser subscribes by opening /events/?den=<id> or /events/?post=<id> with an EventSource.
+# The response never finishes: it stays open and we write an event to it whenever something
+# happens in that den or on that post.
+# See: https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events
+#
+# The browser is connected to one worker, but the write can happen in any other worker. So each
+# worker that has subscribers listens on a Unix datagram socket in EVENTS_SOCKET_DIR, and every
+# event published in any worker is sent to all the sockets in that directory.
+#
+# Each open stream holds on to a worker thread while it waits, so serve the site with a worker
+# class that can keep many requests open at once, e.g.
+#   gunicorn --worker-class gthread --threads 1000 "bobchat:create_app()"
+# or gevent. With the default sync workers, every subscriber ties up a whole worker process.
+# Served on an ASGI server through asgi.py, a stream is just a coroutine waiting on the event loop,
+# and holds no thread at all.
+
+import asyncio
+import json
+import os
+import queue
+import socket
+import threading
+from collections import defaultdict
+
+from flask import Blueprint, Response, abort, current_app, request
+
+from bobchat.auth import login_required
+
+bp = Blueprint('events', __name__, url_prefix='/events')
+
+# How many seconds publish() waits on a worker that isn't reading its socket.
+SEND_TIMEOUT = 0.1
+
+
+# One browser's subscription to a set of channels, like ['den:3', 'post:12'].
+# Events are queued until the stream gets around to sending them. A subscriber that falls
+# more than queue_size events behind misses the extra events rather than using up memory.
+class Subscription:
+    def __init__(self, broadcaster, channels, queue_size):
+        self.broadcaster = broadcaster
+        self.channels = channels
+        self.queue = queue.Queue(queue_size)
+
+    # Returns the next event, or None if nothing happened within timeout seconds.
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            pass
+
+    def close(self):
+        self.broadcaster.unsubscribe(self)
+
+
+# A Subscription for code running on an asyncio event loop (see asgi.py), which can wait for
+# events without holding on to a thread. Events arrive on the broadcaster's threads, and are
+# handed over to the loop.
+class AsyncSubscription(Subscription):
+    def __init__(self, broadcaster, channels, queue_size, loop):
+        self.broadcaster = broadcaster
+        self.channels = channels
+        self.loop = loop
+        self.queue = asyncio.Queue(queue_size)
+
+    # Returns the next event, or None if nothing happened within timeout seconds.
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def put(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The loop has already been closed.
+            pass
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+
+# Hands events to every subscription in this process, and passes them on to other processes
+# through the sockets in socket_dir. There is one broadcaster per app per worker process.
+class Broadcaster:
+    def __init__(self, socket_dir=None, queue_size=100):
+        self.socket_dir = socket_dir
+        self.queue_size = queue_size
+        self._channels = defaultdict(set)
+        self._lock = threading.Lock()
+        self._socket = None
+        self._socket_path = None
+        self._pid = None
+
+    # Subscribes to channels. Pass the running event loop to wait for events with await.
+    def subscribe(self, channels, loop=None):
+        self._listen()
+        if loop is None:
+            subscription = Subscription(self, channels, self.queue_size)
+        else:
+            subscription = AsyncSubscription(self, channels, self.queue_size, loop)
+        with self._lock:
+            for channel in channels:
+                self._channels[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._channels.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._channels[channel]
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(set().union(*self._channels.values()))
+
+    # Sends event to everyone subscribed to any of channels, in this worker and all the others.
+    # A subscriber to more than one of the channels only gets the event once.
+    def publish(self, channels, event):
+        self.deliver(channels, event)
+        if self.socket_dir is None:
+            return
+
+        message = json.dumps([channels, event]).encode('utf8')
+        try:
+            names = os.listdir(self.socket_dir)
+        except FileNotFoundError:
+            return
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # Wait a moment for a worker whose socket is full to catch up, but no longer; a worker
+        # that's stuck shouldn't hold up the request that published the event.
+        sender.settimeout(SEND_TIMEOUT)
+        try:
+            for name in names:
+                path = os.path.join(self.socket_dir, name)
+                if not name.endswith('.sock') or path == self._socket_path:
+                    continue
+                try:
+                    sender.sendto(message, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Nobody is listening on this socket any more; its worker must have exited.
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                except (BlockingIOError, socket.timeout):
+                    # That worker's socket is still full, so it misses this event.
+                    pass
+        finally:
+            sender.close()
+
+    # Hands event to the subscribers of channels in this process only.
+    def deliver(self, channels, event):
+        with self._lock:
+            subscribers = set()
+            for channel in channels:
+                subscribers.update(self._channels.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put(event)
+
+    # Starts listening for events published by other workers, the first time this process
+    # gets a subscriber. A worker that was forked from a process that was already listening
+    # gets its own socket, since the parent's belongs to the parent.
+    def _listen(self):
+        if self.socket_dir is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.socket_dir, exist_ok=True)
+            path = os.path.join(self.socket_dir, '{}.sock'.format(os.getpid()))
+            if os.path.exists(path):
+                os.unlink(path)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(path)
+            self._socket_path = path
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._receive, args=(self._socket,), daemon=True)
+            thread.start()
+
+    def _receive(self, sock):
+        while True:
+            message = sock.recv(65536)
+            channels, event = json.loads(message.decode('utf8'))
+            self.deliver(channels, event)
+
+
+# Returns this app's broadcaster.
+def get_broadcaster():
+    broadcaster = current_app.extensions.get('bobchat.events')
+    if broadcaster is None:
+        socket_dir = current_app.config['EVENTS_SOCKET_DIR']
+        if not hasattr(socket, 'AF_UNIX'):
+            # No Unix sockets on this platform, so events only reach this process.
+            socket_dir = None
+        broadcaster = current_app.extensions['bobchat.events'] = Broadcaster(
+            socket_dir, current_app.config['EVENTS_QUEUE_SIZE'])
+    return broadcaster
+
+
+# Sends event (a dict that can be turned into JSON, with at least a 'type') to the
+# subscribers of channels. Call this after the change has been committed.
+def publish(channels, event):
+    get_broadcaster().publish(channels, event)
+
+
+# The first thing sent on a stream tells the browser how long to wait before reconnecting if it drops.
+RETRY = 'retry: 5000\n\n'
+# A comment line every so often stops proxies from closing an idle connection.
+HEARTBEAT = ': heartbeat\n\n'
+
+HEADERS = {
+    'Cache-Control': 'no-cache',
+    # Stops nginx from buffering the stream.
+    'X-Accel-Buffering': 'no',
+}
+
+
+def format_event(event):
+    return 'event: {}\ndata: {}\n\n'.format(event['type'], json.dumps(event))
+
+
+# Returns the channels for the dens and posts given in the query string, e.g. ?den=3&post=12.
+def requested_channels(args):
+    channels = ['den:{}'.format(den_id) for den_id in args.getlist('den', type=int)]
+    channels += ['post:{}'.format(post_id) for post_id in args.getlist('post', type=int)]
+    return channels
+
+
+# The stream of events for the dens and posts given in the query string.
+# When the site is served with asgi.py, streams are handled there instead, without a thread each.
+@bp.route('/')
+@login_required
+def stream():
+    channels = requested_channels(request.args)
+    if not channels:
+        abort(400)
+
+    subscription = get_broadcaster().subscribe(channels)
+    heartbeat = current_app.config['EVENTS_HEARTBEAT']
+
+    def generate():
+        try:
+            yield RETRY
+            while True:
+                event = subscription.get(heartbeat)
+                yield HEARTBEAT if event is None else format_event(event)
+        finally:
+            # Runs when the browser disconnects and the server closes the generator.
+            subscription.close()
+
+    return Response(generate(), mimetype='text/event-stream', headers=HEADERS)
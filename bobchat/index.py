@@ -4,9 +4,11 @@
 #
 
 # Define the blueprint and register it in the application factory.
-from flask import ( Blueprint, g, render_template, session )
+from flask import ( Blueprint, current_app, g, render_template, request, session )
 
 from bobchat.db import get_db
+from bobchat.pagecache import cached_fragment, cached_page
+from bobchat.timelines import get_timeline
 
 bp = Blueprint('index', __name__)
 
@@ -15,10 +17,60 @@ bp = Blueprint('index', __name__)
 # A JOIN is used so that the author information from the user table is available in the result.
 @bp.route('/')
 def index():
-    db = get_db()
+    if g.user is None:
+        return home()
+    else:
+        # Whether or not the user is logged in, we want to show the 5 most recently made posts...
+        # Under the feed they look the same to everyone, so they're rendered once and cached
+        # until a post is written or liked.
+        recents = cached_fragment(
+            'index.recents', ['posts', 'likes'],
+            lambda: render_template('index/recents.html', posts=get_recent_posts()))
+
+        # The feed is paginated with a keyset (or "cursor") on (created, id) instead of an OFFSET.
+        # The "load more" link carries the created timestamp and id of the last post on the page,
+        # and the next page picks up strictly after it. That way every page costs the same,
+        # no matter how many dens the user follows or how far down the feed they scroll.
+        # See: https://use-the-index-luke.com/no-offset
+        before = request.args.get('before')
+        before_id = request.args.get('before_id', type=int)
+        if before is None or before_id is None:
+            cursor = None
+        else:
+            cursor = (before, before_id)
+
+        # Each user's feed is built ahead of time as posts are written. See timelines.py.
+        page_size = current_app.config['FEED_PAGE_SIZE']
+        posts = get_timeline(session.get('user_id'), cursor, page_size + 1)
+
+        # We asked for one extra row, which tells us if there is another page without a COUNT(*).
+        next_cursor = None
+        if len(posts) > page_size:
+            posts = posts[:page_size]
+            next_cursor = (posts[-1]['created'], posts[-1]['post_id'])
+
+        return render_template('index/feed.html', posts=posts, recents=recents, next_cursor=next_cursor)
+
 
-    # Whether or not the user is logged in, we want to show the 5 most recently made posts...
-    recent_posts = db.execute('''
+# The home page for visitors who aren't logged in. Nothing on it depends on the viewer,
+# so it's cached until someone posts or registers.
+@cached_page(lambda: ['posts', 'users'])
+def home():
+    # Some extra data about the site for displaying on the home page.
+    # These are running totals kept up to date by triggers, so this reads a single row.
+    site_data = get_db().execute('''
+    SELECT users,
+        posts
+    FROM site_stats
+    WHERE id = 1;
+    ''').fetchone()
+
+    return render_template('index/home.html', posts=get_recent_posts(), site_data=site_data)
+
+
+# Returns the 5 most recently made posts on the whole site.
+def get_recent_posts():
+    recent_posts = get_db().execute('''
         SELECT 
         users.username,
         dens.name,
@@ -27,55 +79,11 @@ def index():
         posts.created,
         posts.body,
         posts.title,
-        ifNull(post.likes,0) as likes
-        FROM users, dens, posts left join
-            (
-                select post_id, count(*) as likes
-                from post_like_assoc
-                group by post_like_assoc.post_id
-            ) as post on post_id = posts.id
+        posts.like_count as likes
+        FROM users, dens, posts
         WHERE users.id = posts.author_id
         AND dens.id = den_id
         ORDER BY posts.created DESC
         LIMIT 5;
         ''').fetchall()
-    if g.user is None:
-        # Some extra data about the site for displaying on the home page.
-        site_data = db.execute('''
-        SELECT COUNT(DISTINCT users.id) AS users,
-            COUNT(DISTINCT posts.id) AS posts
-        FROM users,
-            posts;
-        ''').fetchone()
-
-        return render_template('index/home.html', posts=recent_posts, site_data=site_data)
-    else:
-        # SQL operations usually need to use values from Python variables.
-        # However, beware of using Python’s string operations to assemble queries,
-        # as they are vulnerable to SQL injection attacks.
-        # Instead, use the DB-API’s parameter substitution.
-        # See: https://docs.python.org/3/library/sqlite3.html
-        posts = db.execute('''
-        SELECT users.username,
-            dens.name,
-            dens.id as den_id,
-            posts.id as post_id,
-            posts.created,
-            posts.body,
-            posts.title,
-            ifNull(post.likes,0) as likes
-        FROM users, dens, posts left join
-        (
-            select post_id, count(*) as likes
-            from post_like_assoc
-            group by post_like_assoc.post_id
-        ) as post on post_id = posts.id
-        WHERE den_id IN (
-                SELECT den_id
-                FROM user_den_assoc
-                WHERE user_id = ?
-            )
-            AND users.id = posts.author_id
-            AND dens.id = den_id
-        ORDER BY posts.created DESC;''',(session.get('user_id'),)).fetchall()
-        return render_template('index/feed.html', posts=posts, recents=recent_posts)
+    return recent_posts
@@ -0,0 +1,336 @@
+#
+#   likes.py
+#       Records likes and unlikes. Instead of writing each one to the database as it happens,
+#       a worker collects them in memory and writes them out a batch at a time, so a post that's
+#       being liked by hundreds of people a second doesn't queue every worker up behind SQLite's
+#       single write lock.
+#
+
+# Each worker keeps a buffer of the likes it hasn't written yet, as the state each (user, post) pair
+# should end up in: liked or not. Toggling a like looks at that state (or at the database, if the
+# pair isn't in the buffer) and flips it, so liking then unliking before a flush leaves nothing to
+# write at all. The buffer is written out in a single transaction every LIKE_FLUSH_INTERVAL seconds,
+# or straight away once it holds LIKE_BUFFER_SIZE pairs, which also caps how much memory it uses.
+# Batches are only ever written by the buffer's own thread, never by a request's, whose connection
+# may be part way through a transaction of its own.
+#
+# Until a batch is written, posts.like_count doesn't include it. So a worker adds its own unwritten
+# likes to the count it shows (see pending_likes()), and the person who just liked a post sees their
+# like counted. Other workers see it once it's flushed.
+#
+# LIKE_BUFFER picks how likes are recorded:
+#   • 'off' writes each like to the database before the page is shown, like before,
+#   • 'memory' buffers them; likes that haven't been flushed are lost if a worker is killed,
+#   • 'journal' also appends each like to a file in LIKE_JOURNAL_DIR and syncs it to disk before
+#     the page is shown. When the app is built, and when gunicorn forks a worker (see boot.py),
+#     the journals that dead workers left are written out (see recover_journals()).
+
+import atexit
+import logging
+import os
+import threading
+from collections import Counter
+
+from flask import current_app
+
+from bobchat.db import get_db
+from bobchat.events import publish
+
+logger = logging.getLogger(__name__)
+
+
+# Likes or unlikes a post for a user, however LIKE_BUFFER says to.
+def toggle_like(user_id, post_id):
+    if current_app.config['LIKE_BUFFER'] == 'off':
+        toggle_like_now(user_id, post_id)
+    else:
+        get_like_buffer().toggle(user_id, post_id)
+
+
+# Likes or unlikes a post, and commits it immediately.
+def toggle_like_now(user_id, post_id):
+    db = get_db()
+    # Liking or unliking also updates posts.like_count, through the triggers on post_like_assoc,
+    # in the same transaction. So the count can never disagree with the rows in the likes table.
+    liked = db.execute('''
+        INSERT INTO post_like_assoc(user_id, post_id)
+        VALUES(?, ?)
+        ON CONFLICT (user_id, post_id) DO NOTHING;
+    ''', (user_id, post_id)).rowcount
+    if not liked:
+        # This user already liked the post, since there is a uniqueness constraint attached
+        # to the post_like_assoc table, so this is an unlike.
+        db.execute('''
+            DELETE FROM post_like_assoc
+            WHERE user_id = ?
+                AND post_id = ?;
+        ''', (user_id, post_id))
+    db.commit()
+    publish_likes([post_id])
+
+
+# Tells everyone looking at these posts (see events.py) how many likes they have now.
+def publish_likes(post_ids):
+    posts = get_db().execute(
+        'SELECT id, den_id, like_count FROM posts WHERE id IN ({})'.format(', '.join('?' * len(post_ids))),
+        list(post_ids),
+    ).fetchall()
+    for post in posts:
+        publish(['den:{}'.format(post['den_id']), 'post:{}'.format(post['id'])],
+                {'type': 'like', 'den_id': post['den_id'], 'post_id': post['id'], 'likes': post['like_count']})
+
+
+# How many likes this worker has recorded for a post but not written yet. Can be negative.
+def pending_likes(post_id):
+    if current_app.config['LIKE_BUFFER'] == 'off':
+        return 0
+    return get_like_buffer().pending(post_id)
+
+
+# Returns this worker's like buffer. A worker forked from a process that had a buffer
+# starts its own, empty one, so the parent's likes aren't written twice.
+def get_like_buffer():
+    buffer = current_app.extensions.get('bobchat.likes')
+    if buffer is None or buffer.pid != os.getpid():
+        buffer = current_app.extensions['bobchat.likes'] = LikeBuffer(current_app._get_current_object())
+    return buffer
+
+
+class LikeBuffer:
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self.size = app.config['LIKE_BUFFER_SIZE']
+        self.interval = app.config['LIKE_FLUSH_INTERVAL']
+
+        # (user_id, post_id) -> (liked in the database, should be liked), for likes not yet written.
+        self._pending = {}
+        # The batch that's being written right now, in the same form.
+        self._flushing = {}
+        # post_id -> likes recorded but not written, across both of the above. Posts with none
+        # have no entry, so it only ever holds the posts in the buffer.
+        self._deltas = Counter()
+        # How many batches have been written.
+        self._flushes = 0
+
+        self._lock = threading.Lock()
+        # Only one batch is written at a time.
+        self._flush_lock = threading.Lock()
+        # Set to have the flush thread write the batch now, rather than at the next interval.
+        self._full = threading.Event()
+
+        # In journal mode, each toggle is written to the journal while holding _lock, so the lines
+        # are in the order the toggles happened, but it waits for the disk without it, so toggles
+        # aren't held up by each other's fsync. _journal_lock is held while syncing, and while the
+        # journal is rewritten after a flush. One fsync covers every line written before it, so
+        # a toggle whose line has been synced by someone else's doesn't sync again.
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        # How many times the journal has been written to, and how many of those are on disk.
+        self._journal_writes = 0
+        self._journal_synced = 0
+        if app.config['LIKE_BUFFER'] == 'journal':
+            directory = app.config['LIKE_JOURNAL_DIR']
+            os.makedirs(directory, exist_ok=True)
+            self._journal_path = os.path.join(directory, '{}.journal'.format(self.pid))
+            self._journal = open(self._journal_path, 'a', encoding='utf8')
+
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        # Write out whatever's left when the worker shuts down cleanly.
+        atexit.register(self.flush)
+
+    def toggle(self, user_id, post_id):
+        key = (user_id, post_id)
+        while True:
+            with self._lock:
+                flushes = self._flushes
+                buffered = key in self._pending or key in self._flushing
+            liked = None if buffered else get_db().execute('''
+                SELECT 1
+                FROM post_like_assoc
+                WHERE user_id = ?
+                    AND post_id = ?;
+            ''', key).fetchone() is not None
+
+            with self._lock:
+                if self._flushes != flushes:
+                    # A batch was written while we were reading, so what we read may be out of date.
+                    continue
+                # stored is what the database will hold once the batch being written is written.
+                if key in self._pending:
+                    stored, liked = self._pending.pop(key)
+                    self._deltas[post_id] -= liked - stored
+                    if not self._deltas[post_id]:
+                        del self._deltas[post_id]
+                elif key in self._flushing:
+                    stored = liked = self._flushing[key][1]
+                else:
+                    stored = liked
+                wanted = not liked
+                if wanted != stored:
+                    self._pending[key] = (stored, wanted)
+                    self._deltas[post_id] += wanted - stored
+                    if not self._deltas[post_id]:
+                        del self._deltas[post_id]
+                if self._journal is not None:
+                    self._journal.write('{} {} {:d}\n'.format(user_id, post_id, wanted))
+                    self._journal.flush()
+                    self._journal_writes += 1
+                    written = self._journal_writes
+                full = len(self._pending) >= self.size
+            break
+
+        if self._journal is not None:
+            self._sync_journal(written)
+        if full:
+            self._full.set()
+
+    def pending(self, post_id):
+        with self._lock:
+            return self._deltas[post_id]
+
+    # Writes every buffered like to the database in one transaction.
+    def flush(self):
+        # A forked process has a copy of its parent's buffer, which is the parent's to write.
+        if os.getpid() != self.pid:
+            return
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+
+            batch = self._flushing
+            try:
+                with self.app.app_context():
+                    write_likes([(user_id, post_id, wanted) for (user_id, post_id), (stored, wanted) in batch.items()])
+                    publish_likes(set(post_id for user_id, post_id in batch))
+            except Exception:
+                logger.exception('Failed to write %d likes, will try again', len(batch))
+                with self._lock:
+                    # Put the batch back. If the same like was toggled again meanwhile, the newer
+                    # toggle wins, and if that toggled it back, there's nothing left to write.
+                    for key, (stored, wanted) in batch.items():
+                        if key in self._pending:
+                            wanted = self._pending[key][1]
+                        if wanted != stored:
+                            self._pending[key] = (stored, wanted)
+                        else:
+                            self._pending.pop(key, None)
+                    self._flushing = {}
+                return
+
+            with self._lock:
+                # The likes are in posts.like_count now, so stop adding them on.
+                for (user_id, post_id), (stored, wanted) in batch.items():
+                    self._deltas[post_id] -= wanted - stored
+                    if not self._deltas[post_id]:
+                        del self._deltas[post_id]
+                self._flushing = {}
+                self._flushes += 1
+                if self._journal is not None:
+                    # Keep only the likes that still haven't been written.
+                    with self._journal_lock:
+                        self._journal.seek(0)
+                        self._journal.truncate()
+                        for (user_id, post_id), (stored, wanted) in self._pending.items():
+                            self._journal.write('{} {} {:d}\n'.format(user_id, post_id, wanted))
+                        self._journal.flush()
+                        self._journal_writes += 1
+                        written = self._journal_writes
+
+            if self._journal is not None:
+                self._sync_journal(written)
+
+    # Returns once the journal is on disk up to (at least) its written'th write.
+    def _sync_journal(self, written):
+        with self._journal_lock:
+            if self._journal_synced >= written:
+                return
+            # Everything written up to now is covered by this fsync, not just ours.
+            written = self._journal_writes
+            os.fsync(self._journal.fileno())
+            self._journal_synced = written
+
+    def _run(self):
+        while True:
+            self._full.wait(self.interval)
+            self._full.clear()
+            self.flush()
+
+
+# Writes out the journals left behind by workers that are no longer running. Runs before the app
+# serves anything (see create_app() and boot.warm_worker()), so the connection it writes with has
+# no request's transaction on it. A journal that can't be written is logged and left for next time.
+def recover_journals(app):
+    if app.config['LIKE_BUFFER'] != 'journal':
+        return
+    directory = app.config['LIKE_JOURNAL_DIR']
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if not name.endswith('.journal'):
+            continue
+        pid = int(name.split('.')[0])
+        # This process hasn't written a journal yet, so one with its pid is from an earlier one.
+        if pid != os.getpid() and process_exists(pid):
+            continue
+        path = os.path.join(directory, name)
+        likes = {}
+        try:
+            with open(path, encoding='utf8') as journal:
+                for line in journal:
+                    fields = line.split()
+                    # A worker killed part way through a line leaves it incomplete.
+                    if len(fields) == 3:
+                        user_id, post_id, wanted = map(int, fields)
+                        likes[(user_id, post_id)] = bool(wanted)
+        except FileNotFoundError:
+            # Another worker that started at the same time got to it first.
+            continue
+        try:
+            with app.app_context():
+                write_likes([(user_id, post_id, wanted) for (user_id, post_id), wanted in likes.items()])
+        except Exception:
+            logger.exception('Failed to recover %d likes from %s', len(likes), path)
+            continue
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        logger.info('Recovered %d likes from %s', len(likes), path)
+
+
+def init_app(app):
+    recover_journals(app)
+
+
+# Writes a batch of (user_id, post_id, should be liked) in one transaction. Each one says what the
+# like should end up as, rather than flipping it, so writing the same batch twice does no harm.
+def write_likes(likes):
+    db = get_db()
+    with db:
+        # Posts can be deleted while their likes are waiting to be written.
+        db.executemany('''
+            INSERT INTO post_like_assoc(user_id, post_id)
+            SELECT ?, id
+            FROM posts
+            WHERE id = ?
+            ON CONFLICT DO NOTHING;
+        ''', [(user_id, post_id) for user_id, post_id, wanted in likes if wanted])
+        db.executemany('''
+            DELETE FROM post_like_assoc
+            WHERE user_id = ?
+                AND post_id = ?;
+        ''', [(user_id, post_id) for user_id, post_id, wanted in likes if not wanted])
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,162 @@
+#
+#   loader.py
+#       Looks up dens and posts for the current request, remembering everything it has looked up,
+#       so that one page never asks the database for the same row twice, and rows that are needed
+#       together are fetched together.
+#
+
+# Without this, each helper a view calls runs its own query. A post's page used to look up the den,
+# the post, and the post's like count one at a time, and any helper that needed the den again
+# queried it again. With the loader:
+#   • every row is fetched at most once per request, and handed back from memory after that
+#     (an "identity map"). Rows that don't exist are remembered too, as None,
+#   • a post and its den, or a den and whether you follow it, come back from one JOIN.
+# Lists of posts and comments already come with their authors and like counts from the query that
+# lists them, so there's nothing for the loader to batch there.
+#
+# The loader lives on g, and is thrown away at the end of every request (see init_app()), so it
+# never serves stale rows to the next one. Views that write should do so before looking rows up.
+
+from flask import g
+
+from bobchat.db import get_db
+
+DEN_COLUMNS = '''
+    dens.id,
+    dens.name,
+    dens.description,
+    dens.created,
+    dens.author_id,
+    den_authors.username
+'''
+
+POST_COLUMNS = '''
+    posts.id,
+    posts.den_id,
+    posts.author_id,
+    posts.created,
+    posts.title,
+    posts.body,
+    posts.like_count,
+    posts.comment_count,
+    post_authors.username
+'''
+
+
+# Returns the loader for the current request.
+def get_loader():
+    if 'loader' not in g:
+        g.loader = Loader()
+    return g.loader
+
+
+class Loader:
+    def __init__(self):
+        self.dens = {}
+        self.posts = {}
+        # (user_id, den_id) -> whether that user follows that den.
+        self.follows = {}
+
+    # Returns a den (with its author's username), or None if there isn't one with that id.
+    def den(self, den_id):
+        if den_id not in self.dens:
+            row = get_db().execute('''
+                SELECT {}
+                FROM dens
+                    JOIN users AS den_authors ON den_authors.id = dens.author_id
+                WHERE dens.id = ?;
+            '''.format(DEN_COLUMNS), (den_id,)).fetchone()
+            self.dens[den_id] = None if row is None else dict(row)
+        return self.dens[den_id]
+
+    # Returns a post (with its author's username), or None if there isn't one with that id.
+    def post(self, post_id):
+        if post_id not in self.posts:
+            row = get_db().execute('''
+                SELECT {}
+                FROM posts
+                    JOIN users AS post_authors ON post_authors.id = posts.author_id
+                WHERE posts.id = ?;
+            '''.format(POST_COLUMNS), (post_id,)).fetchone()
+            self.posts[post_id] = None if row is None else dict(row)
+        return self.posts[post_id]
+
+    # Fetches a post again, for when this request has just changed it, and returns it like post().
+    def reload_post(self, post_id):
+        self.posts.pop(post_id, None)
+        return self.post(post_id)
+
+    # Fetches a post together with the den it's in, in one query, and returns them as (den, post).
+    # If the post doesn't exist, or isn't in that den, the post is None.
+    def post_in_den(self, den_id, post_id):
+        if post_id not in self.posts or den_id not in self.dens:
+            row = get_db().execute('''
+                SELECT {},
+                    {}
+                FROM posts
+                    JOIN users AS post_authors ON post_authors.id = posts.author_id
+                    JOIN dens ON dens.id = posts.den_id
+                    JOIN users AS den_authors ON den_authors.id = dens.author_id
+                WHERE posts.id = ?;
+            '''.format(prefixed(POST_COLUMNS, 'post_'), prefixed(DEN_COLUMNS, 'den_')),
+                (post_id,)).fetchone()
+            if row is None:
+                self.posts[post_id] = None
+            else:
+                post = unprefixed(row, 'post_')
+                self.posts[post_id] = post
+                self.dens[post['den_id']] = unprefixed(row, 'den_')
+
+        post = self.posts[post_id]
+        if post is not None and post['den_id'] != den_id:
+            post = None
+        return self.den(den_id), post
+
+    # Fetches a den together with whether user_id follows it, in one query, and returns them as
+    # (den, following).
+    def den_for_user(self, den_id, user_id):
+        key = (user_id, den_id)
+        if key not in self.follows or den_id not in self.dens:
+            row = get_db().execute('''
+                SELECT {},
+                    EXISTS (
+                        SELECT 1
+                        FROM user_den_assoc
+                        WHERE user_den_assoc.user_id = ?
+                            AND user_den_assoc.den_id = dens.id
+                    ) AS following
+                FROM dens
+                    JOIN users AS den_authors ON den_authors.id = dens.author_id
+                WHERE dens.id = ?;
+            '''.format(DEN_COLUMNS), (user_id, den_id)).fetchone()
+            if row is None:
+                self.dens[den_id] = None
+                self.follows[key] = False
+            else:
+                den = dict(row)
+                self.follows[key] = bool(den.pop('following'))
+                self.dens[den_id] = den
+        return self.dens[den_id], self.follows[key]
+
+
+# Renames every column in a SELECT list, so that two tables' columns can share one row:
+# 'dens.id' becomes 'dens.id AS den_id'.
+def prefixed(columns, prefix):
+    names = [column.strip() for column in columns.split(',')]
+    return ', '.join('{} AS {}{}'.format(name, prefix, name.split('.')[1]) for name in names)
+
+
+# Picks the columns with the given prefix out of a row, as a dict without the prefix.
+def unprefixed(row, prefix):
+    return dict((key[len(prefix):], row[key]) for key in row.keys() if key.startswith(prefix))
+
+
+# Drops the request's loader when the request ends. g usually goes away with the request anyway,
+# but not when requests are made with the test client inside an app context, like
+# `flask check-query-plans` does, and then every request would share one loader.
+def close_loader(e=None):
+    g.pop('loader', None)
+
+
+def init_app(app):
+    app.teardown_request(close_loader)
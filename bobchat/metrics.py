@@ -0,0 +1,531 @@
+#
+#   metrics.py
+#       Measures where each request's time goes: how many queries it ran, how long they took,
+#       which one was slowest, and how long its templates took to render. The totals are served
+#       at /metrics in Prometheus' text format, and queries slower than METRICS_SLOW_QUERY are logged.
+#
+
+# The database connections get_db() hands out time every statement they run (see
+# InstrumentedConnection), and add it to the stats of the request being served on that thread.
+# Flask's template signals time the rendering. When the request is done, its stats are:
+#   • added to this worker's histograms, labelled with the route (the view's endpoint),
+#   • sent back in a Server-Timing header, so the browser's developer tools show them
+#     for any single page. See: https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Server-Timing
+#   • logged at DEBUG level, along with which statement was the slowest, so turning on debug
+#     logging for bobchat.metrics shows what to look at first on each page.
+#
+# Every worker keeps its own histograms, and writes them to a file in METRICS_DIR at most every
+# METRICS_FLUSH_INTERVAL seconds. /metrics adds up every file in that directory, so whichever
+# worker Prometheus reaches reports the whole site. When a worker has exited, the next /metrics
+# adds its file into exited.json and deletes it, so the totals never go backwards, and the files of
+# long-gone workers don't pile up.
+#
+# /metrics is only served to requests from this machine, unless METRICS_TOKEN is set, in which case
+# it's served to anyone who sends the token. Behind a proxy on the same machine every request looks
+# local, so set METRICS_TOKEN there.
+# See: https://prometheus.io/docs/instrumenting/exposition_formats/
+#
+# All of this costs a few microseconds per query, which is small next to the query itself, so
+# it's meant to be left on in production. Set METRICS_ENABLED to False to turn it off.
+
+import atexit
+import contextlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from flask import Response, abort, before_render_template, current_app, request, template_rendered
+
+from bobchat.streaming import is_streaming
+
+# Only used to tell which workers have exited, which needs a POSIX system (as gunicorn does).
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Bucket upper bounds, in seconds for the timings.
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# The histograms and counters /metrics reports: name -> (type, help, label names, buckets).
+METRICS = {
+    'bobchat_requests_total': (
+        'counter', 'Requests served.', ('endpoint', 'method', 'status'), None),
+    'bobchat_request_duration_seconds': (
+        'histogram', 'Time spent serving a request.', ('endpoint', 'method'), TIME_BUCKETS),
+    'bobchat_request_queries': (
+        'histogram', 'SQL statements run by a request.', ('endpoint',), QUERY_BUCKETS),
+    'bobchat_request_sql_seconds': (
+        'histogram', 'Time a request spent running SQL.', ('endpoint',), TIME_BUCKETS),
+    'bobchat_request_slowest_query_seconds': (
+        'histogram', 'Time taken by the slowest SQL statement of a request.', ('endpoint',), TIME_BUCKETS),
+    'bobchat_request_render_seconds': (
+        'histogram', 'Time a request spent rendering templates.', ('endpoint',), TIME_BUCKETS),
+    'bobchat_slow_queries_total': (
+        'counter', 'SQL statements slower than METRICS_SLOW_QUERY.', ('endpoint',), None),
+    'bobchat_password_hash_queue_seconds': (
+        'histogram', 'Time a password waited for a hashing thread.', ('operation',), TIME_BUCKETS),
+    'bobchat_password_hash_seconds': (
+        'histogram', 'Time taken to hash a password.', ('operation',), TIME_BUCKETS),
+    'bobchat_password_hash_rejected_total': (
+        'counter', 'Passwords turned away because too many were waiting to be hashed.', ('operation',), None),
+}
+
+# The stats of the request each thread is serving, or None outside of a request.
+_local = threading.local()
+
+
+# What one request has done so far.
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql = 0.0
+        self.slowest = 0.0
+        self.slowest_sql = None
+        self.slow_queries = 0
+        self.render = 0.0
+        # Templates can render other templates, e.g. through cached_fragment(). Only the
+        # outermost one is timed, so nothing is counted twice.
+        self.render_depth = 0
+        self.render_started = None
+
+
+def current_stats():
+    return getattr(_local, 'stats', None)
+
+
+# Times every statement a cursor runs, including fetching its rows. Rows read by iterating over the
+# cursor directly aren't timed, but the time to produce the first of them is. Mixed into the cursor
+# classes of each database driver: InstrumentedCursor here, and postgres.InstrumentedPostgresCursor.
+class TimedCursor:
+    sql = None
+    elapsed = 0.0
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._started(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._started(sql, time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._fetched(time.perf_counter() - start)
+
+    def fetchmany(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(*args, **kwargs)
+        finally:
+            self._fetched(time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._fetched(time.perf_counter() - start)
+
+    def _started(self, sql, elapsed):
+        self.sql = sql
+        self.elapsed = 0.0
+        stats = current_stats()
+        if stats is not None:
+            stats.queries += 1
+        self._fetched(elapsed)
+
+    # Adds time spent on the cursor's current statement.
+    def _fetched(self, elapsed):
+        before = self.elapsed
+        self.elapsed += elapsed
+        stats = current_stats()
+        if stats is not None:
+            stats.sql += elapsed
+            if self.elapsed > stats.slowest:
+                stats.slowest = self.elapsed
+                stats.slowest_sql = self.sql
+
+        # Logged once per statement, as soon as it's slow, since we can't tell when it's finished.
+        threshold = self.connection.slow_query
+        if threshold is not None and before < threshold <= self.elapsed:
+            if stats is not None:
+                stats.slow_queries += 1
+            logger.warning('Slow query (%.1f ms) in %s: %s', self.elapsed * 1000,
+                           request.endpoint if stats is not None else 'command', normalize(self.sql))
+
+
+class InstrumentedCursor(TimedCursor, sqlite3.Cursor):
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            self._started(sql_script, time.perf_counter() - start)
+
+
+# Counts a connection's commits as SQL time, since that's when a write waits for the disk.
+class TimedConnection:
+    # Statements that take at least this many seconds are logged. None turns the log off.
+    slow_query = None
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            stats = current_stats()
+            if stats is not None:
+                stats.sql += time.perf_counter() - start
+
+
+# A SQLite connection whose statements are all run through an InstrumentedCursor.
+class InstrumentedConnection(TimedConnection, sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection's own shortcuts make a plain cursor, rather than calling cursor().
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+# Turns a statement into the shape it has for every set of parameters, so the log can be grouped:
+# literals become ?, lists of them become (...), and the whitespace is squeezed onto one line.
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+SPACE = re.compile(r'\s+')
+
+
+def normalize(sql):
+    sql = STRING.sub('?', sql)
+    sql = NUMBER.sub('?', sql)
+    sql = LIST.sub('(...)', sql)
+    return SPACE.sub(' ', sql).strip()
+
+
+# One worker's histograms and counters.
+class Registry:
+    def __init__(self, directory, flush_interval):
+        self.pid = os.getpid()
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.flushed = time.monotonic()
+        # name -> {label values: [count in each bucket..., count above the last bucket, sum]},
+        # or for a counter, name -> {label values: [value]}.
+        self.values = dict((name, {}) for name in METRICS)
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][3]
+        with self._lock:
+            series = self.values[name].get(labels)
+            if series is None:
+                series = self.values[name][labels] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(buckets)
+            series[i] += 1
+            series[-1] += value
+
+    def increment(self, name, labels, amount=1):
+        with self._lock:
+            series = self.values[name].setdefault(labels, [0])
+            series[0] += amount
+
+    # Returns the values as JSON-friendly lists of [label values, series].
+    def snapshot(self):
+        with self._lock:
+            return dict((name, [[list(labels), list(series)] for labels, series in values.items()])
+                        for name, values in self.values.items())
+
+    # Writes this worker's values to its file in METRICS_DIR.
+    def flush(self):
+        if os.getpid() != self.pid:
+            return
+        self.flushed = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}.json'.format(self.pid))
+        with open(path + '.tmp', 'w', encoding='utf8') as file:
+            json.dump(self.snapshot(), file)
+        # Replacing the file all at once means /metrics never reads half of one.
+        os.replace(path + '.tmp', path)
+
+    def maybe_flush(self):
+        if time.monotonic() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    # Adds up this worker's values and the last ones every other worker wrote.
+    def collect(self):
+        snapshots = [self.snapshot()]
+        own = '{}.json'.format(self.pid)
+        with directory_lock(self.directory):
+            reap(self.directory)
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    if name.endswith('.json') and name != own:
+                        snapshot = read_snapshot(os.path.join(self.directory, name))
+                        if snapshot is not None:
+                            snapshots.append(snapshot)
+        return add_up(snapshots)
+
+
+# The file that holds the sum of every exited worker's values.
+EXITED = 'exited.json'
+
+
+# Adds up snapshots (see Registry.snapshot()) into name -> {label values: series}.
+def add_up(snapshots):
+    totals = dict((name, {}) for name in METRICS)
+    for snapshot in snapshots:
+        for name, values in snapshot.items():
+            if name not in totals:
+                continue
+            for labels, series in values:
+                labels = tuple(labels)
+                total = totals[name].get(labels)
+                if total is None or len(total) != len(series):
+                    totals[name][labels] = list(series)
+                else:
+                    totals[name][labels] = [a + b for a, b in zip(total, series)]
+    return totals
+
+
+def read_snapshot(path):
+    try:
+        with open(path, encoding='utf8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+# Keeps other workers from reading or reaping METRICS_DIR while this one reaps it, so no worker's
+# values are ever counted twice, or lost. Without fcntl, nothing is reaped, so there's nothing to lock.
+@contextlib.contextmanager
+def directory_lock(directory):
+    if fcntl is None or not os.path.isdir(directory):
+        yield
+        return
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It's running, as another user.
+        return True
+    return True
+
+
+# Adds the files of workers that have exited into EXITED, and deletes them.
+# Must be called with the directory locked.
+def reap(directory):
+    if fcntl is None or not os.path.isdir(directory):
+        return
+    exited = []
+    for name in os.listdir(directory):
+        pid = name[:-len('.json')]
+        if name.endswith('.json') and pid.isdigit() and not is_running(int(pid)):
+            exited.append(name)
+    if not exited:
+        return
+
+    path = os.path.join(directory, EXITED)
+    snapshots = [read_snapshot(os.path.join(directory, name)) for name in [EXITED] + exited]
+    totals = add_up(snapshot for snapshot in snapshots if snapshot is not None)
+    with open(path + '.tmp', 'w', encoding='utf8') as file:
+        json.dump(dict((name, [[list(labels), series] for labels, series in values.items()])
+                       for name, values in totals.items()), file)
+    os.replace(path + '.tmp', path)
+    for name in exited:
+        os.remove(os.path.join(directory, name))
+
+
+# Returns this worker's registry. A worker forked from a process that had one starts its own.
+def get_registry():
+    registry = current_app.extensions.get('bobchat.metrics')
+    if registry is None or registry.pid != os.getpid():
+        registry = current_app.extensions['bobchat.metrics'] = Registry(
+            current_app.config['METRICS_DIR'], current_app.config['METRICS_FLUSH_INTERVAL'])
+    return registry
+
+
+# Adds a value to one of the histograms in METRICS, from anywhere that has an app context.
+def observe(name, labels, value):
+    if current_app.config['METRICS_ENABLED']:
+        get_registry().observe(name, labels, value)
+
+
+# Adds to one of the counters in METRICS, from anywhere that has an app context.
+def increment(name, labels, amount=1):
+    if current_app.config['METRICS_ENABLED']:
+        get_registry().increment(name, labels, amount)
+
+
+# Renders every metric in Prometheus' text format.
+def render(totals):
+    lines = []
+    for name, (kind, help, labelnames, buckets) in METRICS.items():
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, series in sorted(totals[name].items()):
+            pairs = list(zip(labelnames, labels))
+            if kind == 'counter':
+                lines.append('{}{} {}'.format(name, format_labels(pairs), format_value(series[0])))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), series):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(pairs + [('le', format_value(bound))]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(pairs), format_value(series[-1])))
+            lines.append('{}_count{} {}'.format(name, format_labels(pairs), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(pairs):
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def start_request():
+    _local.stats = RequestStats()
+
+
+def start_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        if stats.render_depth == 0:
+            stats.render_started = time.perf_counter()
+        stats.render_depth += 1
+
+
+def finish_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats.render_depth:
+        stats.render_depth -= 1
+        if stats.render_depth == 0:
+            stats.render += time.perf_counter() - stats.render_started
+
+
+def finish_request(response):
+    stats = current_stats()
+    if stats is None:
+        return response
+    registry = get_registry()
+    endpoint = request.endpoint or 'none'
+    labels = (endpoint, request.method, str(response.status_code))
+
+    # A streamed page (see streaming.py) runs most of its queries and rendering after this, while
+    # it's being sent, so it's recorded once it's done. Its headers are gone by then, so it doesn't
+    # get a Server-Timing header.
+    if is_streaming():
+        response.call_on_close(lambda: record_request(registry, labels, stats))
+        return response
+
+    duration = record_request(registry, labels, stats)
+    response.headers['Server-Timing'] = 'sql;dur={:.1f};desc="{} queries", render;dur={:.1f}, total;dur={:.1f}'.format(
+        stats.sql * 1000, stats.queries, stats.render * 1000, duration * 1000)
+    return response
+
+
+# Adds a finished request to the registry, and returns how long it took.
+def record_request(registry, labels, stats):
+    duration = time.perf_counter() - stats.started
+    endpoint, method, status = labels
+    registry.increment('bobchat_requests_total', labels)
+    registry.observe('bobchat_request_duration_seconds', (endpoint, method), duration)
+    registry.observe('bobchat_request_queries', (endpoint,), stats.queries)
+    registry.observe('bobchat_request_sql_seconds', (endpoint,), stats.sql)
+    registry.observe('bobchat_request_slowest_query_seconds', (endpoint,), stats.slowest)
+    registry.observe('bobchat_request_render_seconds', (endpoint,), stats.render)
+    if stats.slow_queries:
+        registry.increment('bobchat_slow_queries_total', (endpoint,), stats.slow_queries)
+    if stats.slowest_sql is not None:
+        logger.debug('%s %s %s in %.1f ms: %d queries in %.1f ms, render %.1f ms, slowest (%.1f ms): %s',
+                     method, endpoint, status, duration * 1000, stats.queries, stats.sql * 1000,
+                     stats.render * 1000, stats.slowest * 1000, normalize(stats.slowest_sql))
+    return duration
+
+
+def close_request(e=None):
+    # Keep counting a streamed page's queries until it's sent. This runs again then.
+    if is_streaming():
+        return
+    _local.stats = None
+    if 'bobchat.metrics' in current_app.extensions:
+        get_registry().maybe_flush()
+
+
+# Serves every worker's metrics to Prometheus. If METRICS_TOKEN is set, the scraper has to send it
+# as a bearer token, e.g. with `authorization: {credentials: ...}` in its scrape config. Otherwise,
+# only requests from this machine are served.
+def metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if token is not None:
+        # Compared in constant time, so how long it takes doesn't give away how much of it was right.
+        # As bytes, since compare_digest() only takes ASCII strings, and the header may not be.
+        sent = request.headers.get('Authorization', '').encode('utf8')
+        if not hmac.compare_digest(sent, ('Bearer ' + token).encode('utf8')):
+            abort(403)
+    elif not is_local(request.remote_addr):
+        abort(403)
+    return Response(render(get_registry().collect()), mimetype='text/plain; version=0.0.4')
+
+
+def is_local(address):
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+
+def init_app(app):
+    if not app.config['METRICS_ENABLED']:
+        return
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(close_request)
+    before_render_template.connect(start_render, app)
+    template_rendered.connect(finish_render, app)
+    app.add_url_rule('/metrics', 'metrics', metrics)
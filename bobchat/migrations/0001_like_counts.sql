@@ -0,0 +1,23 @@
+-- Adds posts.like_count, a denormalized count of post_like_assoc rows, and the triggers
+-- that keep it up to date.
+ALTER TABLE posts ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0;
+UPDATE posts
+SET like_count = (
+        SELECT COUNT(*)
+        FROM post_like_assoc
+        WHERE post_like_assoc.post_id = posts.id
+    );
+CREATE INDEX IF NOT EXISTS posts_den_id_like_count ON posts(den_id, like_count DESC);
+CREATE INDEX IF NOT EXISTS posts_author_id_like_count ON posts(author_id, like_count DESC);
+-- posts.like_count is a denormalized copy of COUNT(*) over post_like_assoc for that post.
+-- These triggers keep it up to date inside the same transaction as the like or unlike,
+-- so pages can read and sort by it without aggregating the likes table.
+-- If it ever drifts, `flask rebuild-counters` recomputes it.
+CREATE TRIGGER IF NOT EXISTS post_like_assoc_insert AFTER INSERT ON post_like_assoc
+BEGIN
+    UPDATE posts SET like_count = like_count + 1 WHERE id = NEW.post_id;
+END;
+CREATE TRIGGER IF NOT EXISTS post_like_assoc_delete AFTER DELETE ON post_like_assoc
+BEGIN
+    UPDATE posts SET like_count = like_count - 1 WHERE id = OLD.post_id;
+END;
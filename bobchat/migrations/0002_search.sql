@@ -0,0 +1,69 @@
+-- Full-text search indexes. These are FTS5 "external content" tables: they only store the
+-- search index, and read the actual text back from the table named in content=.
+-- The triggers below keep each index in step with its table on insert, update and delete.
+-- `flask rebuild-search-index` regenerates them from scratch.
+-- See: https://www.sqlite.org/fts5.html#external_content_tables
+CREATE VIRTUAL TABLE IF NOT EXISTS dens_fts USING fts5(
+    name,
+    description,
+    content='dens',
+    content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS dens_fts_insert AFTER INSERT ON dens
+BEGIN
+    INSERT INTO dens_fts(rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);
+END;
+CREATE TRIGGER IF NOT EXISTS dens_fts_delete AFTER DELETE ON dens
+BEGIN
+    INSERT INTO dens_fts(dens_fts, rowid, name, description) VALUES ('delete', OLD.id, OLD.name, OLD.description);
+END;
+CREATE TRIGGER IF NOT EXISTS dens_fts_update AFTER UPDATE OF name, description ON dens
+BEGIN
+    INSERT INTO dens_fts(dens_fts, rowid, name, description) VALUES ('delete', OLD.id, OLD.name, OLD.description);
+    INSERT INTO dens_fts(rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);
+END;
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+    title,
+    body,
+    content='posts',
+    content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts
+BEGIN
+    INSERT INTO posts_fts(rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END;
+CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts
+BEGIN
+    INSERT INTO posts_fts(posts_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+END;
+-- Only fire when the text changes. posts is also updated by the like counter triggers.
+CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF title, body ON posts
+BEGIN
+    INSERT INTO posts_fts(posts_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+    INSERT INTO posts_fts(rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END;
+-- Usernames are single words like "BethXerxes", so they use the trigram tokenizer,
+-- which matches any substring of 3 or more characters (just like the old LIKE '%term%').
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+    username,
+    content='users',
+    content_rowid='id',
+    tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users
+BEGIN
+    INSERT INTO users_fts(rowid, username) VALUES (NEW.id, NEW.username);
+END;
+CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users
+BEGIN
+    INSERT INTO users_fts(users_fts, rowid, username) VALUES ('delete', OLD.id, OLD.username);
+END;
+CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username ON users
+BEGIN
+    INSERT INTO users_fts(users_fts, rowid, username) VALUES ('delete', OLD.id, OLD.username);
+    INSERT INTO users_fts(rowid, username) VALUES (NEW.id, NEW.username);
+END;
+-- Index everything that was already in the tables.
+INSERT INTO dens_fts(dens_fts) VALUES ('rebuild');
+INSERT INTO posts_fts(posts_fts) VALUES ('rebuild');
+INSERT INTO users_fts(users_fts) VALUES ('rebuild');
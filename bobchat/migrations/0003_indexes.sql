@@ -0,0 +1,11 @@
+-- Secondary indexes for the foreign keys and sort orders our pages look things up by.
+-- Without them, every den page, profile page, comment list and follow check reads the whole table.
+CREATE INDEX IF NOT EXISTS posts_created ON posts(created, id);
+CREATE INDEX IF NOT EXISTS posts_den_id_created ON posts(den_id, created, id);
+CREATE INDEX IF NOT EXISTS dens_author_id ON dens(author_id);
+CREATE INDEX IF NOT EXISTS dens_created ON dens(created);
+CREATE INDEX IF NOT EXISTS user_den_assoc_user_id_den_id ON user_den_assoc(user_id, den_id);
+CREATE INDEX IF NOT EXISTS user_den_assoc_den_id ON user_den_assoc(den_id);
+CREATE INDEX IF NOT EXISTS post_like_assoc_post_id ON post_like_assoc(post_id);
+CREATE INDEX IF NOT EXISTS comments_post_id_created ON comments(post_id, created);
+CREATE INDEX IF NOT EXISTS comments_author_id ON comments(author_id);
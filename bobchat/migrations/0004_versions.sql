@@ -0,0 +1,96 @@
+-- versions holds a counter for each thing a cached page can depend on: 'den:1', 'post:7', 'user:3',
+-- or a whole table such as 'dens'. The triggers below bump a counter whenever a write changes
+-- what it covers. Cached pages are keyed on the counters they depend on, so a write makes the
+-- old copy unreachable in every worker at once. See pagecache.py.
+CREATE TABLE IF NOT EXISTS versions(
+    key TEXT PRIMARY KEY NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    modified DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS dens_versions_insert AFTER INSERT ON dens
+BEGIN
+    INSERT INTO versions(key) VALUES ('dens'), ('den:' || NEW.id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS dens_versions_update AFTER UPDATE OF name, description ON dens
+BEGIN
+    INSERT INTO versions(key) VALUES ('dens'), ('den:' || NEW.id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS dens_versions_delete AFTER DELETE ON dens
+BEGIN
+    INSERT INTO versions(key) VALUES ('dens'), ('den:' || OLD.id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS posts_versions_insert AFTER INSERT ON posts
+BEGIN
+    INSERT INTO versions(key) VALUES ('posts'), ('den:' || NEW.den_id), ('user:' || NEW.author_id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS posts_versions_update AFTER UPDATE OF title, body ON posts
+BEGIN
+    INSERT INTO versions(key)
+    VALUES ('posts'), ('den:' || NEW.den_id), ('post:' || NEW.id), ('user:' || NEW.author_id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS posts_versions_delete AFTER DELETE ON posts
+BEGIN
+    INSERT INTO versions(key)
+    VALUES ('posts'), ('den:' || OLD.den_id), ('post:' || OLD.id), ('user:' || OLD.author_id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+-- A like changes the count shown on the post, its den's page and its author's profile.
+-- When the likes are being deleted because their post was, the post is already gone and the
+-- lookups come back NULL, so those keys are skipped.
+CREATE TRIGGER IF NOT EXISTS post_like_assoc_versions_insert AFTER INSERT ON post_like_assoc
+BEGIN
+    INSERT INTO versions(key)
+    SELECT column1
+    FROM (
+            VALUES ('likes'),
+                ('post:' || NEW.post_id),
+                ('den:' || (SELECT den_id FROM posts WHERE id = NEW.post_id)),
+                ('user:' || (SELECT author_id FROM posts WHERE id = NEW.post_id))
+        )
+    WHERE column1 IS NOT NULL
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS post_like_assoc_versions_delete AFTER DELETE ON post_like_assoc
+BEGIN
+    INSERT INTO versions(key)
+    SELECT column1
+    FROM (
+            VALUES ('likes'),
+                ('post:' || OLD.post_id),
+                ('den:' || (SELECT den_id FROM posts WHERE id = OLD.post_id)),
+                ('user:' || (SELECT author_id FROM posts WHERE id = OLD.post_id))
+        )
+    WHERE column1 IS NOT NULL
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS comments_versions_insert AFTER INSERT ON comments
+BEGIN
+    INSERT INTO versions(key) VALUES ('post:' || NEW.post_id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS comments_versions_delete AFTER DELETE ON comments
+BEGIN
+    INSERT INTO versions(key) VALUES ('post:' || OLD.post_id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS users_versions_insert AFTER INSERT ON users
+BEGIN
+    INSERT INTO versions(key) VALUES ('users')
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+-- Following or unfollowing changes what that user's den pages and feed look like.
+CREATE TRIGGER IF NOT EXISTS user_den_assoc_versions_insert AFTER INSERT ON user_den_assoc
+BEGIN
+    INSERT INTO versions(key) VALUES ('follows:' || NEW.user_id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS user_den_assoc_versions_delete AFTER DELETE ON user_den_assoc
+BEGIN
+    INSERT INTO versions(key) VALUES ('follows:' || OLD.user_id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
@@ -0,0 +1,62 @@
+-- site_stats holds a single row with running totals for the whole site, so the home page
+-- can show them without counting every table. Triggers keep the totals up to date on every
+-- insert and delete, and `flask rebuild-counters` checks them against the real tables.
+-- Every write now also updates this one row, but SQLite only ever has one writer at a time
+-- anyway, so that doesn't add any contention.
+CREATE TABLE IF NOT EXISTS site_stats(
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    users INTEGER NOT NULL DEFAULT 0,
+    posts INTEGER NOT NULL DEFAULT 0,
+    dens INTEGER NOT NULL DEFAULT 0,
+    comments INTEGER NOT NULL DEFAULT 0,
+    likes INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR REPLACE INTO site_stats(id, users, posts, dens, comments, likes)
+VALUES (
+        1,
+        (SELECT COUNT(*) FROM users),
+        (SELECT COUNT(*) FROM posts),
+        (SELECT COUNT(*) FROM dens),
+        (SELECT COUNT(*) FROM comments),
+        (SELECT COUNT(*) FROM post_like_assoc)
+    );
+CREATE TRIGGER IF NOT EXISTS users_site_stats_insert AFTER INSERT ON users
+BEGIN
+    UPDATE site_stats SET users = users + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS users_site_stats_delete AFTER DELETE ON users
+BEGIN
+    UPDATE site_stats SET users = users - 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS posts_site_stats_insert AFTER INSERT ON posts
+BEGIN
+    UPDATE site_stats SET posts = posts + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS posts_site_stats_delete AFTER DELETE ON posts
+BEGIN
+    UPDATE site_stats SET posts = posts - 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS dens_site_stats_insert AFTER INSERT ON dens
+BEGIN
+    UPDATE site_stats SET dens = dens + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS dens_site_stats_delete AFTER DELETE ON dens
+BEGIN
+    UPDATE site_stats SET dens = dens - 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS comments_site_stats_insert AFTER INSERT ON comments
+BEGIN
+    UPDATE site_stats SET comments = comments + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS comments_site_stats_delete AFTER DELETE ON comments
+BEGIN
+    UPDATE site_stats SET comments = comments - 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS post_like_assoc_site_stats_insert AFTER INSERT ON post_like_assoc
+BEGIN
+    UPDATE site_stats SET likes = likes + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS post_like_assoc_site_stats_delete AFTER DELETE ON post_like_assoc
+BEGIN
+    UPDATE site_stats SET likes = likes - 1 WHERE id = 1;
+END;
@@ -0,0 +1,33 @@
+-- dens.follower_count is a denormalized count of user_den_assoc rows for each den, kept up to
+-- date by triggers. It decides whether new posts in a den are copied into its followers'
+-- timelines, or read from the den on demand (see timelines.py).
+ALTER TABLE dens ADD COLUMN follower_count INTEGER NOT NULL DEFAULT 0;
+UPDATE dens
+SET follower_count = (
+        SELECT COUNT(*)
+        FROM user_den_assoc
+        WHERE user_den_assoc.den_id = dens.id
+    );
+CREATE TRIGGER IF NOT EXISTS user_den_assoc_follower_count_insert AFTER INSERT ON user_den_assoc
+BEGIN
+    UPDATE dens SET follower_count = follower_count + 1 WHERE id = NEW.den_id;
+END;
+CREATE TRIGGER IF NOT EXISTS user_den_assoc_follower_count_delete AFTER DELETE ON user_den_assoc
+BEGIN
+    UPDATE dens SET follower_count = follower_count - 1 WHERE id = OLD.den_id;
+END;
+-- timelines holds a copy of each user's feed: one row per post in every den they follow,
+-- filled in when the post is written. Reading a page of the feed is then a range scan of
+-- the primary key. Rows go away along with their post (and so their den) or user.
+-- migrate_db() fills it in for existing databases once this has run.
+CREATE TABLE IF NOT EXISTS timelines(
+    user_id INTEGER NOT NULL,
+    created DATETIME NOT NULL,
+    post_id INTEGER NOT NULL,
+    den_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, created, post_id),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS timelines_post_id ON timelines(post_id);
+CREATE INDEX IF NOT EXISTS timelines_user_id_den_id ON timelines(user_id, den_id);
@@ -0,0 +1,29 @@
+-- Comments can be replies to other comments. parent_id is the comment being replied to, or NULL
+-- for a comment on the post itself. Deleting a comment deletes its replies along with it.
+ALTER TABLE comments ADD COLUMN parent_id INTEGER REFERENCES comments(id) ON DELETE CASCADE;
+-- comments.reply_count and posts.comment_count are denormalized counts kept up to date by the
+-- triggers below, so a post's page can show how big the discussion is, and how many replies
+-- each collapsed thread has, without counting them.
+ALTER TABLE comments ADD COLUMN reply_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE posts ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0;
+UPDATE posts
+SET comment_count = (
+        SELECT COUNT(*)
+        FROM comments
+        WHERE comments.post_id = posts.id
+    );
+CREATE TRIGGER IF NOT EXISTS comments_comment_count_insert AFTER INSERT ON comments
+BEGIN
+    UPDATE posts SET comment_count = comment_count + 1 WHERE id = NEW.post_id;
+    UPDATE comments SET reply_count = reply_count + 1 WHERE id = NEW.parent_id;
+END;
+CREATE TRIGGER IF NOT EXISTS comments_comment_count_delete AFTER DELETE ON comments
+BEGIN
+    UPDATE posts SET comment_count = comment_count - 1 WHERE id = OLD.post_id;
+    UPDATE comments SET reply_count = reply_count - 1 WHERE id = OLD.parent_id;
+END;
+-- A post's page shows one page of its top-level comments, newest first, and each thread's
+-- replies are read a page at a time, oldest first. Both walk one of these indexes from the cursor.
+DROP INDEX IF EXISTS comments_post_id_created;
+CREATE INDEX IF NOT EXISTS comments_post_id_parent_id_created ON comments(post_id, parent_id, created, id);
+CREATE INDEX IF NOT EXISTS comments_parent_id_created ON comments(parent_id, created, id);
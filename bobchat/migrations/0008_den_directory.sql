@@ -0,0 +1,56 @@
+-- The den directory can be sorted by newest, most followed or most active (see dens.index()).
+-- dens.post_count is a denormalized count of each den's posts, kept up to date by the triggers
+-- below like dens.follower_count is.
+ALTER TABLE dens ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0;
+UPDATE dens
+SET post_count = (
+        SELECT COUNT(*)
+        FROM posts
+        WHERE posts.den_id = dens.id
+    );
+-- den_activity counts each den's posts per day (in UTC), so how active a den has been over the
+-- last few days is a sum over a handful of rows, rather than a count over all of its posts.
+-- Days with no posts have no row.
+CREATE TABLE IF NOT EXISTS den_activity(
+    day TEXT NOT NULL,
+    den_id INTEGER NOT NULL,
+    posts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, den_id),
+    FOREIGN KEY (den_id) REFERENCES dens(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS den_activity_den_id ON den_activity(den_id);
+INSERT INTO den_activity(day, den_id, posts)
+SELECT date(created),
+    den_id,
+    COUNT(*)
+FROM posts
+GROUP BY date(created),
+    den_id;
+CREATE TRIGGER IF NOT EXISTS posts_den_counts_insert AFTER INSERT ON posts
+BEGIN
+    UPDATE dens SET post_count = post_count + 1 WHERE id = NEW.den_id;
+    INSERT INTO den_activity(day, den_id, posts) VALUES (date(NEW.created), NEW.den_id, 1)
+    ON CONFLICT(day, den_id) DO UPDATE SET posts = posts + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS posts_den_counts_delete AFTER DELETE ON posts
+BEGIN
+    UPDATE dens SET post_count = post_count - 1 WHERE id = OLD.den_id;
+    UPDATE den_activity SET posts = posts - 1 WHERE day = date(OLD.created) AND den_id = OLD.den_id;
+    DELETE FROM den_activity WHERE day = date(OLD.created) AND den_id = OLD.den_id AND posts = 0;
+END;
+-- The directory shows every den's counters, so following or unfollowing any den changes it.
+DROP TRIGGER IF EXISTS user_den_assoc_versions_insert;
+DROP TRIGGER IF EXISTS user_den_assoc_versions_delete;
+CREATE TRIGGER IF NOT EXISTS user_den_assoc_versions_insert AFTER INSERT ON user_den_assoc
+BEGIN
+    INSERT INTO versions(key) VALUES ('follows:' || NEW.user_id), ('followers')
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS user_den_assoc_versions_delete AFTER DELETE ON user_den_assoc
+BEGIN
+    INSERT INTO versions(key) VALUES ('follows:' || OLD.user_id), ('followers')
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+-- Sorted by followers, the directory walks this index from where the last page left off,
+-- as it walks dens_created sorted by newest.
+CREATE INDEX IF NOT EXISTS dens_follower_count ON dens(follower_count, id);
@@ -0,0 +1,57 @@
+-- See 0008_den_directory.sql in the folder above.
+ALTER TABLE dens ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0;
+UPDATE dens
+SET post_count = (
+        SELECT COUNT(*)
+        FROM posts
+        WHERE posts.den_id = dens.id
+    );
+CREATE TABLE den_activity(
+    day DATE NOT NULL,
+    den_id INTEGER NOT NULL REFERENCES dens(id) ON DELETE CASCADE,
+    posts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, den_id)
+);
+CREATE INDEX den_activity_den_id ON den_activity(den_id);
+INSERT INTO den_activity(day, den_id, posts)
+SELECT created::DATE,
+    den_id,
+    COUNT(*)
+FROM posts
+GROUP BY created::DATE,
+    den_id;
+CREATE OR REPLACE FUNCTION posts_changed() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE dens SET post_count = post_count + 1 WHERE id = NEW.den_id;
+        INSERT INTO den_activity(day, den_id, posts) VALUES (NEW.created::DATE, NEW.den_id, 1)
+        ON CONFLICT(day, den_id) DO UPDATE SET posts = den_activity.posts + 1;
+        PERFORM bump_versions('posts', 'den:' || NEW.den_id, 'user:' || NEW.author_id);
+        UPDATE site_stats_shards SET posts = posts + 1 WHERE shard = site_stats_shard();
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM bump_versions('posts', 'den:' || NEW.den_id, 'post:' || NEW.id, 'user:' || NEW.author_id);
+    ELSE
+        UPDATE dens SET post_count = post_count - 1 WHERE id = OLD.den_id;
+        UPDATE den_activity SET posts = posts - 1 WHERE day = OLD.created::DATE AND den_id = OLD.den_id;
+        DELETE FROM den_activity WHERE day = OLD.created::DATE AND den_id = OLD.den_id AND posts = 0;
+        PERFORM bump_versions('posts', 'den:' || OLD.den_id, 'post:' || OLD.id, 'user:' || OLD.author_id);
+        UPDATE site_stats_shards SET posts = posts - 1 WHERE shard = site_stats_shard();
+    END IF;
+    RETURN NULL;
+END
+$$;
+CREATE OR REPLACE FUNCTION user_den_assoc_changed() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE dens SET follower_count = follower_count + 1 WHERE id = NEW.den_id;
+        PERFORM bump_versions('follows:' || NEW.user_id, 'followers');
+    ELSE
+        UPDATE dens SET follower_count = follower_count - 1 WHERE id = OLD.den_id;
+        PERFORM bump_versions('follows:' || OLD.user_id, 'followers');
+    END IF;
+    RETURN NULL;
+END
+$$;
+DROP INDEX dens_created;
+CREATE INDEX dens_created ON dens(created, id);
+CREATE INDEX dens_follower_count ON dens(follower_count, id);
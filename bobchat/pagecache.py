@@ -0,0 +1,110 @@
+#
+#   pagecache.py
+#       Caches rendered pages and template fragments in each worker, so that pages which are
+#       read far more often than they change don't have to be queried and rendered every time.
+#
+
+# Every cached page names the things it depends on, like 'den:4' or 'post:12'. Each of these
+# has a version counter in the versions table, which triggers bump on every write that changes
+# it (see schema.sql). The counters are part of the cache key, so:
+#   • a cache hit costs one small indexed read of versions, instead of the page's queries
+#     and template rendering,
+#   • after a write, the next request looks for a key that has never been cached, and the old
+#     copy is never served again, in any worker. It just ages out of the LRU.
+# Because the counters are bumped by the database itself, every write path is covered: new posts,
+# edits, comments, likes, den updates and deletes, including rows removed by ON DELETE CASCADE.
+
+import functools
+
+from flask import current_app, g, make_response, request, session
+from markupsafe import Markup
+
+from bobchat.cache import MISSING, LRUCache
+from bobchat.db import get_db
+
+
+# Returns this app's cache of rendered pages.
+def get_page_cache():
+    cache = current_app.extensions.get('bobchat.pages')
+    if cache is None:
+        cache = current_app.extensions['bobchat.pages'] = LRUCache(
+            current_app.config['PAGE_CACHE_SIZE'], maxbytes=current_app.config['PAGE_CACHE_MAX_BYTES'])
+    return cache
+
+
+# Returns the current version of each key, in the same order. Keys that have never been written
+# to aren't in the table yet, and are version 0.
+def get_versions(keys):
+    rows = get_db().execute(
+        'SELECT key, version FROM versions WHERE key IN ({})'.format(', '.join('?' * len(keys))),
+        keys,
+    ).fetchall()
+    versions = dict((row['key'], row['version']) for row in rows)
+    return tuple(versions.get(key, 0) for key in keys)
+
+
+# A page can only be served from the cache if it's a plain GET and there are no flashed
+# messages waiting to be shown on it.
+def cacheable():
+    return (current_app.config['PAGE_CACHE_ENABLED'] and request.method == 'GET'
+            and '_flashes' not in session)
+
+
+# Caches the HTML returned by a view.
+#
+# depends_on is called with the view's arguments and returns the version keys the page depends on.
+# The key also includes the URL (with its query string), and the logged in user, since base.html
+# shows their name and pages show edit links for things they wrote. Anything else about the viewer
+# that changes the page has to be covered by a version key, like 'follows:<user id>'.
+#
+# Redirects and other responses that aren't a plain rendered string are never cached.
+#
+# If the page also shows something this worker knows about before the database does, vary is called
+# with the view's arguments and returns something that changes whenever that does. It's added to
+# the key too. See dens.den_post().
+def cached_page(depends_on, vary=None):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(**kwargs):
+            if not cacheable():
+                return view(**kwargs)
+
+            keys = depends_on(**kwargs)
+            user_id = g.user['id'] if g.user else None
+            cache_key = ('page', request.full_path, user_id, tuple(keys), get_versions(keys))
+            if vary is not None:
+                cache_key += (vary(**kwargs),)
+
+            cache = get_page_cache()
+            html = cache.get(cache_key)
+            if html is MISSING:
+                html = view(**kwargs)
+                if not isinstance(html, str):
+                    return html
+                cache.set(cache_key, html)
+                status = 'MISS'
+            else:
+                status = 'HIT'
+
+            response = make_response(html)
+            response.headers['X-Cache'] = status
+            return response
+
+        return wrapped_view
+
+    return decorator
+
+
+# Returns a fragment of HTML from the cache, calling render() to produce it on a miss.
+# Fragments are shared by every viewer, so render() must not depend on who's logged in.
+def cached_fragment(name, keys, render):
+    if not current_app.config['PAGE_CACHE_ENABLED']:
+        return Markup(render())
+
+    cache = get_page_cache()
+    cache_key = ('fragment', name, tuple(keys), get_versions(keys))
+    html = cache.get(cache_key)
+    if html is MISSING:
+        html = render()
+        cache.set(cache_key, html)
+    return Markup(html)
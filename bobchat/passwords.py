@@ -0,0 +1,107 @@
+#
+#   passwords.py
+#       Hashes and checks passwords according to the PASSWORD_* configuration, on a small pool
+#       of threads per worker, so a rush of logins can't use up every worker the site has.
+#
+
+# Password hashes are slow on purpose: each one takes tens of milliseconds of CPU, so that
+# stolen hashes take forever to crack. That also means a burst of logins, done inline, keeps
+# every worker busy hashing while the rest of the site waits. So instead:
+#   • hashing happens on a pool of PASSWORD_HASH_WORKERS threads in each worker. hashlib lets go
+#     of the GIL while it hashes, so other requests keep being served while it works, but no more
+#     than that many CPUs are ever spent hashing at once,
+#   • up to PASSWORD_HASH_QUEUE more logins can wait for a thread. Past that, logins are turned
+#     away straight away with a 503 and a Retry-After header, rather than queueing forever.
+# How long hashes waited for a thread, how long they took and how many were turned away are
+# reported at /metrics (see metrics.py).
+#
+# PASSWORD_HASH_METHOD and its parameters set how new hashes are made. A stored hash records
+# how it was made, so old ones still check out after the settings change, and each is upgraded
+# to the current settings the next time its user logs in.
+# See: https://cheatsheetseries.owasp.org/cheatsheets/Password_Storage_Cheat_Sheet.html
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from bobchat.metrics import increment, observe
+
+
+# Raised when too many passwords are already waiting to be hashed. Shown as a 503 page.
+class HashingBusy(ServiceUnavailable):
+    description = 'Too many people are logging in right now. Please try again in a moment.'
+
+
+# Returns the werkzeug method string for the configured policy, e.g. 'scrypt:32768:8:1'.
+# It's written out in full, the same way werkzeug records it in the hash, so the two can be compared.
+def hash_method(config):
+    method = config['PASSWORD_HASH_METHOD']
+    if method == 'scrypt':
+        return 'scrypt:{:d}:{:d}:{:d}'.format(
+            config['PASSWORD_SCRYPT_N'], config['PASSWORD_SCRYPT_R'], config['PASSWORD_SCRYPT_P'])
+    if method == 'pbkdf2':
+        return 'pbkdf2:sha256:{:d}'.format(config['PASSWORD_PBKDF2_ITERATIONS'])
+    raise ValueError("PASSWORD_HASH_METHOD must be 'scrypt' or 'pbkdf2', not {!r}".format(method))
+
+
+# Whether a stored hash was made with different settings than the current ones.
+def needs_rehash(stored_hash, config):
+    return stored_hash.split('$', 1)[0] != hash_method(config)
+
+
+# Hashes a new password with the current settings.
+def hash_password(password):
+    return get_hasher().run('hash', generate_password_hash, password, hash_method(current_app.config))
+
+
+# Checks a password against its stored hash.
+def check_password(stored_hash, password):
+    return get_hasher().run('check', check_password_hash, stored_hash, password)
+
+
+# Returns this worker's hashing pool. A worker forked from a process that had one starts its own,
+# since the parent's threads don't exist in the child.
+def get_hasher():
+    hasher = current_app.extensions.get('bobchat.passwords')
+    if hasher is None or hasher.pid != os.getpid():
+        hasher = current_app.extensions['bobchat.passwords'] = Hasher(
+            current_app.config['PASSWORD_HASH_WORKERS'], current_app.config['PASSWORD_HASH_QUEUE'])
+    return hasher
+
+
+class Hasher:
+    def __init__(self, workers, queue_size):
+        self.pid = os.getpid()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        # One slot for each hash that's running or waiting to run.
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    # Runs function(*args) on the pool and returns its result, or raises HashingBusy if the
+    # queue is full. operation labels the metrics: 'hash' or 'check'.
+    def run(self, operation, function, *args):
+        if not self.slots.acquire(blocking=False):
+            increment('bobchat_password_hash_rejected_total', (operation,))
+            raise HashingBusy(retry_after=1)
+
+        queued = time.perf_counter()
+        timings = []
+
+        def task():
+            started = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                timings.extend([started - queued, time.perf_counter() - started])
+
+        try:
+            return self.executor.submit(task).result()
+        finally:
+            self.slots.release()
+            if timings:
+                observe('bobchat_password_hash_queue_seconds', (operation,), timings[0])
+                observe('bobchat_password_hash_seconds', (operation,), timings[1])
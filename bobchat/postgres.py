@@ -0,0 +1,223 @@
+#
+#   postgres.py
+#       The PostgreSQL driver behind get_db(), used when DATABASE_DRIVER is 'postgresql'.
+#       It hands out connections from a pool that look and behave like the sqlite3 ones the
+#       rest of the code was written against, so the same queries run on either database.
+#
+
+# SQLite lets one process write at a time, on one machine. With the database on a PostgreSQL
+# server instead, any number of web servers can share it, each running its own workers.
+#
+# What the rest of the code relies on, and how it's provided here:
+#   • queries are written with ? placeholders, like sqlite3 wants. They're rewritten to psycopg's
+#     %s once per distinct statement (see translate()),
+#   • rows can be read by column name or by position, and turned into dicts, like sqlite3.Row,
+#   • timestamps come back as the same 'YYYY-MM-DD HH:MM:SS' text SQLite stores, so cursors in
+#     URLs, templates and the API look the same on both,
+#   • `with db:` commits on success and rolls back on an error, and db.IntegrityError and
+#     db.Error are the exceptions the connection raises.
+# The SQL itself sticks to what both databases understand (ON CONFLICT rather than INSERT OR
+# IGNORE, RETURNING rather than lastrowid, and so on). The few queries that can't, like full-text
+# search, check get_driver() and pick their own. The schema is in schema_postgresql.sql.
+#
+# Each worker keeps a pool of POSTGRES_POOL_MIN_SIZE to POSTGRES_POOL_MAX_SIZE open connections, and
+# a request borrows one for as long as it runs, the way it gets a thread's open connection with
+# SQLite. Once a connection has run the same statement POSTGRES_PREPARE_THRESHOLD times, psycopg
+# prepares it on the server, so after that it's planned once per connection instead of every time.
+# See: https://www.psycopg.org/psycopg3/docs/advanced/prepare.html
+#
+# Needs psycopg and psycopg_pool: pip install -e .[postgresql]
+
+import functools
+import os
+import re
+import threading
+import time
+
+import psycopg
+from flask import current_app
+from psycopg.types.string import TextLoader
+from psycopg_pool import ConnectionPool
+
+from bobchat.metrics import TimedConnection, TimedCursor
+
+# The parts of a statement that ? and % mean something different in: quoted strings and
+# identifiers, and comments. Then the characters themselves.
+TOKENS = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/|\?|%""", re.DOTALL)
+
+
+# Rewrites a statement with ? placeholders into one with psycopg's %s placeholders.
+# psycopg reads % anywhere in the statement as the start of a placeholder, so every other % has to
+# be doubled, even in strings and comments. A ? inside a string or comment is left alone.
+@functools.lru_cache(maxsize=1024)
+def translate(sql):
+    def replace(match):
+        token = match.group()
+        if token == '?':
+            return '%s'
+        return token.replace('%', '%%')
+    return TOKENS.sub(replace, sql)
+
+
+# A row that can be read by column name or by position, like sqlite3.Row.
+class Row:
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns, values):
+        self._columns = columns
+        self._values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._values[self._columns[key]]
+        return self._values[key]
+
+    def keys(self):
+        return list(self._columns)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        return isinstance(other, Row) and self._columns == other._columns and self._values == other._values
+
+    def __repr__(self):
+        return 'Row({!r})'.format(dict(zip(self._columns, self._values)))
+
+
+def row_factory(cursor):
+    columns = {}
+    for position, column in enumerate(cursor.description or ()):
+        # Like sqlite3.Row, a name that's in the result twice means the first of them.
+        columns.setdefault(column.name, position)
+    return functools.partial(Row, columns)
+
+
+class PostgresCursor(psycopg.Cursor):
+    def execute(self, sql, parameters=()):
+        return super().execute(translate(sql), parameters)
+
+    # Returns the cursor, like sqlite3 does, rather than None. Its rowcount is the total.
+    def executemany(self, sql, seq_of_parameters):
+        super().executemany(translate(sql), seq_of_parameters)
+        return self
+
+    # Runs several statements at once, like sqlite3's executescript(). Without any parameters,
+    # psycopg sends the text as it is, so % and ? don't need translating.
+    def executescript(self, sql_script):
+        return psycopg.Cursor.execute(self, sql_script)
+
+
+# A cursor that times its statements for /metrics, used when METRICS_ENABLED (see metrics.py).
+class InstrumentedPostgresCursor(TimedCursor, PostgresCursor):
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            self._started(sql_script, time.perf_counter() - start)
+
+
+class PostgresConnection(TimedConnection, psycopg.Connection):
+    # The exceptions queries can raise, under the same names sqlite3 connections have.
+    Error = psycopg.Error
+    IntegrityError = psycopg.IntegrityError
+
+    # sqlite3 connections have these shortcuts, which make a cursor and run one statement on it.
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    @property
+    def in_transaction(self):
+        return self.info.transaction_status != psycopg.pq.TransactionStatus.IDLE
+
+    # `with db:` wraps a transaction, like sqlite3: it commits if the block finishes and rolls back
+    # if it raises. psycopg's own `with` closes the connection instead, which would take it away
+    # from the pool.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+
+# Sets up each connection as the pool opens it.
+def configure(config, db):
+    db.row_factory = row_factory
+    # Read timestamps as text, the way SQLite stores them.
+    db.adapters.register_loader('timestamp', TextLoader)
+    if config['METRICS_ENABLED']:
+        db.cursor_factory = InstrumentedPostgresCursor
+        db.slow_query = config['METRICS_SLOW_QUERY']
+    else:
+        db.cursor_factory = PostgresCursor
+
+
+_pool_lock = threading.Lock()
+
+
+# Returns this worker's pool, opening it the first time. A worker forked from a process that had
+# a pool opens its own, since the parent's connections are still the parent's.
+# The first requests a worker serves can arrive at once, on several threads. Only one of them may
+# open the pool: a connection borrowed from one pool can't be handed back to another.
+def get_pool():
+    pool = current_app.extensions.get('bobchat.postgres')
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            return _open_pool()
+    return pool
+
+
+def _open_pool():
+    pool = current_app.extensions.get('bobchat.postgres')
+    if pool is None or pool.pid != os.getpid():
+        config = current_app.config
+        pool = ConnectionPool(
+            config['POSTGRES_DSN'],
+            connection_class=PostgresConnection,
+            kwargs={'prepare_threshold': config['POSTGRES_PREPARE_THRESHOLD']},
+            configure=functools.partial(configure, config),
+            min_size=config['POSTGRES_POOL_MIN_SIZE'],
+            max_size=config['POSTGRES_POOL_MAX_SIZE'],
+            timeout=config['POSTGRES_POOL_TIMEOUT'],
+            name='bobchat',
+            open=True,
+        )
+        pool.pid = os.getpid()
+        current_app.extensions['bobchat.postgres'] = pool
+    return pool
+
+
+# Borrows a connection from the pool. Waits up to POSTGRES_POOL_TIMEOUT seconds if they're all in use.
+def connect():
+    return get_pool().getconn()
+
+
+# Hands a connection back to the pool, rolling back anything left uncommitted first.
+def release(db):
+    if db.in_transaction:
+        db.rollback()
+    get_pool().putconn(db)
+
+
+# Sets each table's id sequence to carry on after the largest id in it. Rows inserted with their
+# ids given, like the seed data, don't move the sequence along, and the next insert would clash.
+def reset_sequences(db, table_names):
+    for table_name in table_names:
+        db.execute("""
+            SELECT setval(pg_get_serial_sequence(?, 'id'), COALESCE(MAX(id), 0) + 1, false)
+            FROM {};
+        """.format(table_name), (table_name,))
@@ -8,6 +8,9 @@ from werkzeug.exceptions import abort
 
 from bobchat.auth import login_required
 from bobchat.db import get_db
+from bobchat.events import publish
+from bobchat.loader import get_loader
+from bobchat.timelines import fan_out_post
 
 #
 # TODO: It would be nice if we could nest this blueprint off of the dens blueprint.
@@ -49,20 +52,25 @@ def delete(comment_id):
 @login_required
 def create(den_id):
     db = get_db()
-    den = db.execute('''SELECT *
-                        FROM dens
-                        WHERE id= ?''', (den_id,)).fetchone()
+    den = get_loader().den(den_id)
+    if den is None:
+        abort(404)
 
     if request.method == 'GET':
         return render_template('posts/create.html', den=den)
     else:
         title = request.form['title']
         body = request.form['body']
-        db.execute('''
+        post_id = db.execute('''
             INSERT INTO posts(author_id, den_id, title, body)
             VALUES(?, ?, ?, ?)
-        ''', (g.user['id'], den_id, title, body,))
+            RETURNING id
+        ''', (g.user['id'], den_id, title, body,)).fetchone()['id']
+        # Put the new post in the feed of everyone following the den, in the same transaction.
+        fan_out_post(post_id)
         db.commit()
+        publish(['den:{}'.format(den_id)],
+                {'type': 'post', 'den_id': den_id, 'post_id': post_id, 'title': title})
         return redirect(url_for('dens.den', den_id=den_id))
 
 
@@ -71,17 +79,15 @@ def create(den_id):
 @login_required
 def update(post_id):
     db = get_db()
-    post = db.execute('SELECT * FROM posts WHERE id = ?',
-                      (post_id,)).fetchone()
-    den = db.execute('SELECT * FROM dens WHERE id = ?',
-                     (post['den_id'],)).fetchone()
+    post = get_loader().post(post_id)
+    if post is None:
+        abort(404)
 
     if request.method == 'GET':
         return render_template('posts/update.html', post=post)
     else:
         try:
             request.form['delete']
-            db.execute('pragma foreign_keys = on;')
             db.execute('DELETE FROM posts WHERE id = ? AND author_id = ?',
                        (request.form['delete'], g.user['id']))
             db.commit()
@@ -95,4 +101,4 @@ def update(post_id):
                 AND author_id = ?
             ''', (body, title, post_id, g.user['id'],))
             db.commit()
-        return redirect(url_for('dens.den', den_id=den['id']))
+        return redirect(url_for('dens.den', den_id=post['den_id']))
@@ -0,0 +1,210 @@
+#
+#   queryplan.py
+#       A regression check for our SQL: it drives every page of the site against a scratch
+#       copy of the database, asks SQLite how it would run each query it saw, and fails if
+#       any of them would read a whole table instead of using an index, or if a page ran more
+#       queries than it should.
+#
+
+# SQLite will tell you how it plans to run a query if you prefix it with EXPLAIN QUERY PLAN.
+# Each row of the output describes one step. "SEARCH posts USING INDEX ..." means it looks
+# rows up through an index, while a bare "SCAN posts" means it reads every row of the table.
+# See: https://www.sqlite.org/eqp.html
+
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+from urllib.parse import urlencode
+
+import click
+from flask import current_app, request, request_started
+from flask.cli import with_appcontext
+
+from bobchat.db import get_db, get_driver
+
+# A step that reads a whole table, e.g. "SCAN posts" or "SCAN d" for an aliased table,
+# or the whole of one of its indexes ("SCAN users USING COVERING INDEX ...").
+# Walking an index in order ("SCAN d USING INDEX dens_created") is allowed, since that's
+# how ORDER BY ... LIMIT reads just the first few rows. Virtual tables (our FTS5 indexes)
+# plan their own lookups, and show up as "SCAN ... VIRTUAL TABLE".
+FULL_SCAN = re.compile(r'^SCAN (\w+)(?: USING COVERING INDEX \w+)?$')
+
+# Some pages really do need every row of a table. Each entry is an (endpoint, table) pair
+# whose full scan is expected. Keep this list short!
+ALLOWED_SCANS = {
+    # The user directory lists every user.
+    ('users.index', 'users'),
+}
+
+# A subquery in the FROM clause whose rows are computed first. Scanning its results is fine,
+# as long as the subquery itself doesn't scan a table, which is checked separately.
+SUBQUERY = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\w+)$')
+
+# Statements we don't need to explain.
+SKIPPED = re.compile(r'^\s*(--|BEGIN|COMMIT|ROLLBACK|PRAGMA|SAVEPOINT|RELEASE)', re.IGNORECASE)
+
+# The most queries a GET of each of these pages may run. A page that goes over has started
+# looking the same rows up more than once, or one row at a time in a loop. Use loader.py.
+QUERY_BUDGETS = {
+    'index.index': 3,
+    'dens.index': 1,
+    'dens.den': 2,
+    'dens.den_post': 2,
+    'dens.replies': 1,
+    'users.user_page': 2,
+    'posts.create': 1,
+    'posts.update': 1,
+    'dens.update': 1,
+}
+
+
+# Walks through every route in the app as a brand new user. The requests are made with
+# the test client, so they go through the same views, templates and queries as real traffic.
+def exercise_routes(client):
+    username = 'queryplan'
+    client.post('/auth/register', data={
+        'username': username, 'password': username, 'firstname': 'Query',
+        'lastname': 'Plan', 'email': 'queryplan@ucmerced.edu', 'major': 'undeclared',
+    })
+    client.post('/auth/login', data={'username': username, 'password': username})
+
+    client.post('/dens/create', data={'name': 'Query Plans', 'description': 'EXPLAIN everything'})
+    den_id = get_db().execute('SELECT MAX(id) FROM dens').fetchone()[0]
+    client.post('/dens/follow', data={'den_id': den_id, 'follow': 'follow'})
+
+    client.post('/posts/create/{}'.format(den_id), data={'title': 'Indexes', 'body': 'Are great'})
+    post_id = get_db().execute('SELECT MAX(id) FROM posts').fetchone()[0]
+    post_url = '/dens/{}/{}'.format(den_id, post_id)
+
+    client.post(post_url + '/comment', data={'comment': 'Agreed'})
+    comment_id = get_db().execute('SELECT MAX(id) FROM comments').fetchone()[0]
+    client.post(post_url + '/comment', data={'comment': 'Seconded', 'parent_id': comment_id})
+    reply_id = get_db().execute('SELECT MAX(id) FROM comments').fetchone()[0]
+    created = get_db().execute('SELECT created FROM comments WHERE id = ?', (reply_id,)).fetchone()[0]
+    replies_url = '{}/comments/{}/replies'.format(post_url, comment_id)
+
+    for url in ['/', '/dens/', '/dens/?search=query', '/dens/?sort=followers', '/dens/?sort=active',
+                '/dens/?' + urlencode({'sort': 'newest', 'after': created, 'after_id': den_id}),
+                '/dens/?' + urlencode({'sort': 'followers', 'after': 1, 'after_id': den_id}),
+                '/dens/?' + urlencode({'sort': 'active', 'after': 1, 'after_id': den_id}),
+                '/dens/{}'.format(den_id),
+                '/dens/{}?search=index'.format(den_id), post_url,
+                post_url + '?' + urlencode({'before': created, 'before_id': comment_id}),
+                replies_url, replies_url + '?' + urlencode({'after': created, 'after_id': reply_id}),
+                '/users/', '/users/?search=query', '/users/?search=qu',
+                '/users/' + username, '/posts/create/{}'.format(den_id),
+                '/posts/update/{}'.format(post_id), '/dens/{}/update'.format(den_id),
+                '/api/v1/', '/api/v1/feed', '/api/v1/dens', '/api/v1/dens/{}'.format(den_id),
+                '/api/v1' + post_url, '/api/v1/users/' + username]:
+        client.get(url)
+
+    # Like, then unlike.
+    client.post(post_url)
+    client.post(post_url)
+
+    client.post('/posts/update/{}'.format(post_id), data={'title': 'Indexes', 'body': 'Are very great'})
+    client.post('/posts/delete/{}'.format(comment_id), data={'den_id': den_id, 'post_id': post_id})
+    client.post('/dens/{}/update'.format(den_id), data={'title': 'Query Plans', 'body': 'Still explaining'})
+    client.post('/dens/follow', data={'den_id': den_id, 'follow': 'unfollow'})
+    client.post('/posts/update/{}'.format(post_id), data={'delete': post_id})
+    client.post('/dens/{}/delete'.format(den_id))
+    client.get('/auth/logout')
+    client.get('/')
+
+
+# Returns a list of (endpoint, sql, plan) for every statement that scans a table it shouldn't,
+# a list of (endpoint, queries) for every page that ran more queries than QUERY_BUDGETS allows,
+# and how many different statements were checked.
+def check_routes():
+    app = current_app._get_current_object()
+    statements = []
+    counts = []
+
+    # SQLite calls the trace callback with the text of every statement it runs,
+    # with the parameters already filled in, so we can EXPLAIN them afterwards.
+    def trace(sender, **extra):
+        endpoint = request.endpoint
+        count = [request.method, endpoint, 0]
+        counts.append(count)
+
+        def callback(sql):
+            statements.append((endpoint, sql))
+            if not SKIPPED.match(sql):
+                count[2] += 1
+
+        get_db().set_trace_callback(callback)
+
+    # Run against a scratch copy of the database, since exercise_routes() writes to it.
+    scratch = tempfile.mkdtemp()
+    database = app.config['DATABASE']
+    copy = os.path.join(scratch, 'queryplan.sqlite')
+    source = sqlite3.connect(database)
+    destination = sqlite3.connect(copy)
+    source.backup(destination)
+    source.close()
+
+    # Pages served from the page cache wouldn't run their queries, so turn it off while we look.
+    # Likes are written straight away too, rather than later by the like buffer's own thread.
+    page_cache_enabled = app.config['PAGE_CACHE_ENABLED']
+    like_buffer = app.config['LIKE_BUFFER']
+    app.config['DATABASE'] = copy
+    app.config['PAGE_CACHE_ENABLED'] = False
+    app.config['LIKE_BUFFER'] = 'off'
+    try:
+        with request_started.connected_to(trace, app):
+            exercise_routes(app.test_client())
+
+        offenders = []
+        seen = set()
+        for endpoint, sql in statements:
+            if SKIPPED.match(sql) or (endpoint, sql) in seen:
+                continue
+            seen.add((endpoint, sql))
+            plan = [row[3] for row in destination.execute('EXPLAIN QUERY PLAN ' + sql)]
+            subqueries = set(match.group(1) for match in map(SUBQUERY.match, plan) if match)
+            for step in plan:
+                match = FULL_SCAN.match(step)
+                if match and match.group(1) not in subqueries \
+                        and (endpoint, match.group(1)) not in ALLOWED_SCANS:
+                    offenders.append((endpoint, sql, plan))
+                    break
+
+        over_budget = [(endpoint, queries) for method, endpoint, queries in counts
+                       if method == 'GET' and queries > QUERY_BUDGETS.get(endpoint, queries)]
+        return offenders, over_budget, len(seen)
+    finally:
+        app.config['DATABASE'] = database
+        app.config['PAGE_CACHE_ENABLED'] = page_cache_enabled
+        app.config['LIKE_BUFFER'] = like_buffer
+        destination.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+@click.command('check-query-plans')
+@with_appcontext
+def check_query_plans_command():
+    """Fail if any query on the site does a full table scan, or a page runs too many queries."""
+    if get_driver() != 'sqlite':
+        # It reads SQLite's own trace callback and EXPLAIN QUERY PLAN output.
+        raise click.ClickException('check-query-plans needs DATABASE_DRIVER = "sqlite".')
+    offenders, over_budget, checked = check_routes()
+    for endpoint, sql, plan in offenders:
+        click.echo('{}: full table scan in\n{}'.format(endpoint, sql.strip()))
+        for step in plan:
+            click.echo('\t' + step)
+        click.echo()
+
+    for endpoint, queries in over_budget:
+        click.echo('{}: ran {} queries, more than its budget of {}'.format(
+            endpoint, queries, QUERY_BUDGETS[endpoint]))
+
+    click.echo('Checked {} statements, {} full table scans, {} pages over their query budget.'.format(
+        checked, len(offenders), len(over_budget)))
+    if offenders or over_budget:
+        raise SystemExit(1)
+
+
+def init_app(app):
+    app.cli.add_command(check_query_plans_command)
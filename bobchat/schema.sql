@@ -1,4 +1,11 @@
 pragma foreign_keys = ON;
+DROP TABLE IF EXISTS den_activity;
+DROP TABLE IF EXISTS timelines;
+DROP TABLE IF EXISTS site_stats;
+DROP TABLE IF EXISTS versions;
+DROP TABLE IF EXISTS users_fts;
+DROP TABLE IF EXISTS posts_fts;
+DROP TABLE IF EXISTS dens_fts;
 DROP TABLE IF EXISTS user_den_assoc;
 DROP TABLE IF EXISTS comments;
 DROP TABLE IF EXISTS posts;
@@ -21,6 +28,8 @@ CREATE TABLE IF NOT EXISTS dens(
     author_id INTEGER NOT NULL DEFAULT 1,
     created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     description TEXT NOT NULL,
+    follower_count INTEGER NOT NULL DEFAULT 0,
+    post_count INTEGER NOT NULL DEFAULT 0,
     FOREIGN KEY (author_id) REFERENCES users(id)
 );
 CREATE TABLE IF NOT EXISTS posts (
@@ -30,9 +39,13 @@ CREATE TABLE IF NOT EXISTS posts (
     created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     title TEXT NOT NULL,
     body TEXT NOT NULL,
+    like_count INTEGER NOT NULL DEFAULT 0,
+    comment_count INTEGER NOT NULL DEFAULT 0,
     FOREIGN KEY (author_id) REFERENCES users(id) ON DELETE CASCADE,
     FOREIGN KEY (den_id) REFERENCES dens(id) ON DELETE CASCADE
 );
+CREATE INDEX IF NOT EXISTS posts_den_id_like_count ON posts(den_id, like_count DESC);
+CREATE INDEX IF NOT EXISTS posts_author_id_like_count ON posts(author_id, like_count DESC);
 CREATE TABLE IF NOT EXISTS user_den_assoc(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
@@ -48,12 +61,336 @@ CREATE TABLE IF NOT EXISTS post_like_assoc(
     FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE,
     UNIQUE(user_id, post_id)
 );
+-- posts.like_count is a denormalized copy of COUNT(*) over post_like_assoc for that post.
+-- These triggers keep it up to date inside the same transaction as the like or unlike,
+-- so pages can read and sort by it without aggregating the likes table.
+-- If it ever drifts, `flask rebuild-counters` recomputes it.
+CREATE TRIGGER IF NOT EXISTS post_like_assoc_insert AFTER INSERT ON post_like_assoc
+BEGIN
+    UPDATE posts SET like_count = like_count + 1 WHERE id = NEW.post_id;
+END;
+CREATE TRIGGER IF NOT EXISTS post_like_assoc_delete AFTER DELETE ON post_like_assoc
+BEGIN
+    UPDATE posts SET like_count = like_count - 1 WHERE id = OLD.post_id;
+END;
 CREATE TABLE IF NOT EXISTS comments(
     id integer PRIMARY KEY autoincrement,
     author_id integer NOT NULL,
     post_id integer NOT NULL,
     body text NOT NULL,
     created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    parent_id INTEGER REFERENCES comments(id) ON DELETE CASCADE,
+    reply_count INTEGER NOT NULL DEFAULT 0,
     FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE,
     FOREIGN KEY (author_id) REFERENCES users(id) ON DELETE CASCADE
-);
\ No newline at end of file
+);
+-- Comments can be replies to other comments. parent_id is the comment being replied to, or NULL
+-- for a comment on the post itself. Deleting a comment deletes its replies along with it.
+-- comments.reply_count and posts.comment_count are denormalized counts kept up to date by these
+-- triggers, so a post's page can show how big the discussion is, and how many replies each
+-- collapsed thread has, without counting them.
+CREATE TRIGGER IF NOT EXISTS comments_comment_count_insert AFTER INSERT ON comments
+BEGIN
+    UPDATE posts SET comment_count = comment_count + 1 WHERE id = NEW.post_id;
+    UPDATE comments SET reply_count = reply_count + 1 WHERE id = NEW.parent_id;
+END;
+CREATE TRIGGER IF NOT EXISTS comments_comment_count_delete AFTER DELETE ON comments
+BEGIN
+    UPDATE posts SET comment_count = comment_count - 1 WHERE id = OLD.post_id;
+    UPDATE comments SET reply_count = reply_count - 1 WHERE id = OLD.parent_id;
+END;
+-- Secondary indexes for the foreign keys and sort orders our pages look things up by.
+-- Without them, every den page, profile page, comment list and follow check reads the whole table.
+CREATE INDEX IF NOT EXISTS posts_created ON posts(created, id);
+CREATE INDEX IF NOT EXISTS posts_den_id_created ON posts(den_id, created, id);
+CREATE INDEX IF NOT EXISTS dens_author_id ON dens(author_id);
+CREATE INDEX IF NOT EXISTS dens_created ON dens(created);
+CREATE INDEX IF NOT EXISTS user_den_assoc_user_id_den_id ON user_den_assoc(user_id, den_id);
+CREATE INDEX IF NOT EXISTS user_den_assoc_den_id ON user_den_assoc(den_id);
+CREATE INDEX IF NOT EXISTS post_like_assoc_post_id ON post_like_assoc(post_id);
+-- A post's page shows one page of its top-level comments, newest first, and each thread's
+-- replies are read a page at a time, oldest first. Both walk one of these indexes from the cursor.
+CREATE INDEX IF NOT EXISTS comments_post_id_parent_id_created ON comments(post_id, parent_id, created, id);
+CREATE INDEX IF NOT EXISTS comments_parent_id_created ON comments(parent_id, created, id);
+CREATE INDEX IF NOT EXISTS comments_author_id ON comments(author_id);
+-- Full-text search indexes. These are FTS5 "external content" tables: they only store the
+-- search index, and read the actual text back from the table named in content=.
+-- The triggers below keep each index in step with its table on insert, update and delete.
+-- `flask rebuild-search-index` regenerates them from scratch.
+-- See: https://www.sqlite.org/fts5.html#external_content_tables
+CREATE VIRTUAL TABLE IF NOT EXISTS dens_fts USING fts5(
+    name,
+    description,
+    content='dens',
+    content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS dens_fts_insert AFTER INSERT ON dens
+BEGIN
+    INSERT INTO dens_fts(rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);
+END;
+CREATE TRIGGER IF NOT EXISTS dens_fts_delete AFTER DELETE ON dens
+BEGIN
+    INSERT INTO dens_fts(dens_fts, rowid, name, description) VALUES ('delete', OLD.id, OLD.name, OLD.description);
+END;
+CREATE TRIGGER IF NOT EXISTS dens_fts_update AFTER UPDATE OF name, description ON dens
+BEGIN
+    INSERT INTO dens_fts(dens_fts, rowid, name, description) VALUES ('delete', OLD.id, OLD.name, OLD.description);
+    INSERT INTO dens_fts(rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);
+END;
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+    title,
+    body,
+    content='posts',
+    content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts
+BEGIN
+    INSERT INTO posts_fts(rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END;
+CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts
+BEGIN
+    INSERT INTO posts_fts(posts_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+END;
+-- Only fire when the text changes. posts is also updated by the like counter triggers.
+CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF title, body ON posts
+BEGIN
+    INSERT INTO posts_fts(posts_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+    INSERT INTO posts_fts(rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END;
+-- Usernames are single words like "BethXerxes", so they use the trigram tokenizer,
+-- which matches any substring of 3 or more characters (just like the old LIKE '%term%').
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+    username,
+    content='users',
+    content_rowid='id',
+    tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users
+BEGIN
+    INSERT INTO users_fts(rowid, username) VALUES (NEW.id, NEW.username);
+END;
+CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users
+BEGIN
+    INSERT INTO users_fts(users_fts, rowid, username) VALUES ('delete', OLD.id, OLD.username);
+END;
+CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username ON users
+BEGIN
+    INSERT INTO users_fts(users_fts, rowid, username) VALUES ('delete', OLD.id, OLD.username);
+    INSERT INTO users_fts(rowid, username) VALUES (NEW.id, NEW.username);
+END;
+-- versions holds a counter for each thing a cached page can depend on: 'den:1', 'post:7', 'user:3',
+-- or a whole table such as 'dens'. The triggers below bump a counter whenever a write changes
+-- what it covers. Cached pages are keyed on the counters they depend on, so a write makes the
+-- old copy unreachable in every worker at once. See pagecache.py.
+CREATE TABLE IF NOT EXISTS versions(
+    key TEXT PRIMARY KEY NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    modified DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS dens_versions_insert AFTER INSERT ON dens
+BEGIN
+    INSERT INTO versions(key) VALUES ('dens'), ('den:' || NEW.id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS dens_versions_update AFTER UPDATE OF name, description ON dens
+BEGIN
+    INSERT INTO versions(key) VALUES ('dens'), ('den:' || NEW.id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS dens_versions_delete AFTER DELETE ON dens
+BEGIN
+    INSERT INTO versions(key) VALUES ('dens'), ('den:' || OLD.id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS posts_versions_insert AFTER INSERT ON posts
+BEGIN
+    INSERT INTO versions(key) VALUES ('posts'), ('den:' || NEW.den_id), ('user:' || NEW.author_id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS posts_versions_update AFTER UPDATE OF title, body ON posts
+BEGIN
+    INSERT INTO versions(key)
+    VALUES ('posts'), ('den:' || NEW.den_id), ('post:' || NEW.id), ('user:' || NEW.author_id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS posts_versions_delete AFTER DELETE ON posts
+BEGIN
+    INSERT INTO versions(key)
+    VALUES ('posts'), ('den:' || OLD.den_id), ('post:' || OLD.id), ('user:' || OLD.author_id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+-- A like changes the count shown on the post, its den's page and its author's profile.
+-- When the likes are being deleted because their post was, the post is already gone and the
+-- lookups come back NULL, so those keys are skipped.
+CREATE TRIGGER IF NOT EXISTS post_like_assoc_versions_insert AFTER INSERT ON post_like_assoc
+BEGIN
+    INSERT INTO versions(key)
+    SELECT column1
+    FROM (
+            VALUES ('likes'),
+                ('post:' || NEW.post_id),
+                ('den:' || (SELECT den_id FROM posts WHERE id = NEW.post_id)),
+                ('user:' || (SELECT author_id FROM posts WHERE id = NEW.post_id))
+        )
+    WHERE column1 IS NOT NULL
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS post_like_assoc_versions_delete AFTER DELETE ON post_like_assoc
+BEGIN
+    INSERT INTO versions(key)
+    SELECT column1
+    FROM (
+            VALUES ('likes'),
+                ('post:' || OLD.post_id),
+                ('den:' || (SELECT den_id FROM posts WHERE id = OLD.post_id)),
+                ('user:' || (SELECT author_id FROM posts WHERE id = OLD.post_id))
+        )
+    WHERE column1 IS NOT NULL
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS comments_versions_insert AFTER INSERT ON comments
+BEGIN
+    INSERT INTO versions(key) VALUES ('post:' || NEW.post_id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS comments_versions_delete AFTER DELETE ON comments
+BEGIN
+    INSERT INTO versions(key) VALUES ('post:' || OLD.post_id)
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS users_versions_insert AFTER INSERT ON users
+BEGIN
+    INSERT INTO versions(key) VALUES ('users')
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+-- Following or unfollowing changes what that user's den pages and feed look like, and the
+-- follower counts in the den directory.
+CREATE TRIGGER IF NOT EXISTS user_den_assoc_versions_insert AFTER INSERT ON user_den_assoc
+BEGIN
+    INSERT INTO versions(key) VALUES ('follows:' || NEW.user_id), ('followers')
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+CREATE TRIGGER IF NOT EXISTS user_den_assoc_versions_delete AFTER DELETE ON user_den_assoc
+BEGIN
+    INSERT INTO versions(key) VALUES ('follows:' || OLD.user_id), ('followers')
+    ON CONFLICT(key) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+-- site_stats holds a single row with running totals for the whole site, so the home page
+-- can show them without counting every table. Triggers keep the totals up to date on every
+-- insert and delete, and `flask rebuild-counters` checks them against the real tables.
+-- Every write now also updates this one row, but SQLite only ever has one writer at a time
+-- anyway, so that doesn't add any contention.
+CREATE TABLE IF NOT EXISTS site_stats(
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    users INTEGER NOT NULL DEFAULT 0,
+    posts INTEGER NOT NULL DEFAULT 0,
+    dens INTEGER NOT NULL DEFAULT 0,
+    comments INTEGER NOT NULL DEFAULT 0,
+    likes INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR REPLACE INTO site_stats(id, users, posts, dens, comments, likes)
+VALUES (
+        1,
+        (SELECT COUNT(*) FROM users),
+        (SELECT COUNT(*) FROM posts),
+        (SELECT COUNT(*) FROM dens),
+        (SELECT COUNT(*) FROM comments),
+        (SELECT COUNT(*) FROM post_like_assoc)
+    );
+CREATE TRIGGER IF NOT EXISTS users_site_stats_insert AFTER INSERT ON users
+BEGIN
+    UPDATE site_stats SET users = users + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS users_site_stats_delete AFTER DELETE ON users
+BEGIN
+    UPDATE site_stats SET users = users - 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS posts_site_stats_insert AFTER INSERT ON posts
+BEGIN
+    UPDATE site_stats SET posts = posts + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS posts_site_stats_delete AFTER DELETE ON posts
+BEGIN
+    UPDATE site_stats SET posts = posts - 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS dens_site_stats_insert AFTER INSERT ON dens
+BEGIN
+    UPDATE site_stats SET dens = dens + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS dens_site_stats_delete AFTER DELETE ON dens
+BEGIN
+    UPDATE site_stats SET dens = dens - 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS comments_site_stats_insert AFTER INSERT ON comments
+BEGIN
+    UPDATE site_stats SET comments = comments + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS comments_site_stats_delete AFTER DELETE ON comments
+BEGIN
+    UPDATE site_stats SET comments = comments - 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS post_like_assoc_site_stats_insert AFTER INSERT ON post_like_assoc
+BEGIN
+    UPDATE site_stats SET likes = likes + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS post_like_assoc_site_stats_delete AFTER DELETE ON post_like_assoc
+BEGIN
+    UPDATE site_stats SET likes = likes - 1 WHERE id = 1;
+END;
+-- dens.follower_count is a denormalized count of user_den_assoc rows for each den, kept up to
+-- date by triggers. It decides whether new posts in a den are copied into its followers'
+-- timelines, or read from the den on demand (see timelines.py).
+CREATE TRIGGER IF NOT EXISTS user_den_assoc_follower_count_insert AFTER INSERT ON user_den_assoc
+BEGIN
+    UPDATE dens SET follower_count = follower_count + 1 WHERE id = NEW.den_id;
+END;
+CREATE TRIGGER IF NOT EXISTS user_den_assoc_follower_count_delete AFTER DELETE ON user_den_assoc
+BEGIN
+    UPDATE dens SET follower_count = follower_count - 1 WHERE id = OLD.den_id;
+END;
+-- The den directory can be sorted by newest, most followed or most active (see dens.index()).
+-- dens.post_count is a denormalized count of each den's posts, kept up to date by these triggers
+-- like dens.follower_count is. den_activity counts each den's posts per day (in UTC), so how active
+-- a den has been over the last few days is a sum over a handful of rows, rather than a count over
+-- all of its posts. Days with no posts have no row.
+CREATE TABLE IF NOT EXISTS den_activity(
+    day TEXT NOT NULL,
+    den_id INTEGER NOT NULL,
+    posts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, den_id),
+    FOREIGN KEY (den_id) REFERENCES dens(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS den_activity_den_id ON den_activity(den_id);
+CREATE TRIGGER IF NOT EXISTS posts_den_counts_insert AFTER INSERT ON posts
+BEGIN
+    UPDATE dens SET post_count = post_count + 1 WHERE id = NEW.den_id;
+    INSERT INTO den_activity(day, den_id, posts) VALUES (date(NEW.created), NEW.den_id, 1)
+    ON CONFLICT(day, den_id) DO UPDATE SET posts = posts + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS posts_den_counts_delete AFTER DELETE ON posts
+BEGIN
+    UPDATE dens SET post_count = post_count - 1 WHERE id = OLD.den_id;
+    UPDATE den_activity SET posts = posts - 1 WHERE day = date(OLD.created) AND den_id = OLD.den_id;
+    DELETE FROM den_activity WHERE day = date(OLD.created) AND den_id = OLD.den_id AND posts = 0;
+END;
+-- Sorted by followers, the directory walks this index from where the last page left off,
+-- as it walks dens_created sorted by newest.
+CREATE INDEX IF NOT EXISTS dens_follower_count ON dens(follower_count, id);
+-- timelines holds a copy of each user's feed: one row per post in every den they follow,
+-- filled in when the post is written. Reading a page of the feed is then a range scan of
+-- the primary key. Rows go away along with their post (and so their den) or user.
+CREATE TABLE IF NOT EXISTS timelines(
+    user_id INTEGER NOT NULL,
+    created DATETIME NOT NULL,
+    post_id INTEGER NOT NULL,
+    den_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, created, post_id),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS timelines_post_id ON timelines(post_id);
+CREATE INDEX IF NOT EXISTS timelines_user_id_den_id ON timelines(user_id, den_id);
+-- The schema above is already up to date with every file in migrations/,
+-- so record that none of them need to run on a freshly initialized database.
+-- See: db.migrate_db()
+PRAGMA user_version = 8;
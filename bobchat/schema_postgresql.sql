@@ -0,0 +1,271 @@
+-- The same schema as schema.sql, for PostgreSQL (see postgres.py). Both have the same tables
+-- and columns, and the same counters, versions and search indexes kept up to date by triggers,
+-- so every query the site runs works on either. Where they differ, it's said below.
+DROP VIEW IF EXISTS site_stats;
+DROP TABLE IF EXISTS schema_version,
+    den_activity,
+    timelines,
+    site_stats_shards,
+    versions,
+    user_den_assoc,
+    comments,
+    post_like_assoc,
+    posts,
+    dens,
+    users CASCADE;
+-- CURRENT_TIMESTAMP in SQLite: the time in UTC, to the second. Timestamps are read back as text
+-- in the same format SQLite uses (see postgres.configure()).
+CREATE OR REPLACE FUNCTION utc_now() RETURNS TIMESTAMP(0) LANGUAGE SQL STABLE AS $$
+    SELECT date_trunc('second', now() AT TIME ZONE 'UTC')::TIMESTAMP(0);
+$$;
+-- Usernames are compared byte by byte, like SQLite does, rather than by the server's locale.
+-- That keeps their order, and the prefix search in search.search_users(), the same on both.
+CREATE TABLE users (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    username TEXT COLLATE "C" UNIQUE NOT NULL,
+    password TEXT NOT NULL,
+    firstname TEXT NOT NULL,
+    lastname TEXT NOT NULL,
+    created TIMESTAMP(0) NOT NULL DEFAULT utc_now(),
+    email TEXT NOT NULL,
+    major TEXT NOT NULL
+);
+-- search is the full-text index's document, in place of SQLite's dens_fts table. A match in the
+-- name is weighted A and one in the description D, so search.search_dens() can rank them.
+CREATE TABLE dens(
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    name TEXT NOT NULL,
+    author_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id),
+    created TIMESTAMP(0) NOT NULL DEFAULT utc_now(),
+    description TEXT NOT NULL,
+    follower_count INTEGER NOT NULL DEFAULT 0,
+    post_count INTEGER NOT NULL DEFAULT 0,
+    search TSVECTOR GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', name), 'A') || setweight(to_tsvector('simple', description), 'D')
+    ) STORED
+);
+CREATE TABLE posts (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    author_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    den_id INTEGER NOT NULL REFERENCES dens(id) ON DELETE CASCADE,
+    created TIMESTAMP(0) NOT NULL DEFAULT utc_now(),
+    title TEXT NOT NULL,
+    body TEXT NOT NULL,
+    like_count INTEGER NOT NULL DEFAULT 0,
+    comment_count INTEGER NOT NULL DEFAULT 0,
+    search TSVECTOR GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', title), 'A') || setweight(to_tsvector('simple', body), 'D')
+    ) STORED
+);
+CREATE TABLE user_den_assoc(
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    den_id INTEGER NOT NULL REFERENCES dens(id) ON DELETE CASCADE
+);
+CREATE TABLE post_like_assoc(
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    post_id INTEGER NOT NULL REFERENCES posts(id) ON DELETE CASCADE,
+    UNIQUE(user_id, post_id)
+);
+CREATE TABLE comments(
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    author_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    post_id INTEGER NOT NULL REFERENCES posts(id) ON DELETE CASCADE,
+    body TEXT NOT NULL,
+    created TIMESTAMP(0) NOT NULL DEFAULT utc_now(),
+    parent_id INTEGER REFERENCES comments(id) ON DELETE CASCADE,
+    reply_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX posts_den_id_like_count ON posts(den_id, like_count DESC);
+CREATE INDEX posts_author_id_like_count ON posts(author_id, like_count DESC);
+CREATE INDEX posts_created ON posts(created, id);
+CREATE INDEX posts_den_id_created ON posts(den_id, created, id);
+CREATE INDEX dens_author_id ON dens(author_id);
+CREATE INDEX dens_created ON dens(created, id);
+CREATE INDEX dens_follower_count ON dens(follower_count, id);
+CREATE INDEX user_den_assoc_user_id_den_id ON user_den_assoc(user_id, den_id);
+CREATE INDEX user_den_assoc_den_id ON user_den_assoc(den_id);
+CREATE INDEX post_like_assoc_post_id ON post_like_assoc(post_id);
+CREATE INDEX comments_post_id_parent_id_created ON comments(post_id, parent_id, created, id);
+CREATE INDEX comments_parent_id_created ON comments(parent_id, created, id);
+CREATE INDEX comments_author_id ON comments(author_id);
+CREATE INDEX dens_search ON dens USING GIN (search);
+CREATE INDEX posts_search ON posts USING GIN (search);
+-- Usernames are searched for by substring. The pg_trgm extension can index that, the way the
+-- trigram tokenizer does in SQLite. Without it, searching users reads the whole table.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX users_username_trigram ON users USING GIN (username gin_trgm_ops);
+    END IF;
+END
+$$;
+-- See versions in schema.sql.
+CREATE TABLE versions(
+    key TEXT PRIMARY KEY NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    modified TIMESTAMP(0) NOT NULL DEFAULT utc_now()
+);
+-- Bumps the version of each key. NULL keys are skipped. The keys are locked in sorted order,
+-- so two writes bumping the same keys at once wait for each other rather than deadlocking.
+CREATE OR REPLACE FUNCTION bump_versions(VARIADIC keys TEXT[]) RETURNS VOID LANGUAGE SQL AS $$
+    INSERT INTO versions(key)
+    SELECT DISTINCT key
+    FROM unnest(keys) AS key
+    WHERE key IS NOT NULL
+    ORDER BY key
+    ON CONFLICT(key) DO UPDATE SET version = versions.version + 1, modified = utc_now();
+$$;
+-- See site_stats in schema.sql. SQLite only ever has one writer, but here every write updating
+-- the same row would make writers on every server take turns. So the totals are spread over
+-- 16 rows, each connection adds to the one its server process id picks, and the site_stats view
+-- adds them up. Queries read it exactly like SQLite's table.
+CREATE TABLE site_stats_shards(
+    shard INTEGER PRIMARY KEY,
+    users INTEGER NOT NULL DEFAULT 0,
+    posts INTEGER NOT NULL DEFAULT 0,
+    dens INTEGER NOT NULL DEFAULT 0,
+    comments INTEGER NOT NULL DEFAULT 0,
+    likes INTEGER NOT NULL DEFAULT 0
+);
+INSERT INTO site_stats_shards(shard)
+SELECT generate_series(0, 15);
+CREATE VIEW site_stats AS
+SELECT 1 AS id,
+    SUM(users)::INTEGER AS users,
+    SUM(posts)::INTEGER AS posts,
+    SUM(dens)::INTEGER AS dens,
+    SUM(comments)::INTEGER AS comments,
+    SUM(likes)::INTEGER AS likes
+FROM site_stats_shards;
+CREATE OR REPLACE FUNCTION site_stats_shard() RETURNS INTEGER LANGUAGE SQL STABLE AS $$
+    SELECT pg_backend_pid() % 16;
+$$;
+-- Each table has one trigger function that does everything the separate triggers on it do in
+-- schema.sql: counters, versions and site_stats. OLD and NEW are only set for the operations that
+-- have them, so each branch only reads the one it has.
+CREATE OR REPLACE FUNCTION users_changed() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM bump_versions('users');
+        UPDATE site_stats_shards SET users = users + 1 WHERE shard = site_stats_shard();
+    ELSE
+        UPDATE site_stats_shards SET users = users - 1 WHERE shard = site_stats_shard();
+    END IF;
+    RETURN NULL;
+END
+$$;
+CREATE TRIGGER users_changed AFTER INSERT OR DELETE ON users
+FOR EACH ROW EXECUTE FUNCTION users_changed();
+CREATE OR REPLACE FUNCTION dens_changed() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM bump_versions('dens', 'den:' || OLD.id);
+        UPDATE site_stats_shards SET dens = dens - 1 WHERE shard = site_stats_shard();
+    ELSE
+        PERFORM bump_versions('dens', 'den:' || NEW.id);
+        IF TG_OP = 'INSERT' THEN
+            UPDATE site_stats_shards SET dens = dens + 1 WHERE shard = site_stats_shard();
+        END IF;
+    END IF;
+    RETURN NULL;
+END
+$$;
+CREATE TRIGGER dens_changed AFTER INSERT OR DELETE OR UPDATE OF name, description ON dens
+FOR EACH ROW EXECUTE FUNCTION dens_changed();
+CREATE OR REPLACE FUNCTION posts_changed() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE dens SET post_count = post_count + 1 WHERE id = NEW.den_id;
+        INSERT INTO den_activity(day, den_id, posts) VALUES (NEW.created::DATE, NEW.den_id, 1)
+        ON CONFLICT(day, den_id) DO UPDATE SET posts = den_activity.posts + 1;
+        PERFORM bump_versions('posts', 'den:' || NEW.den_id, 'user:' || NEW.author_id);
+        UPDATE site_stats_shards SET posts = posts + 1 WHERE shard = site_stats_shard();
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM bump_versions('posts', 'den:' || NEW.den_id, 'post:' || NEW.id, 'user:' || NEW.author_id);
+    ELSE
+        UPDATE dens SET post_count = post_count - 1 WHERE id = OLD.den_id;
+        UPDATE den_activity SET posts = posts - 1 WHERE day = OLD.created::DATE AND den_id = OLD.den_id;
+        DELETE FROM den_activity WHERE day = OLD.created::DATE AND den_id = OLD.den_id AND posts = 0;
+        PERFORM bump_versions('posts', 'den:' || OLD.den_id, 'post:' || OLD.id, 'user:' || OLD.author_id);
+        UPDATE site_stats_shards SET posts = posts - 1 WHERE shard = site_stats_shard();
+    END IF;
+    RETURN NULL;
+END
+$$;
+CREATE TRIGGER posts_changed AFTER INSERT OR DELETE OR UPDATE OF title, body ON posts
+FOR EACH ROW EXECUTE FUNCTION posts_changed();
+CREATE OR REPLACE FUNCTION post_like_assoc_changed() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+DECLARE
+    delta INTEGER := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+    liked INTEGER := CASE WHEN TG_OP = 'INSERT' THEN NEW.post_id ELSE OLD.post_id END;
+    post posts%ROWTYPE;
+BEGIN
+    -- When the likes are being deleted because their post was, the post is already gone,
+    -- so only 'likes' and the post's own key are bumped.
+    UPDATE posts SET like_count = like_count + delta WHERE id = liked RETURNING * INTO post;
+    PERFORM bump_versions('likes', 'post:' || liked, 'den:' || post.den_id, 'user:' || post.author_id);
+    UPDATE site_stats_shards SET likes = likes + delta WHERE shard = site_stats_shard();
+    RETURN NULL;
+END
+$$;
+CREATE TRIGGER post_like_assoc_changed AFTER INSERT OR DELETE ON post_like_assoc
+FOR EACH ROW EXECUTE FUNCTION post_like_assoc_changed();
+CREATE OR REPLACE FUNCTION comments_changed() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE posts SET comment_count = comment_count + 1 WHERE id = NEW.post_id;
+        UPDATE comments SET reply_count = reply_count + 1 WHERE id = NEW.parent_id;
+        PERFORM bump_versions('post:' || NEW.post_id);
+        UPDATE site_stats_shards SET comments = comments + 1 WHERE shard = site_stats_shard();
+    ELSE
+        UPDATE posts SET comment_count = comment_count - 1 WHERE id = OLD.post_id;
+        UPDATE comments SET reply_count = reply_count - 1 WHERE id = OLD.parent_id;
+        PERFORM bump_versions('post:' || OLD.post_id);
+        UPDATE site_stats_shards SET comments = comments - 1 WHERE shard = site_stats_shard();
+    END IF;
+    RETURN NULL;
+END
+$$;
+CREATE TRIGGER comments_changed AFTER INSERT OR DELETE ON comments
+FOR EACH ROW EXECUTE FUNCTION comments_changed();
+CREATE OR REPLACE FUNCTION user_den_assoc_changed() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE dens SET follower_count = follower_count + 1 WHERE id = NEW.den_id;
+        PERFORM bump_versions('follows:' || NEW.user_id, 'followers');
+    ELSE
+        UPDATE dens SET follower_count = follower_count - 1 WHERE id = OLD.den_id;
+        PERFORM bump_versions('follows:' || OLD.user_id, 'followers');
+    END IF;
+    RETURN NULL;
+END
+$$;
+CREATE TRIGGER user_den_assoc_changed AFTER INSERT OR DELETE ON user_den_assoc
+FOR EACH ROW EXECUTE FUNCTION user_den_assoc_changed();
+-- See den_activity in schema.sql. It's filled in by posts_changed().
+CREATE TABLE den_activity(
+    day DATE NOT NULL,
+    den_id INTEGER NOT NULL REFERENCES dens(id) ON DELETE CASCADE,
+    posts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, den_id)
+);
+CREATE INDEX den_activity_den_id ON den_activity(den_id);
+-- See timelines in schema.sql.
+CREATE TABLE timelines(
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    created TIMESTAMP(0) NOT NULL,
+    post_id INTEGER NOT NULL REFERENCES posts(id) ON DELETE CASCADE,
+    den_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, created, post_id)
+);
+CREATE INDEX timelines_post_id ON timelines(post_id);
+CREATE INDEX timelines_user_id_den_id ON timelines(user_id, den_id);
+-- PostgreSQL has no user_version, so the number of the last migration applied is kept here.
+-- This schema is already up to date with every file in migrations/, and later migrations for
+-- PostgreSQL go in migrations/postgresql/ with the same numbers. See: db.migrate_db()
+CREATE TABLE schema_version(version INTEGER NOT NULL);
+INSERT INTO schema_version(version)
+VALUES (8);
@@ -0,0 +1,242 @@
+#
+#   search.py
+#       Full-text search over dens, posts and users, backed by SQLite's FTS5 extension.
+#       The search indexes themselves (dens_fts, posts_fts and users_fts) and the triggers
+#       that keep them in sync are defined in schema.sql.
+#
+
+# A plain LIKE '%term%' can't use an index, so every search used to read the whole table.
+# An FTS5 index looks the words up directly, and bm25() ranks the matches by relevance.
+# See: https://www.sqlite.org/fts5.html
+#
+# On PostgreSQL, dens and posts have a tsvector column with a GIN index instead, ranked with
+# ts_rank(), and usernames are matched with ILIKE, which pg_trgm's index speeds up when the server
+# has it (see schema_postgresql.sql). Results and pages come back the same shape from either.
+# See: https://www.postgresql.org/docs/current/textsearch.html
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from bobchat.db import get_db, get_driver
+
+# The trigram tokenizer can only match terms that are at least this many characters long.
+TRIGRAM_LENGTH = 3
+
+
+# Turns whatever the user typed into a safe FTS5 query.
+# FTS5 has its own query syntax (AND, OR, NEAR, column filters, ...), and a stray quote or
+# parenthesis would be a syntax error. So every word is wrapped in double quotes, which makes
+# it a literal string. With prefix=True, each word also matches longer words starting with it,
+# so that "merc" finds "Merced" the way the old LIKE search did.
+def fts_query(term, prefix=True):
+    words = term.split()
+    if not words:
+        return None
+    quoted = ['"{}"'.format(word.replace('"', '""')) for word in words]
+    if prefix:
+        quoted = [word + '*' for word in quoted]
+    # Words separated by spaces are implicitly AND-ed together.
+    return ' '.join(quoted)
+
+
+# The same as fts_query(), for PostgreSQL's to_tsquery(): every word is quoted, so it's taken
+# literally, matches longer words starting with it, and has to be there along with the others.
+def tsquery(term):
+    words = term.split()
+    if not words:
+        return None
+    return ' & '.join("'{}':*".format(word.replace('\\', '\\\\').replace("'", "''")) for word in words)
+
+
+# Turns a term into a LIKE pattern that finds it anywhere, with LIKE's own wildcards escaped.
+def contains_pattern(term):
+    return '%{}%'.format(term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+
+
+# Returns the LIMIT and OFFSET for a 1-indexed page number.
+# We ask for one row more than a page, so the caller can tell if there's a next page.
+def page_bounds(page):
+    per_page = current_app.config['SEARCH_PAGE_SIZE']
+    page = max(page, 1)
+    return per_page + 1, (page - 1) * per_page
+
+
+# Splits a result set into (rows, has_more), dropping the extra row page_bounds() asked for.
+def paginate(rows):
+    per_page = current_app.config['SEARCH_PAGE_SIZE']
+    return rows[:per_page], len(rows) > per_page
+
+
+# Returns a page of dens whose name or description matches term, best match first.
+# A match in the name counts ten times as much as a match in the description.
+def search_dens(term, page=1):
+    if get_driver() == 'postgresql':
+        return search_dens_postgresql(term, page)
+    query = fts_query(term)
+    if query is None:
+        return [], False
+    limit, offset = page_bounds(page)
+    dens = get_db().execute('''
+        SELECT d.name,
+            u.username,
+            d.created,
+            d.description,
+            d.id,
+            d.follower_count,
+            d.post_count
+        FROM dens_fts
+            JOIN dens d ON d.id = dens_fts.rowid
+            JOIN users u ON d.author_id = u.id
+        WHERE dens_fts MATCH ?
+        ORDER BY bm25(dens_fts, 10.0, 1.0)
+        LIMIT ? OFFSET ?;
+    ''', (query, limit, offset)).fetchall()
+    return paginate(dens)
+
+
+# ts_rank() weights the D, C, B and A parts of the document by these. Names are A and descriptions
+# are D (see schema_postgresql.sql), so a match in the name counts ten times as much here too.
+def search_dens_postgresql(term, page=1):
+    query = tsquery(term)
+    if query is None:
+        return [], False
+    limit, offset = page_bounds(page)
+    dens = get_db().execute('''
+        SELECT d.name,
+            u.username,
+            d.created,
+            d.description,
+            d.id,
+            d.follower_count,
+            d.post_count
+        FROM dens d
+            JOIN users u ON d.author_id = u.id,
+            to_tsquery('simple', ?) AS query
+        WHERE d.search @@ query
+        ORDER BY ts_rank('{0.1, 0, 0, 1}', d.search, query) DESC, d.id
+        LIMIT ? OFFSET ?;
+    ''', (query, limit, offset)).fetchall()
+    return paginate(dens)
+
+
+# Returns a page of the posts in a den whose title or body matches term, best match first.
+def search_posts(den_id, term, page=1):
+    if get_driver() == 'postgresql':
+        return search_posts_postgresql(den_id, term, page)
+    query = fts_query(term)
+    if query is None:
+        return [], False
+    limit, offset = page_bounds(page)
+    posts = get_db().execute('''
+        SELECT users.username,
+            posts.created,
+            posts.title,
+            posts.id,
+            posts.like_count AS likes
+        FROM posts_fts
+            JOIN posts ON posts.id = posts_fts.rowid
+            JOIN users ON users.id = posts.author_id
+        WHERE posts_fts MATCH ?
+            AND posts.den_id = ?
+        ORDER BY bm25(posts_fts, 5.0, 1.0)
+        LIMIT ? OFFSET ?;
+    ''', (query, den_id, limit, offset)).fetchall()
+    return paginate(posts)
+
+
+# A match in the title counts five times as much as one in the body, as with bm25() above.
+def search_posts_postgresql(den_id, term, page=1):
+    query = tsquery(term)
+    if query is None:
+        return [], False
+    limit, offset = page_bounds(page)
+    posts = get_db().execute('''
+        SELECT users.username,
+            posts.created,
+            posts.title,
+            posts.id,
+            posts.like_count AS likes
+        FROM posts
+            JOIN users ON users.id = posts.author_id,
+            to_tsquery('simple', ?) AS query
+        WHERE posts.search @@ query
+            AND posts.den_id = ?
+        ORDER BY ts_rank('{0.2, 0, 0, 1}', posts.search, query) DESC, posts.id
+        LIMIT ? OFFSET ?;
+    ''', (query, den_id, limit, offset)).fetchall()
+    return paginate(posts)
+
+
+# Returns a page of users whose username contains term, best match first.
+# Only the columns the results show are read, so password hashes and emails never reach the page.
+def search_users(term, page=1):
+    term = term.strip()
+    if not term:
+        return [], False
+    limit, offset = page_bounds(page)
+    if len(term) < TRIGRAM_LENGTH:
+        # Too short for the trigram index, so fall back to usernames starting with term.
+        # This is a range scan on the UNIQUE index on username rather than a full table scan.
+        users = get_db().execute('''
+            SELECT id,
+                username,
+                created
+            FROM users
+            WHERE username >= ?
+                AND username < ?
+            ORDER BY username
+            LIMIT ? OFFSET ?;
+        ''', (term, term + '\uffff', limit, offset)).fetchall()
+    elif get_driver() == 'postgresql':
+        # The shortest usernames containing the term are the closest matches.
+        users = get_db().execute('''
+            SELECT id,
+                username,
+                created
+            FROM users
+            WHERE username ILIKE ?
+            ORDER BY length(username), username
+            LIMIT ? OFFSET ?;
+        ''', (contains_pattern(term), limit, offset)).fetchall()
+    else:
+        users = get_db().execute('''
+            SELECT users.id,
+                users.username,
+                users.created
+            FROM users_fts
+                JOIN users ON users.id = users_fts.rowid
+            WHERE users_fts MATCH ?
+            ORDER BY rank
+            LIMIT ? OFFSET ?;
+        ''', (fts_query(term, prefix=False), limit, offset)).fetchall()
+    return paginate(users)
+
+
+# Rebuilds every search index from the contents of its table.
+def rebuild_search_index():
+    db = get_db()
+    if get_driver() == 'postgresql':
+        # The tsvector columns can't fall out of date, since PostgreSQL computes them from the
+        # row itself, so only the indexes are rebuilt.
+        with db:
+            for table in ('dens', 'posts', 'users'):
+                db.execute('REINDEX TABLE {}'.format(table))
+        return
+    with db:
+        for table in ('dens_fts', 'posts_fts', 'users_fts'):
+            # The special 'rebuild' command re-reads the whole content table.
+            # See: https://www.sqlite.org/fts5.html#the_rebuild_command
+            db.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(table))
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    """Rebuild the full-text search indexes."""
+    rebuild_search_index()
+    click.echo('Search indexes rebuilt.')
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_search_index_command)
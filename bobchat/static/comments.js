@@ -0,0 +1,26 @@
+// Expands a comment thread in place: clicking "Show replies" (or "More replies") fetches that page
+// of replies (see dens.replies()) and puts it where the link was. Without JavaScript the link
+// just opens the replies on their own.
+(function () {
+  document.addEventListener("click", function (click) {
+    var link = click.target.closest("a.load-replies");
+    if (!link || !window.fetch) {
+      return;
+    }
+    click.preventDefault();
+    fetch(link.href, { credentials: "same-origin" })
+      .then(function (response) {
+        if (!response.ok) {
+          throw new Error(response.statusText);
+        }
+        return response.text();
+      })
+      .then(function (html) {
+        link.insertAdjacentHTML("afterend", html);
+        link.remove();
+      })
+      .catch(function () {
+        window.location = link.href;
+      });
+  });
+})();
@@ -0,0 +1,23 @@
+// Listens for new activity on the den or post being viewed (see events.py), and lets the
+// reader know about it without them having to refresh the page.
+(function () {
+  var live = document.getElementById("live");
+  if (!live || !window.EventSource) {
+    return;
+  }
+  var source = new EventSource(live.dataset.events);
+
+  function showNotice() {
+    live.hidden = false;
+  }
+
+  source.addEventListener("post", showNotice);
+  source.addEventListener("comment", showNotice);
+  source.addEventListener("like", function (message) {
+    var event = JSON.parse(message.data);
+    var likes = document.getElementById("likes-" + event.post_id);
+    if (likes) {
+      likes.textContent = event.likes;
+    }
+  });
+})();
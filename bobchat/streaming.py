@@ -0,0 +1,58 @@
+#
+#   streaming.py
+#       Renders long pages a piece at a time and sends each piece as soon as it's ready, instead of
+#       building the whole page in memory before the first byte goes out.
+#
+
+# render_template() returns the finished page as one string, so a page listing every user keeps the
+# rows, the rendered HTML and the response body in memory at once, and the browser sees nothing
+# until all of it is done. stream_page() renders the template with Jinja's generate() instead:
+#   • the view passes the cursor itself, not cursor.fetchall(), so rows are read from SQLite as the
+#     template reaches them (psycopg reads a result in one go, so on PostgreSQL this only saves the
+#     rendering),
+#   • the output is gathered into pieces of about STREAM_BUFFER_SIZE characters, each sent as soon as
+#     it's ready. Sending every little string the template produces would cost a write each,
+#   • the compression middleware (see compression.py) compresses each piece as it goes by.
+#
+# The request would normally end when the view returns, and take its database connection with it.
+# While the page is streaming, g.streaming is set, and close_db() and the metrics leave the request
+# alone until the last piece is sent. Flask then runs the teardown again, and they clean up as usual.
+
+from flask import Response, current_app, g, stream_with_context
+from flask.signals import before_render_template, template_rendered
+
+
+# Like render_template(), but returns a response that renders the page while it's being sent.
+# Any cursors in the context must stay usable until then, so don't close them in the view.
+def stream_page(template_name, **context):
+    app = current_app._get_current_object()
+    template = app.jinja_env.get_or_select_template(template_name)
+    app.update_template_context(context)
+    buffer_size = app.config['STREAM_BUFFER_SIZE']
+    g.streaming = True
+
+    def generate():
+        try:
+            # The same signals render_template() sends, which is how the metrics time rendering.
+            before_render_template.send(app, template=template, context=context)
+            pieces = []
+            size = 0
+            for text in template.generate(context):
+                pieces.append(text)
+                size += len(text)
+                if size >= buffer_size:
+                    yield ''.join(pieces)
+                    pieces = []
+                    size = 0
+            if pieces:
+                yield ''.join(pieces)
+            template_rendered.send(app, template=template, context=context)
+        finally:
+            g.streaming = False
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+
+# Whether the current request is still sending a streamed page.
+def is_streaming():
+    return g.get('streaming', False)
@@ -0,0 +1,283 @@
+#
+#   synthetic.py
+#       Generates a database of made-up users, dens, posts, comments, likes and follows, of any
+#       size, for benchmarking. The same scale and seed always generate the same database.
+#
+
+# The seed CSVs in bobchat/csv only have a few hundred rows, spread evenly, which says nothing about
+# how the site behaves once it's big. Real communities are lopsided, so this data is too:
+#   • den popularity follows a Zipf distribution: the den ranked r gets about 1/r^ZIPF_EXPONENT of
+#     the follows and posts, so a few dens are huge and most are tiny,
+#   • the number of dens each user follows is heavy-tailed (Pareto): most follow a handful,
+#     a few follow hundreds,
+#   • a few users write most of the posts and comments, and a few posts get most of the likes
+#     and comments, by the same Zipf rule.
+# See: https://en.wikipedia.org/wiki/Zipf%27s_law
+#
+# Rows are inserted through the normal schema, so the triggers fill in every counter, version and
+# search index just like real traffic would. Every user's password is BENCH_PASSWORD, hashed
+# once, so `flask bench routes` can log in as anyone.
+
+import itertools
+import os
+import random
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.security import generate_password_hash
+
+from bobchat.db import create_schema, get_db, get_driver
+from bobchat.passwords import hash_method
+
+BENCH_PASSWORD = 'bench'
+
+# The number of each kind of row at --scale 1. Everything grows with the scale, so --scale 100
+# has a million posts.
+PROFILE = {
+    'users': 1000,
+    'dens': 100,
+    'posts': 10000,
+    'comments': 20000,
+    'likes': 50000,
+}
+
+ZIPF_EXPONENT = 1.1
+# Follows per user are drawn from a Pareto distribution with this shape, times FOLLOWS_SCALE.
+# Lower shapes have longer tails.
+FOLLOWS_SHAPE = 1.5
+FOLLOWS_SCALE = 3
+# The share of comments that reply to an earlier comment on the same post.
+REPLY_FRACTION = 0.3
+# How far back the generated activity goes.
+HISTORY_SECONDS = 365 * 24 * 60 * 60
+
+# Rows are inserted this many at a time.
+BATCH_SIZE = 10000
+
+WORDS = '''
+    bobcat campus merced library lecture midterm final exam study group lab project deadline
+    professor housing dorm dining coffee parking shuttle club soccer basketball music concert
+    art gallery hike yosemite weekend party game anime movie book coding python flask database
+    index query cache server deploy bug feature review homework tutor internship career resume
+    research paper thesis advisor major minor physics chemistry biology math history economics
+'''.split()
+
+MAJORS = ['Computer Science', 'Biology', 'Physics', 'Economics', 'History', 'Mathematics', 'Undeclared']
+
+
+# Returns the cumulative weights of a Zipf distribution over n ranks, for random.choices().
+def zipf_weights(n, exponent=ZIPF_EXPONENT):
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+
+
+# Yields items in lists of up to size.
+def batched(items, size=BATCH_SIZE):
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def timestamp(seconds):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+
+# Fills the (empty, freshly initialized) database that get_db() returns, and returns how many
+# rows of each kind it inserted.
+def generate(scale=1.0, seed=0):
+    rng = random.Random(seed)
+    counts = dict((kind, max(1, int(count * scale))) for kind, count in PROFILE.items())
+    now = time.time()
+    start = now - HISTORY_SECONDS
+    db = get_db()
+    sqlite = get_driver() == 'sqlite'
+    if sqlite:
+        # The database can be regenerated if this is interrupted, so don't wait for the disk.
+        db.execute('PRAGMA synchronous = OFF')
+
+    def insert(sql, rows):
+        for batch in batched(rows):
+            db.executemany(sql, batch)
+
+    with db:
+        # Everyone shares one hash, since hashing a million passwords would take hours.
+        password = generate_password_hash(BENCH_PASSWORD, hash_method(current_app.config))
+        users = counts['users']
+        insert('''
+            INSERT INTO users(id, username, password, firstname, lastname, created, email, major)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+        ''', ((user_id, 'user{}'.format(user_id), password, 'User', str(user_id),
+               timestamp(start + HISTORY_SECONDS * (user_id - 1) / users),
+               'user{}@ucmerced.edu'.format(user_id), rng.choice(MAJORS))
+              for user_id in range(1, users + 1)))
+
+        # The users and dens are numbered in order of popularity, so rank r is id r.
+        user_weights = zipf_weights(users)
+        user_ids = range(1, users + 1)
+        dens = counts['dens']
+        den_weights = zipf_weights(dens)
+        den_ids = range(1, dens + 1)
+        insert('''
+            INSERT INTO dens(id, name, author_id, created, description)
+            VALUES(?, ?, ?, ?, ?)
+        ''', ((den_id, '{} {}'.format(sentence(rng, 2).title(), den_id),
+               rng.choices(user_ids, cum_weights=user_weights)[0],
+               timestamp(start + HISTORY_SECONDS * (den_id - 1) / dens / 2), sentence(rng, 12))
+              for den_id in den_ids))
+
+        follows = 0
+        for batch in batched(user_ids, BATCH_SIZE // 10):
+            rows = []
+            for user_id in batch:
+                wanted = min(dens, int(FOLLOWS_SCALE * rng.paretovariate(FOLLOWS_SHAPE)))
+                followed = set(rng.choices(den_ids, cum_weights=den_weights, k=wanted))
+                rows.extend((user_id, den_id) for den_id in followed)
+            db.executemany('INSERT INTO user_den_assoc(user_id, den_id) VALUES(?, ?)', rows)
+            follows += len(rows)
+
+        # Posts are written in order over the second half of the history, so their ids and
+        # created times go up together like real posts.
+        posts = counts['posts']
+
+        def post_created(post_id):
+            return start + HISTORY_SECONDS / 2 + HISTORY_SECONDS * post_id / posts / 2
+
+        insert('''
+            INSERT INTO posts(id, author_id, den_id, created, title, body)
+            VALUES(?, ?, ?, ?, ?, ?)
+        ''', ((post_id, rng.choices(user_ids, cum_weights=user_weights)[0],
+               rng.choices(den_ids, cum_weights=den_weights)[0],
+               timestamp(post_created(post_id)),
+               sentence(rng, rng.randint(3, 8)).capitalize(), sentence(rng, rng.randint(10, 60)))
+              for post_id in range(1, posts + 1)))
+
+        # Which posts are popular is shuffled, so it isn't always the oldest ones.
+        post_weights = zipf_weights(posts)
+        popular_posts = list(range(1, posts + 1))
+        rng.shuffle(popular_posts)
+
+        # post_id -> ids of its comments so far, to pick the ones being replied to from.
+        threads = {}
+
+        def comment_rows():
+            for comment_id in range(1, counts['comments'] + 1):
+                post_id = rng.choices(popular_posts, cum_weights=post_weights)[0]
+                earlier = threads.setdefault(post_id, [])
+                parent_id = rng.choice(earlier) if earlier and rng.random() < REPLY_FRACTION else None
+                earlier.append(comment_id)
+                # Each comment on a post comes a minute after the one before it.
+                created = min(post_created(post_id) + len(earlier) * 60, now)
+                yield (comment_id, rng.choices(user_ids, cum_weights=user_weights)[0], post_id,
+                       sentence(rng, rng.randint(3, 25)), timestamp(created), parent_id)
+
+        # Inserted in id order, so every reply comes after the comment it replies to.
+        insert('''
+            INSERT INTO comments(id, author_id, post_id, body, created, parent_id)
+            VALUES(?, ?, ?, ?, ?, ?)
+        ''', comment_rows())
+        del threads
+
+        likes = 0
+        for batch in batched(range(counts['likes'])):
+            cursor = db.executemany('INSERT INTO post_like_assoc(user_id, post_id) VALUES(?, ?) ON CONFLICT DO NOTHING', [
+                (rng.choice(user_ids), rng.choices(popular_posts, cum_weights=post_weights)[0])
+                for _ in batch
+            ])
+            likes += cursor.rowcount
+
+        # Fill in everyone's feed as if they had just followed each of their dens, which copies the
+        # den's latest TIMELINE_BACKFILL posts (see timelines.backfill()). rebuild_timelines() would
+        # copy every post instead, which at this size is far more rows than any feed ever shows.
+        db.execute('''
+            INSERT INTO timelines(user_id, created, post_id, den_id)
+            SELECT user_den_assoc.user_id,
+                latest.created,
+                latest.id,
+                latest.den_id
+            FROM user_den_assoc
+                JOIN dens ON dens.id = user_den_assoc.den_id
+                JOIN (
+                    SELECT id,
+                        den_id,
+                        created,
+                        ROW_NUMBER() OVER (PARTITION BY den_id ORDER BY created DESC, id DESC) AS position
+                    FROM posts
+                ) AS latest ON latest.den_id = user_den_assoc.den_id
+            WHERE dens.follower_count < ?
+                AND latest.position <= ?
+            ON CONFLICT DO NOTHING;
+        ''', (current_app.config['TIMELINE_FANOUT_LIMIT'], current_app.config['TIMELINE_BACKFILL']))
+
+        if not sqlite:
+            # Every row was inserted with its id, so move the id sequences past them.
+            from bobchat.postgres import reset_sequences
+            reset_sequences(db, ['users', 'dens', 'posts', 'comments', 'post_like_assoc', 'user_den_assoc'])
+
+    if sqlite:
+        db.execute('PRAGMA synchronous = {}'.format(current_app.config['SQLITE_SYNCHRONOUS']))
+
+    counts['follows'] = follows
+    # Liking the same post twice is ignored, so there can be fewer than asked for.
+    counts['likes'] = likes
+    return counts
+
+
+# Where `flask bench generate` writes, and `flask bench routes` reads, unless told otherwise.
+# It's kept apart from DATABASE so that benchmarking never touches real data.
+def default_database():
+    return os.path.join(current_app.instance_path, 'bench.sqlite')
+
+
+@click.command('generate')
+@click.option('--database', type=click.Path(dir_okay=False),
+              help='Database file to write. Defaults to bench.sqlite in the instance folder. '
+                   'With DATABASE_DRIVER = "postgresql", the database at POSTGRES_DSN is filled instead.')
+@click.option('--scale', default=1.0, show_default=True,
+              help='Multiplies the size of everything. At 1 there are 10,000 posts; at 100, a million.')
+@click.option('--seed', default=0, show_default=True, help='Seed for the random generator.')
+@click.option('--yes', is_flag=True, help="Don't ask before replacing an existing database.")
+@with_appcontext
+def generate_command(database, scale, seed, yes):
+    """Generate a database of synthetic data for benchmarking."""
+    app = current_app._get_current_object()
+    if get_driver() == 'postgresql':
+        # There's no file to point at, so point POSTGRES_DSN at a database of its own for this.
+        name = get_db().info.dbname
+        if not yes:
+            click.confirm('This deletes everything in the PostgreSQL database {}. Continue?'.format(name), abort=True)
+        started = time.perf_counter()
+        create_schema(get_db())
+        counts = generate(scale, seed)
+        click.echo('Generated {} in the PostgreSQL database {}, in {:.1f} s. Every password is "{}".'.format(
+            ', '.join('{} {}'.format(count, kind) for kind, count in counts.items()),
+            name, time.perf_counter() - started, BENCH_PASSWORD))
+        return
+
+    database = database or default_database()
+    if os.path.exists(database) and not yes:
+        click.confirm('This deletes everything in {}. Continue?'.format(database), abort=True)
+
+    # Start from a brand new file, rather than dropping every table of a big database one by one.
+    for path in (database, database + '-wal', database + '-shm'):
+        if os.path.exists(path):
+            os.unlink(path)
+
+    saved = app.config['DATABASE']
+    app.config['DATABASE'] = database
+    try:
+        started = time.perf_counter()
+        create_schema(get_db())
+        counts = generate(scale, seed)
+    finally:
+        app.config['DATABASE'] = saved
+    click.echo('Generated {} in {}, in {:.1f} s. Every password is "{}".'.format(
+        ', '.join('{} {}'.format(count, kind) for kind, count in counts.items()),
+        database, time.perf_counter() - started, BENCH_PASSWORD))
@@ -0,0 +1,159 @@
+#
+#   timelines.py
+#       Builds each user's feed ahead of time. When a post is written, it's copied into the
+#       timeline of everyone who follows its den ("fan-out on write"), so showing someone their
+#       feed is a single range scan of their timeline instead of a join across every den they follow.
+#
+
+# Copying every post to every follower gets expensive for dens with a huge following: one post
+# would mean thousands of inserts. So dens with at least TIMELINE_FANOUT_LIMIT followers are
+# skipped when fanning out, and their posts are read straight from the den when the feed is
+# shown instead ("fan-out on read"). Reading a feed merges the two.
+#
+# If a den grows past the limit, its older posts are still in timelines, and are also found by
+# reading the den; the UNION in get_timeline() drops the duplicates. If a den shrinks back below
+# the limit, the posts made while it was large are only in timelines after `flask rebuild-timelines`.
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from bobchat.db import get_db
+
+
+# Copies a newly created post into the timeline of every follower of its den,
+# unless the den is too popular to fan out to. The caller commits.
+def fan_out_post(post_id):
+    get_db().execute('''
+        INSERT INTO timelines(user_id, created, post_id, den_id)
+        SELECT user_den_assoc.user_id,
+            posts.created,
+            posts.id,
+            posts.den_id
+        FROM posts
+            JOIN dens ON dens.id = posts.den_id
+            JOIN user_den_assoc ON user_den_assoc.den_id = posts.den_id
+        WHERE posts.id = ?
+            AND dens.follower_count < ?
+        ON CONFLICT DO NOTHING;
+    ''', (post_id, current_app.config['TIMELINE_FANOUT_LIMIT']))
+
+
+# Fills in the most recent posts of a den a user just followed, so their feed isn't empty
+# until the next post. The caller commits.
+def backfill(user_id, den_id):
+    get_db().execute('''
+        INSERT INTO timelines(user_id, created, post_id, den_id)
+        SELECT ?,
+            posts.created,
+            posts.id,
+            posts.den_id
+        FROM posts
+            JOIN dens ON dens.id = posts.den_id
+        WHERE posts.den_id = ?
+            AND dens.follower_count < ?
+        ORDER BY posts.created DESC, posts.id DESC
+        LIMIT ?
+        ON CONFLICT DO NOTHING;
+    ''', (user_id, den_id, current_app.config['TIMELINE_FANOUT_LIMIT'],
+          current_app.config['TIMELINE_BACKFILL']))
+
+
+# Removes a den's posts from a user's timeline after they unfollow it. The caller commits.
+def prune(user_id, den_id):
+    get_db().execute('''
+        DELETE FROM timelines
+        WHERE user_id = ?
+            AND den_id = ?;
+    ''', (user_id, den_id))
+
+
+# Returns one page of a user's feed, newest first.
+# cursor is either None for the first page, or the (created, id) of the last post already shown.
+def get_timeline(user_id, cursor, limit):
+    # Only fixed fragments are spliced into the query text, never user input.
+    if cursor is None:
+        keyset = ''
+        keyset_params = ()
+    else:
+        keyset = 'AND ({}created, {}) < (?, ?)'
+        keyset_params = tuple(cursor)
+
+    fanout_limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+    posts = get_db().execute('''
+    SELECT users.username,
+        dens.name,
+        dens.id as den_id,
+        posts.id as post_id,
+        posts.created,
+        posts.body,
+        posts.title,
+        posts.like_count as likes
+    FROM (
+            -- Posts that were fanned out to this user's timeline...
+            SELECT *
+            FROM (
+                    SELECT post_id
+                    FROM timelines
+                    WHERE user_id = ?
+                        {}
+                    ORDER BY created DESC, post_id DESC
+                    LIMIT ?
+                ) AS fanned_out
+            UNION
+            -- ...and posts in the dens they follow that are too popular to fan out.
+            SELECT *
+            FROM (
+                    SELECT posts.id
+                    FROM posts
+                    WHERE posts.den_id IN (
+                            SELECT user_den_assoc.den_id
+                            FROM user_den_assoc
+                                JOIN dens ON dens.id = user_den_assoc.den_id
+                            WHERE user_den_assoc.user_id = ?
+                                AND dens.follower_count >= ?
+                        )
+                        {}
+                    ORDER BY posts.created DESC, posts.id DESC
+                    LIMIT ?
+                ) AS read_on_demand
+        ) AS feed
+        JOIN posts ON posts.id = feed.post_id
+        JOIN users ON users.id = posts.author_id
+        JOIN dens ON dens.id = posts.den_id
+    ORDER BY posts.created DESC, posts.id DESC
+    LIMIT ?;'''.format(keyset.format('', 'post_id'), keyset.format('posts.', 'posts.id')),
+        (user_id,) + keyset_params + (limit, user_id, fanout_limit) + keyset_params + (limit, limit)
+    ).fetchall()
+    return posts
+
+
+# Throws away every timeline and fills them in again from who follows what.
+def rebuild_timelines():
+    db = get_db()
+    with db:
+        db.execute('DELETE FROM timelines;')
+        db.execute('''
+            INSERT INTO timelines(user_id, created, post_id, den_id)
+            SELECT user_den_assoc.user_id,
+                posts.created,
+                posts.id,
+                posts.den_id
+            FROM user_den_assoc
+                JOIN dens ON dens.id = user_den_assoc.den_id
+                JOIN posts ON posts.den_id = user_den_assoc.den_id
+            WHERE dens.follower_count < ?
+            ON CONFLICT DO NOTHING;
+        ''', (current_app.config['TIMELINE_FANOUT_LIMIT'],))
+
+
+@click.command('rebuild-timelines')
+@with_appcontext
+def rebuild_timelines_command():
+    """Rebuild every user's feed timeline."""
+    rebuild_timelines()
+    click.echo('Timelines rebuilt.')
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_timelines_command)
@@ -7,6 +7,8 @@
 from flask import ( Blueprint, render_template, request )
 
 from bobchat.db import get_db
+from bobchat.search import search_users
+from bobchat.streaming import stream_page
 
 bp = Blueprint('users', __name__, url_prefix='/users')
 
@@ -16,26 +18,23 @@ bp = Blueprint('users', __name__, url_prefix='/users')
 @bp.route('/', methods=['POST', 'GET'])
 def index():
     db = get_db()
-    if request.method == 'POST':
-        users = db.execute(
-            '''
-            select *
-            from users
-            where username like ?;
-            ''',('%'+request.form['search']+'%',)
-        ).fetchall()
+    search = request.values.get('search', '')
+    page = request.args.get('page', 1, type=int)
+    has_more = False
+    if search != '':
+        users, has_more = search_users(search, page)
     else:
+        # Every user is listed, so the page is streamed, and the rows are read as it's rendered.
         users = db.execute(
             '''
-            select *
+            select username, created
             from users;
             '''
-        ).fetchall()
-    return render_template('users/index.html', users=users)
+        )
+    return stream_page('users/index.html', users=users, search=search, page=page, has_more=has_more)
 
 @bp.route('/<username>')
 def user_page(username):
-    print(str(username))
     db = get_db()
     user = db.execute(
         '''
@@ -53,17 +52,11 @@ def user_page(username):
             posts.created,
             posts.title,
             dens.name as den_name,
-            IFNULL(post.likes, 0) AS likes
+            posts.like_count AS likes
         FROM dens, posts
-            LEFT JOIN (
-                SELECT post_id, COUNT(*) AS likes
-                FROM post_like_assoc, posts
-                WHERE posts.id = post_like_assoc.post_id
-                GROUP BY post_like_assoc.post_id
-            ) AS post ON post_id = posts.id
         WHERE posts.author_id = ?
         and posts.den_id = dens.id
-        ORDER BY likes DESC;
+        ORDER BY posts.like_count DESC;
         ''',(author_id,)
     ).fetchall()
     return render_template('users/user_page.html', user = user, posts = posts)
\ No newline at end of file
@@ -0,0 +1,35 @@
+#
+#   gunicorn.conf.py
+#       How Bobchat is served in production. gunicorn reads this file by itself when it's started
+#       from this directory, so all it takes is:
+#
+#       gunicorn
+#
+
+# The app is built and warmed up once, in the master process, and every worker is forked from it
+# ready to serve, instead of each worker building its own and being slow for its first requests.
+# See bobchat/boot.py. The number of workers comes from $WEB_CONCURRENCY, and the port from $PORT.
+
+import gc
+
+wsgi_app = 'bobchat.boot:create_warm_app()'
+preload_app = True
+
+# Den and post pages keep a connection open to hear about new posts, comments and likes,
+# so each worker needs to be able to hold many requests open at once.
+worker_class = 'gthread'
+threads = 100
+
+
+# Runs in the master once the app is loaded, before any workers are forked.
+def when_ready(server):
+    # Python's garbage collector writes to every object it looks at, which would copy the pages the
+    # workers share with the master into each of them. Everything loaded so far lives as long as the
+    # app does anyway, so it's moved where the collector never looks.
+    gc.freeze()
+
+
+# Runs in each worker right after it's forked.
+def post_fork(server, worker):
+    from bobchat.boot import warm_worker
+    warm_worker(server.app.wsgi())
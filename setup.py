@@ -28,9 +28,18 @@ setup(
     zip_safe=False,
     install_requires=[
         'flask',
-        'pandas',
         'gunicorn',
     ],
+    # pip install -e .[asgi] to serve with uvicorn. See bobchat/asgi.py.
+    # pip install -e .[postgresql] to keep the data in PostgreSQL. See bobchat/postgres.py.
+    # pip install -e .[brotli] to also compress static files with brotli. See bobchat/assets.py.
+    # pip install -e .[test] to run the tests in tests/ with pytest.
+    extras_require={
+        'asgi': ['uvicorn'],
+        'postgresql': ['psycopg[binary]', 'psycopg-pool'],
+        'brotli': ['brotli'],
+        'test': ['pytest'],
+    },
 )
 
 #
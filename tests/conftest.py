@@ -0,0 +1,87 @@
+#
+#   conftest.py
+#       Fixtures shared by every test: an app built on a fresh database filled with the seed data,
+#       and a test client for it.
+#
+
+# Tests run against SQLite by default. To run them against PostgreSQL as well, point
+# BOBCHAT_TEST_POSTGRES_DSN at a database they're allowed to wipe, e.g.
+#
+#   BOBCHAT_TEST_POSTGRES_DSN="dbname=bobchat_test" python -m pytest
+#
+# Tests that take the `driver` fixture then run once for each.
+
+import os
+
+import pytest
+
+from bobchat import create_app
+from bobchat.boot import close_database
+from bobchat.db import create_schema, get_db, load_seed_data
+from bobchat.timelines import rebuild_timelines
+
+POSTGRES_DSN = os.environ.get('BOBCHAT_TEST_POSTGRES_DSN')
+
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def driver(request):
+    if request.param == 'postgresql' and not POSTGRES_DSN:
+        pytest.skip('BOBCHAT_TEST_POSTGRES_DSN is not set')
+    return request.param
+
+
+# Only the tests that ask for `driver` run on PostgreSQL. The rest use SQLite.
+@pytest.fixture
+def app(request, tmp_path):
+    driver = request.getfixturevalue('driver') if 'driver' in request.fixturenames else 'sqlite'
+    config = {
+        'TESTING': True,
+        'DATABASE_DRIVER': driver,
+        'DATABASE': str(tmp_path / 'bobchat.sqlite'),
+        'ASSETS_DIR': str(tmp_path / 'assets'),
+        'METRICS_DIR': str(tmp_path / 'metrics'),
+        'LIKE_JOURNAL_DIR': str(tmp_path / 'likes'),
+        'TEMPLATE_CACHE_DIR': None,
+        # The seed users' passwords are hashed when they're loaded, so keep that quick.
+        'PASSWORD_HASH_METHOD': 'pbkdf2',
+        'PASSWORD_PBKDF2_ITERATIONS': 1000,
+    }
+    if driver == 'postgresql':
+        config['POSTGRES_DSN'] = POSTGRES_DSN
+    app = create_app(config)
+
+    with app.app_context():
+        db = get_db()
+        create_schema(db)
+        load_seed_data(db)
+        rebuild_timelines()
+
+    yield app
+
+    close_database(app)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# Registers and logs in a new user with the test client.
+class AuthActions:
+    def __init__(self, client):
+        self._client = client
+
+    def register(self, username='test', password='test'):
+        return self._client.post('/auth/register', data={
+            'username': username, 'password': password, 'firstname': 'Test',
+            'lastname': 'User', 'email': username + '@ucmerced.edu', 'major': 'undeclared',
+        })
+
+    def login(self, username='test', password='test'):
+        self.register(username, password)
+        return self._client.post('/auth/login', data={'username': username, 'password': password})
+
+
+@pytest.fixture
+def auth(client):
+    return AuthActions(client)
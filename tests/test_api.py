@@ -0,0 +1,61 @@
+import pytest
+
+from bobchat.db import get_db
+
+
+# A gzipped response gets a weak ETag (see compression.py). Sending it back must still get a 304,
+# with the same tag, whether or not the response was big enough to compress.
+@pytest.mark.parametrize('path', ['/api/v1/', '/api/v1/dens', '/api/v1/dens/1'])
+def test_gzip_then_not_modified(client, auth, path):
+    auth.login()
+    response = client.get(path, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    response = client.get(path, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+
+def test_not_modified_without_gzip(client):
+    response = client.get('/api/v1/dens')
+    assert 'Content-Encoding' not in response.headers
+    etag = response.headers['ETag']
+    assert not etag.startswith('W/')
+
+    response = client.get('/api/v1/dens', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+
+def test_changed_after_write(client, auth):
+    etag = client.get('/api/v1/dens', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+    auth.login()
+    client.post('/dens/create', data={'name': 'New', 'description': 'A new den'})
+
+    response = client.get('/api/v1/dens', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 200
+
+
+# A client that only sends If-Modified-Since gets a 304 for a date after the last write, but not
+# for the date of the last write itself, since another write may have happened in that second.
+def test_if_modified_since(client, auth, app):
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE versions SET modified = '2020-01-01 00:00:00' WHERE key = 'dens'")
+        db.commit()
+    last_modified = client.get('/api/v1/dens').headers['Last-Modified']
+    assert last_modified == 'Wed, 01 Jan 2020 00:00:00 GMT'
+    later = 'Wed, 01 Jan 2020 00:00:01 GMT'
+    assert client.get('/api/v1/dens', headers={'If-Modified-Since': later}).status_code == 304
+
+    # A den is created in the same second.
+    auth.login()
+    client.post('/dens/create', data={'name': 'New', 'description': 'A new den'})
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE versions SET modified = '2020-01-01 00:00:00' WHERE key = 'dens'")
+        db.commit()
+    response = client.get('/api/v1/dens', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+    assert 'New' in [den['name'] for den in response.get_json()['dens']]
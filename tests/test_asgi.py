@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from bobchat.asgi import BobchatASGI
+from bobchat.db import get_db
+
+
+# Sends one request through the ASGI app and returns (status, body). A body is sent in two parts,
+# as a server would with a large one.
+def get(asgi_app, path, method='GET', body=b'', headers=()):
+    messages = []
+    parts = [body[:len(body) // 2], body[len(body) // 2:]]
+
+    async def receive():
+        return {'type': 'http.request', 'body': parts.pop(0), 'more_body': bool(parts)}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+        'root_path': '', 'headers': [(b'host', b'localhost')] + list(headers), 'server': ('localhost', 80),
+        'method': method,
+    }
+    asyncio.run(asgi_app(scope, receive, send))
+    status = next(message['status'] for message in messages if message['type'] == 'http.response.start')
+    body = b''.join(message.get('body', b'') for message in messages if message['type'] == 'http.response.body')
+    return status, body
+
+
+# The read routes are served over ASGI by the same synchronous views, on the app's thread pool.
+@pytest.mark.parametrize('path', ['/', '/dens/', '/users/', '/auth/login'])
+def test_read_routes(app, path):
+    asgi_app = BobchatASGI(app)
+    try:
+        status, body = get(asgi_app, path)
+    finally:
+        asgi_app.executor.shutdown()
+    assert status == 200
+    assert body.rstrip().endswith(b'</section>')
+
+
+# Without a logged in user, an event stream is handed to the Flask view, which redirects.
+def test_events_requires_login(app):
+    asgi_app = BobchatASGI(app)
+    try:
+        status, body = get(asgi_app, '/events/')
+    finally:
+        asgi_app.executor.shutdown()
+    assert status == 302
+
+
+# A form's body reaches the view.
+def test_post(app):
+    asgi_app = BobchatASGI(app)
+    body = (b'username=asgi&password=asgi&firstname=Test&lastname=User'
+            b'&email=asgi%40ucmerced.edu&major=undeclared')
+    try:
+        status, body = get(asgi_app, '/auth/register', 'POST', body, [
+            (b'content-type', b'application/x-www-form-urlencoded'),
+            (b'content-length', str(len(body)).encode())])
+    finally:
+        asgi_app.executor.shutdown()
+    assert status == 302
+    with app.app_context():
+        assert get_db().execute("SELECT id FROM users WHERE username = 'asgi'").fetchone() is not None
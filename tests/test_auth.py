@@ -0,0 +1,13 @@
+from bobchat import auth as auth_module
+
+
+# A taken username is turned away before its password is hashed, so it doesn't hold up logins.
+def test_register_taken_username(client, auth, monkeypatch):
+    assert auth.register().headers['Location'] == '/auth/login'
+
+    hashed = []
+    monkeypatch.setattr(auth_module, 'hash_password', lambda password: hashed.append(password))
+    response = auth.register()
+    assert response.status_code == 200
+    assert b'User test is already registered.' in response.data
+    assert hashed == []
@@ -0,0 +1,41 @@
+from flask import request_finished
+
+from bobchat.counters import check_counters
+from bobchat.db import get_db, migrate_db
+from bobchat.queryplan import exercise_routes
+
+
+# A freshly created schema is already up to date with every migration for its driver.
+def test_schema_is_up_to_date(app, driver):
+    with app.app_context():
+        assert migrate_db() == []
+
+
+# Every page and form of the site works the same on either driver, and the counters the
+# database keeps are still right afterwards.
+def test_routes(app, driver):
+    # Likes are written straight away, so the counters can be checked as soon as we're done.
+    app.config['LIKE_BUFFER'] = 'off'
+    statuses = []
+
+    def record(sender, response, **extra):
+        statuses.append(response.status_code)
+
+    # exercise_routes() looks up the ids of what it creates between requests.
+    with app.app_context(), request_finished.connected_to(record, app):
+        exercise_routes(app.test_client())
+
+    assert statuses
+    assert [status for status in statuses if status >= 500] == []
+    with app.app_context():
+        drift = check_counters()
+    assert drift == dict.fromkeys(drift, 0)
+
+
+def test_site_stats(app, driver):
+    with app.app_context():
+        db = get_db()
+        stats = db.execute('SELECT users, posts, dens FROM site_stats WHERE id = 1').fetchone()
+        assert stats['users'] == db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        assert stats['posts'] == db.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+        assert stats['dens'] == db.execute('SELECT COUNT(*) FROM dens').fetchone()[0]
@@ -0,0 +1,98 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from bobchat.db import get_db
+from bobchat.likes import get_like_buffer, pending_likes, recover_journals
+
+
+def test_follow(client, auth, app):
+    auth.login()
+    response = client.post('/dens/follow', data={'den_id': 1, 'follow': 'follow'})
+    assert response.headers['Location'] == '/dens/1'
+    with app.app_context():
+        assert get_db().execute(
+            'SELECT COUNT(*) FROM user_den_assoc JOIN users ON users.id = user_id'
+            " WHERE username = 'test' AND den_id = 1").fetchone()[0] == 1
+
+
+@pytest.mark.parametrize('follow', ['follow', 'unfollow'])
+def test_follow_missing_den(client, auth, follow):
+    auth.login()
+    assert client.post('/dens/follow', data={'den_id': 100000, 'follow': follow}).status_code == 404
+    assert client.post('/dens/follow', data={'den_id': 'nope', 'follow': follow}).status_code == 404
+
+
+@pytest.mark.parametrize('like_buffer', ['off', 'memory', 'journal'])
+def test_like(client, auth, app, like_buffer):
+    app.config['LIKE_BUFFER'] = like_buffer
+    auth.login()
+    with app.app_context():
+        post = get_db().execute('SELECT id, den_id, like_count FROM posts WHERE id = 1').fetchone()
+    url = '/dens/{}/{}'.format(post['den_id'], post['id'])
+
+    # The page shows the like straight away, whether or not it has been written yet,
+    # and so does the cached page.
+    likes = 'id="likes-{}">{{}}<'.format(post['id'])
+    client.get(url)
+    assert likes.format(post['like_count'] + 1) in client.post(url).get_data(as_text=True)
+    assert likes.format(post['like_count'] + 1) in client.get(url).get_data(as_text=True)
+    assert likes.format(post['like_count']) in client.post(url).get_data(as_text=True)
+    assert likes.format(post['like_count']) in client.get(url).get_data(as_text=True)
+
+
+# Once a post's likes are written, the buffer keeps nothing for it, and neither does the journal.
+@pytest.mark.parametrize('like_buffer', ['memory', 'journal'])
+def test_like_buffer_forgets_written_posts(client, auth, app, like_buffer):
+    app.config['LIKE_BUFFER'] = like_buffer
+    auth.login()
+    with app.app_context():
+        posts = get_db().execute('SELECT id, den_id FROM posts ORDER BY id LIMIT 2').fetchall()
+    # Liked and unliked, which leaves nothing to write, and liked.
+    for post in [posts[0], posts[0], posts[1]]:
+        assert client.post('/dens/{}/{}'.format(post['den_id'], post['id'])).status_code == 200
+    with app.app_context():
+        buffer = get_like_buffer()
+        assert pending_likes(posts[1]['id']) == 1
+        buffer.flush()
+        assert pending_likes(posts[1]['id']) == 0
+        assert not buffer._deltas
+    if like_buffer == 'journal':
+        assert os.path.getsize(buffer._journal_path) == 0
+
+
+@pytest.mark.parametrize('like_buffer', ['off', 'memory', 'journal'])
+def test_like_missing_post(client, auth, app, like_buffer):
+    app.config['LIKE_BUFFER'] = like_buffer
+    auth.login()
+    assert client.post('/dens/1/100000').status_code == 404
+    with app.app_context():
+        assert pending_likes(100000) == 0
+        assert get_db().execute('SELECT COUNT(*) FROM post_like_assoc WHERE post_id = 100000').fetchone()[0] == 0
+
+
+# A journal left by a worker that died is written out when the app starts, not on a request.
+def test_recover_journal(app):
+    app.config['LIKE_BUFFER'] = 'journal'
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    directory = app.config['LIKE_JOURNAL_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}.journal'.format(process.pid))
+    with app.app_context():
+        db = get_db()
+        user_id = db.execute('SELECT id FROM users ORDER BY id LIMIT 1').fetchone()[0]
+        post_id = db.execute(
+            'SELECT id FROM posts WHERE id NOT IN (SELECT post_id FROM post_like_assoc WHERE user_id = ?)'
+            ' ORDER BY id LIMIT 1', (user_id,)).fetchone()[0]
+    with open(path, 'w', encoding='utf8') as journal:
+        # The last line was cut off when the worker was killed.
+        journal.write('{} {} 1\n{} {}'.format(user_id, post_id, user_id, post_id))
+
+    recover_journals(app)
+    assert not os.path.exists(path)
+    with app.app_context():
+        assert get_db().execute('SELECT 1 FROM post_like_assoc WHERE user_id = ? AND post_id = ?',
+                                (user_id, post_id)).fetchone() is not None
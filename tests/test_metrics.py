@@ -0,0 +1,54 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+# Without METRICS_TOKEN, /metrics is only served to this machine.
+def test_local_only(client):
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code == 403
+
+
+def test_token(app, client):
+    app.config['METRICS_TOKEN'] = 'secret'
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'},
+                          environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    assert response.status_code == 200
+
+
+# A worker that has exited still counts, but its file is folded into exited.json.
+@pytest.mark.skipif(os.name != 'posix', reason='exited workers are only reaped on POSIX')
+def test_exited_worker(app, client):
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    directory = app.config['METRICS_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}.json'.format(process.pid))
+    with open(path, 'w', encoding='utf8') as file:
+        json.dump({'bobchat_requests_total': [[['x', 'GET', '200'], [5]]]}, file)
+
+    line = 'bobchat_requests_total{endpoint="x",method="GET",status="200"} 5'
+    assert line in client.get('/metrics').get_data(as_text=True)
+    assert not os.path.exists(path)
+    assert os.path.exists(os.path.join(directory, 'exited.json'))
+    assert line in client.get('/metrics').get_data(as_text=True)
+
+
+def test_token_not_ascii(app, client):
+    app.config['METRICS_TOKEN'] = 'secret'
+    assert client.get('/metrics', headers={'Authorization': 'Bearer sécret'}).status_code == 403
+
+
+# Each request's slowest statement is logged at DEBUG level, with its values taken out.
+def test_slowest_query_logged(client, caplog):
+    caplog.set_level(logging.DEBUG, logger='bobchat.metrics')
+    client.get('/dens/')
+    messages = [record.getMessage() for record in caplog.records if record.name == 'bobchat.metrics']
+    assert any(message.startswith('GET dens.index 200 in ') and 'slowest' in message
+               and 'SELECT' in message for message in messages)
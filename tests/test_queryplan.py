@@ -0,0 +1,17 @@
+from bobchat.queryplan import QUERY_BUDGETS, check_routes
+
+
+# Every query the site runs, on every page, must look rows up through an index (see queryplan.py).
+def test_no_full_table_scans(app):
+    with app.app_context():
+        offenders, over_budget, checked = check_routes()
+    assert checked > 0
+    assert [(endpoint, sql.strip(), plan) for endpoint, sql, plan in offenders] == []
+
+
+# Each page in QUERY_BUDGETS runs no more queries than its budget. A page that goes over has
+# started looking the same rows up more than once, or one row at a time in a loop.
+def test_query_budgets(app):
+    with app.app_context():
+        offenders, over_budget, checked = check_routes()
+    assert [(endpoint, queries, QUERY_BUDGETS[endpoint]) for endpoint, queries in over_budget] == []
@@ -0,0 +1,13 @@
+import pytest
+
+from bobchat.search import search_users
+
+
+# Short terms are looked up by prefix, longer ones through the search index.
+@pytest.mark.parametrize('term', ['Be', 'Beth'])
+def test_search_users(app, driver, term):
+    with app.app_context():
+        users, has_more = search_users(term)
+    assert 'BethXerxes' in [user['username'] for user in users]
+    # Nothing the results page doesn't show, like password hashes or emails.
+    assert all(sorted(user.keys()) == ['created', 'id', 'username'] for user in users)